@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import itertools
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from escqrs.archive import get_archive
+from model import EventStore, Snapshot, ItemIndex
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+"""
+Event Archiver
+最新snapshotのfrom_versionより RETENTION_VERSIONS 以上古いeventを
+segment fileに移し、EventStoreから削除する
+日常の読み込み (snapshot以降のtail) はarchive済みのeventに触れない
+"""
+
+RETENTION_VERSIONS = int(os.environ.get('ARCHIVE_RETENTION_VERSIONS', '1000'))
+CONCURRENCY = int(os.environ.get('ARCHIVE_CONCURRENCY', '4'))
+# 残り時間がこれを下回ったら次のchunkを始めずにcursorを返す
+TIME_MARGIN_MS = int(os.environ.get('ARCHIVE_TIME_MARGIN_MS', '60000'))
+
+
+class Archiver:
+
+    def __init__(self, root=None, retention_versions=RETENTION_VERSIONS,
+                 concurrency=CONCURRENCY, dry_run=False):
+        self.archive = get_archive(root)
+        if self.archive is None:
+            raise ValueError('ARCHIVE_ROOT is not set')
+        self.retention_versions = retention_versions
+        self.concurrency = max(1, concurrency)
+        self.dry_run = dry_run
+
+    def run(self, item_ids=None, cursor=None, remaining_time_ms=None):
+        report = {
+            'dry_run': self.dry_run,
+            'retention_versions': self.retention_versions,
+            'items': 0,
+            'events': 0,
+            'event_bytes': 0,
+            'segment_bytes': 0,
+            'deleted': 0,
+            'failed': [],
+            'cursor': cursor,
+            'done': True,
+        }
+        if item_ids is None:
+            item_ids = ItemIndex().iter_item_ids(cursor)
+        elif cursor is not None and cursor in item_ids:
+            item_ids = item_ids[item_ids.index(cursor) + 1:]
+        item_ids = iter(item_ids)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while True:
+                chunk = list(itertools.islice(item_ids, self.concurrency * 4))
+                if not chunk:
+                    break
+                if remaining_time_ms and remaining_time_ms() < TIME_MARGIN_MS:
+                    report['done'] = False
+                    break
+                for item_id, result in zip(
+                        chunk, executor.map(self.__archive_or_error, chunk)):
+                    self.__add_result(report, item_id, result)
+                report['cursor'] = chunk[-1]
+        return report
+
+    def archive_item(self, item_id):
+        result = {'events': 0, 'event_bytes': 0, 'segment_bytes': 0,
+                  'deleted': 0}
+        archived_version = self.archive.archived_version(item_id)
+        horizon = Snapshot(item_id).get_from_version() - \
+            self.retention_versions
+
+        es = EventStore(item_id)
+        if horizon > archived_version:
+            writer = None if self.dry_run else self.archive.writer(item_id)
+            for events in es.iter_events(archived_version, horizon):
+                result['events'] += len(events)
+                result['event_bytes'] += sum(
+                    len(json.dumps(event, separators=(',', ':')))
+                    for event in events)
+                if writer is not None:
+                    writer.write(events)
+            if writer is not None:
+                self.archive.commit(item_id, writer)
+                result['segment_bytes'] = writer.bytes
+                archived_version = self.archive.archived_version(item_id)
+
+        # manifestを書き換えた後で削除する
+        # (前回の実行が削除前に止まった分もここで消える)
+        if not self.dry_run and archived_version:
+            result['deleted'] = es.delete_through(archived_version)
+        return result
+
+    def __archive_or_error(self, item_id):
+        # 1 itemの失敗でjob全体を止めない
+        try:
+            return self.archive_item(item_id)
+        except Exception as e:
+            logger.warning('archive: {} {}: {}'.format(
+                item_id, type(e).__name__, e))
+            return e
+
+    @staticmethod
+    def __add_result(report, item_id, result):
+        report['items'] += 1
+        if isinstance(result, Exception):
+            report['failed'].append(
+                {'item_id': item_id, 'error': type(result).__name__})
+            return
+        for key in ('events', 'event_bytes', 'segment_bytes', 'deleted'):
+            report[key] += result[key]
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import logging
+import os
+from archiver import Archiver
+from escqrs.startup import startup
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+'''
+ARCHIVE_ROOT にはsegment fileを置くdirectory (Lambdaでは EFS の mount path)
+を指定する。queryのLambdaにも同じpathを設定すると、archive済みのversionは
+segment fileからreplayされる
+EFSにはVPCの設定が必要なため、template.ymlではこのLambdaをdeployしていない
+(README参照)
+'''
+
+# 時間内に終わらなかった場合、cursorを付けて自分を非同期で呼び直す
+REINVOKE = os.environ.get('ARCHIVE_REINVOKE', 'true').lower() == 'true'
+
+lmbd = None
+
+
+def extract_options(event):
+    """
+    {
+        'dry_run': true,             # 移動せずに件数とbyte数を報告する
+        'retention_versions': 1000,
+        'item_ids': ['00000001'],    # 省略時はInventoryViewの全item
+        'cursor': '00000001'         # 前回の続きから
+    }
+    """
+    options = {'dry_run': bool(event.get('dry_run', False))}
+    for key in ('retention_versions', 'concurrency'):
+        if event.get(key) is not None:
+            options[key] = int(event[key])
+    return options
+
+
+def reinvoke(context, event):
+    global lmbd
+    if lmbd is None:
+        # reinvokeする時だけ使うのでimportも遅らせる
+        import boto3
+        lmbd = boto3.client('lambda')
+    lmbd.invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps(event))
+
+
+@startup
+def lambda_handler(event, context):
+    event = event or {}
+    logger.info('ARCHIVE: {}'.format(event))
+    archiver = Archiver(**extract_options(event))
+    remaining_time_ms = getattr(context, 'get_remaining_time_in_millis', None)
+    report = archiver.run(event.get('item_ids'),
+                          event.get('cursor'),
+                          remaining_time_ms)
+    logger.info('ARCHIVE report: {}'.format(json.dumps(report)))
+
+    if not report['done'] and REINVOKE and context is not None:
+        reinvoke(context, dict(event, cursor=report['cursor']))
+    return report
+
+
+def main(argv=None):
+    # EFSをmountしたhostなどから直接実行する
+    parser = argparse.ArgumentParser(description='archive cold events')
+    parser.add_argument('--root', default=os.environ.get('ARCHIVE_ROOT'))
+    parser.add_argument('--item-ids', nargs='+')
+    parser.add_argument('--retention-versions', type=int)
+    parser.add_argument('--dry-run', action='store_true')
+    options = parser.parse_args(argv)
+    event = {'dry_run': options.dry_run,
+             'retention_versions': options.retention_versions,
+             'item_ids': options.item_ids}
+    archiver = Archiver(options.root, **extract_options(event))
+    print(json.dumps(archiver.run(options.item_ids), indent=2))
+
+
+if __name__ == '__main__':
+    main()
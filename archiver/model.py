@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import logging
+from pynamodb.models import Model
+from pynamodb.attributes import (
+    UnicodeAttribute,
+    NumberAttribute,
+    JSONAttribute
+)
+from exception_handler import raise_for_throttling
+from escqrs.storage import get_backend
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+# --------------------------
+# Event Store Table
+# --------------------------
+class EventStoreModel(Model):
+    class Meta:
+        table_name = 'EventStore'
+        region = 'ap-northeast-1'
+        max_retry_attempts = 8
+        base_backoff_ms = 297
+
+    item_id = UnicodeAttribute(hash_key=True)
+    version = NumberAttribute(range_key=True)
+    event_id = UnicodeAttribute()
+    event_type = UnicodeAttribute()
+    name = UnicodeAttribute()
+    quantity = NumberAttribute()
+    fired_at = UnicodeAttribute()
+    saved_at = UnicodeAttribute()
+    order_id = UnicodeAttribute(null=True)
+
+
+event_store = get_backend(EventStoreModel)
+
+
+class EventStore:
+
+    def __init__(self, item_id):
+        self.__item_id = item_id
+        self.__storage = event_store
+
+    def iter_events(self, from_version, to_version):
+        """from_version < version <= to_version をpage単位でyieldする"""
+        with raise_for_throttling(self.__item_id):
+            for events in self.__storage.iter_pages(self.__item_id,
+                                                    from_version,
+                                                    to_version,
+                                                    consistent_read=True):
+                yield events
+
+    def delete_through(self, to_version):
+        """version <= to_version のeventを削除する return: 削除件数"""
+        deleted = 0
+        with raise_for_throttling(self.__item_id):
+            for rows in self.__storage.iter_projected_pages(
+                    self.__item_id, ('version',), 0, to_version):
+                self.__storage.batch_delete(
+                    [{'item_id': self.__item_id, 'version': version}
+                     for version, in rows])
+                deleted += len(rows)
+        return deleted
+
+
+# --------------------------
+# snapshot Table
+# --------------------------
+class SnapshotModel(Model):
+    class Meta:
+        table_name = 'EventStore'
+        region = 'ap-northeast-1'
+        max_retry_attempts = 8
+        base_backoff_ms = 297
+
+    item_id = UnicodeAttribute(hash_key=True)
+    version = NumberAttribute(range_key=True)
+    from_version = NumberAttribute()
+    name = UnicodeAttribute()
+    state = JSONAttribute()
+    saved_at = UnicodeAttribute()
+    order_id = UnicodeAttribute(null=True)
+
+
+snapshot_store = get_backend(SnapshotModel)
+
+
+class Snapshot:
+
+    __snapshot_suffix = '-snapshot'
+
+    def __init__(self, item_id):
+        self.__item_id = item_id
+        self.__storage = snapshot_store
+
+    def get_from_version(self):
+        """最新snapshotのfrom_version (snapshotが無ければ0)"""
+        with raise_for_throttling(self.__item_id):
+            snapshot = self.__storage.get_latest(
+                self.__item_id + self.__snapshot_suffix)
+        return snapshot['from_version'] if snapshot else 0
+
+
+# --------------------------
+# InventoryView Table
+# --------------------------
+class InventoryViewModel(Model):
+    class Meta:
+        table_name = 'InventoryView'
+        region = 'ap-northeast-1'
+        max_retry_attempts = 8
+        base_backoff_ms = 297
+
+    item_id = UnicodeAttribute(hash_key=True)
+    version = NumberAttribute()
+    name = UnicodeAttribute()
+    state = JSONAttribute()
+    updated_at = UnicodeAttribute()
+
+
+inventory_view_store = get_backend(InventoryViewModel)
+
+
+class ItemIndex:
+    """InventoryViewの1行 = 1 item として、archive対象のitem_idを列挙する"""
+
+    def __init__(self):
+        self.__storage = inventory_view_store
+
+    def iter_item_ids(self, start_after=None):
+        with raise_for_throttling():
+            for item_id in self.__storage.iter_hash_keys(start_after):
+                yield item_id
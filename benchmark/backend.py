@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+import json
+import math
+import random
+import threading
+import time
+from escqrs.storage import ConditionalCheckFailed, register_backend
+from escqrs.storage.base import transact_items
+from escqrs.storage.memory import InMemoryBackend
+
+"""
+benchmark用のDynamoDB stand-in
+
+InMemoryBackendに以下を加える
+- 1 requestごとのlatency (+jitter)
+- throttling (SDKのretryを模してbackoff後に再実行)
+- consumed capacity (RCU/WCU) の見積もり
+- DynamoDB Streams (INSERTのNewImage) の記録
+"""
+
+
+class Stats:
+
+    __fields = ('requests', 'reads', 'writes', 'rcu', 'wcu',
+                'conditional_failures', 'throttles')
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def add(self, **counts):
+        with self.__lock:
+            for key, value in counts.items():
+                self.__counts[key] += value
+
+    def reset(self):
+        with self.__lock:
+            self.__counts = {key: 0 for key in self.__fields}
+
+    def snapshot(self):
+        with self.__lock:
+            return dict(self.__counts)
+
+
+class Stream:
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__records = []
+
+    def put(self, table_name, item):
+        stream_arn = 'arn:aws:dynamodb:local:000000000000:' \
+            'table/{}/stream/local'.format(table_name)
+        with self.__lock:
+            sequence_number = str(len(self.__records) + 1).zfill(21)
+            self.__records.append({
+                'eventID': sequence_number,
+                'eventName': 'INSERT',
+                'eventSource': 'aws:dynamodb',
+                'awsRegion': 'local',
+                'eventSourceARN': stream_arn,
+                'dynamodb': {
+                    'NewImage': serialize(item)['M'],
+                    'SequenceNumber': sequence_number,
+                    'StreamViewType': 'NEW_IMAGE',
+                }
+            })
+
+    def read(self, start, end=None):
+        with self.__lock:
+            return self.__records[start:end]
+
+    def __len__(self):
+        return len(self.__records)
+
+
+class SimulatedDynamoDB:
+    """backendが共有する設定と計測値"""
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, throttle_rate=0.0,
+                 throttle_backoff_ms=25.0, seed=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.throttle_rate = throttle_rate
+        self.throttle_backoff_ms = throttle_backoff_ms
+        self.stats = Stats()
+        self.stream = Stream()
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+
+    def request(self):
+        """1 request分のlatencyとthrottlingを発生させる"""
+        throttles = 0
+        while True:
+            with self.__lock:
+                throttled = self.__random.random() < self.throttle_rate
+                jitter = self.__random.uniform(0, self.jitter_ms)
+            self.__sleep(self.latency_ms + jitter)
+            if not throttled:
+                break
+            throttles += 1
+            self.__sleep(self.throttle_backoff_ms * 2 ** min(throttles, 8))
+        self.stats.add(requests=1, throttles=throttles)
+
+    @staticmethod
+    def __sleep(ms):
+        if ms > 0:
+            time.sleep(ms / 1000.0)
+
+    def register(self, kind='simulated'):
+        register_backend(
+            kind, lambda model: SimulatedBackend(model.Meta.table_name, self))
+
+
+class SimulatedBackend(InMemoryBackend):
+
+    def __init__(self, table_name, dynamodb):
+        super().__init__(table_name)
+        self.__table_name = table_name
+        self.__dynamodb = dynamodb
+
+    def append(self, item):
+        self.__dynamodb.request()
+        wcu = write_capacity(item)
+        try:
+            super().append(item)
+        except ConditionalCheckFailed:
+            # 条件付き書き込みの失敗もWCUを消費する
+            self.__dynamodb.stats.add(writes=1, wcu=wcu,
+                                      conditional_failures=1)
+            raise
+        self.__dynamodb.stats.add(writes=1, wcu=wcu)
+        self.__dynamodb.stream.put(self.__table_name, item)
+
+    def transact_append(self, items):
+        items = [item for _, item in transact_items(items)]
+        self.__dynamodb.request()
+        # transactionは1 itemあたり2倍のWCUを消費する
+        wcu = 2 * sum(map(write_capacity, items))
+        try:
+            super().transact_append(items)
+        except ConditionalCheckFailed:
+            self.__dynamodb.stats.add(writes=len(items), wcu=wcu,
+                                      conditional_failures=1)
+            raise
+        self.__dynamodb.stats.add(writes=len(items), wcu=wcu)
+        for item in items:
+            self.__dynamodb.stream.put(self.__table_name, item)
+
+    def get_latest(self, hash_key):
+        self.__dynamodb.request()
+        item = super().get_latest(hash_key)
+        self.__dynamodb.stats.add(
+            reads=1, rcu=read_capacity([item] if item else [], False))
+        return item
+
+    def get(self, hash_key, range_key, consistent_read=False):
+        self.__dynamodb.request()
+        item = super().get(hash_key, range_key, consistent_read)
+        self.__dynamodb.stats.add(
+            reads=1, rcu=read_capacity([item] if item else [],
+                                       consistent_read))
+        return item
+
+    def query(self, hash_key, from_version=0, to_version=None,
+              ascending=True, limit=None, consistent_read=False):
+        self.__dynamodb.request()
+        items = super().query(hash_key, from_version, to_version,
+                              ascending, limit, consistent_read)
+        self.__dynamodb.stats.add(
+            reads=1, rcu=read_capacity(items, consistent_read))
+        return items
+
+    def query_at_or_before(self, hash_key, attribute, value, limit=1):
+        self.__dynamodb.request()
+        items = super().query_at_or_before(hash_key, attribute, value, limit)
+        self.__dynamodb.stats.add(reads=1, rcu=read_capacity(items, False))
+        return items
+
+    def set_attributes(self, hash_key, range_key, attributes):
+        self.__dynamodb.request()
+        # UpdateItemは更新後のitem全体のサイズでWCUを消費する
+        item = dict(super().get(hash_key, range_key) or {}, **attributes)
+        wcu = write_capacity(item)
+        try:
+            super().set_attributes(hash_key, range_key, attributes)
+        except ConditionalCheckFailed:
+            self.__dynamodb.stats.add(writes=1, wcu=wcu,
+                                      conditional_failures=1)
+            raise
+        self.__dynamodb.stats.add(writes=1, wcu=wcu)
+
+    def batch_write(self, items):
+        for start in range(0, len(items), 25):
+            self.__dynamodb.request()
+            chunk = items[start:start + 25]
+            super().batch_write(chunk)
+            self.__dynamodb.stats.add(
+                writes=len(chunk), wcu=sum(map(write_capacity, chunk)))
+            for item in chunk:
+                self.__dynamodb.stream.put(self.__table_name, item)
+
+    def batch_delete(self, items):
+        for start in range(0, len(items), 25):
+            self.__dynamodb.request()
+            chunk = items[start:start + 25]
+            super().batch_delete(chunk)
+            # 削除も1 itemあたり1 WCU以上を消費する
+            self.__dynamodb.stats.add(
+                writes=len(chunk), wcu=sum(map(write_capacity, chunk)))
+
+    def get_item(self, hash_key, consistent_read=False):
+        self.__dynamodb.request()
+        item = super().get_item(hash_key, consistent_read)
+        self.__dynamodb.stats.add(
+            reads=1,
+            rcu=read_capacity([item] if item else [], consistent_read))
+        return item
+
+    def batch_get(self, hash_keys):
+        items = []
+        # BatchGetItemは100 keyまで itemごとに切り上げて課金される
+        for start in range(0, len(hash_keys), 100):
+            self.__dynamodb.request()
+            chunk = super().batch_get(hash_keys[start:start + 100])
+            self.__dynamodb.stats.add(
+                reads=1,
+                rcu=sum(read_capacity([item], False) for item in chunk))
+            items.extend(chunk)
+        return items
+
+    def put_if_newer(self, item):
+        self.__dynamodb.request()
+        wcu = write_capacity(item)
+        try:
+            super().put_if_newer(item)
+        except ConditionalCheckFailed:
+            self.__dynamodb.stats.add(writes=1, wcu=wcu,
+                                      conditional_failures=1)
+            raise
+        self.__dynamodb.stats.add(writes=1, wcu=wcu)
+
+
+def item_size(item):
+    return len(json.dumps(item, separators=(',', ':')))
+
+
+def write_capacity(item):
+    # 1 WCU = 1KBまで
+    return max(1, int(math.ceil(item_size(item) / 1024.0)))
+
+
+def read_capacity(items, consistent_read):
+    # 1 RCU = 4KBまで(強整合性) 結果整合性はその半分
+    size = sum(map(item_size, items))
+    units = max(1, int(math.ceil(size / 4096.0)))
+    return units if consistent_read else units / 2.0
+
+
+def serialize(value):
+    """python値 -> DynamoDB JSON"""
+    if value is None:
+        return {'NULL': True}
+    if isinstance(value, bool):
+        return {'BOOL': value}
+    if isinstance(value, (int, float)):
+        return {'N': str(value)}
+    if isinstance(value, dict):
+        return {'M': {key: serialize(v) for key, v in value.items()}}
+    if isinstance(value, (list, tuple)):
+        return {'L': [serialize(v) for v in value]}
+    return {'S': str(value)}
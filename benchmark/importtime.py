@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from run import git_revision
+
+"""
+Lambdaのcold start (lambda_functionのimportと最初の呼び出し) のbenchmark
+
+serviceごとに新しいprocessで python -X importtime を実行し、
+importにかかった時間をmodule(top-level package)ごとに集計する
+
+    $ python benchmark/importtime.py --output importtime.json
+    $ python benchmark/importtime.py --modes fast --compare importtime.json
+
+modes
+    default : FAST_STARTUP=false (import時にpatch_all)
+    fast    : FAST_STARTUP=true
+
+--backend dynamodb ではinit中のbotocore client生成も計測に入る
+(requestは送らないので最初の呼び出しは計測しない)
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAYER = os.path.join(ROOT, 'lambda', 'layer', 'python')
+
+MODES = {
+    'default': {'FAST_STARTUP': 'false'},
+    'fast': {'FAST_STARTUP': 'true'},
+}
+
+# 最初の呼び出しに使うevent (無いserviceはimportだけ計測する)
+FIRST_EVENTS = {
+    'event': {
+        'item_id': '00000001',
+        'event_type': 'stock_add',
+        'name': 'Product 1',
+        'quantity': 10,
+        'fired_at': '2020-01-01 00:00:00',
+        'event_id': 'importtime-00000001',
+    },
+    'query': {
+        'path': '/inventory',
+        'httpMethod': 'GET',
+        'queryStringParameters': {'item_id': '00000001'},
+    },
+    'snapshot': {'Records': []},
+}
+
+# 子processで実行する (stderrに -X importtime の出力が出る)
+CHILD = '''
+import json, sys, time
+started = time.perf_counter()
+import lambda_function
+imported = time.perf_counter()
+event = json.loads(sys.argv[1])
+if event is not None:
+    lambda_function.lambda_handler(event, None)
+called = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'first_call_ms': (called - imported) * 1000 if event is not None else None,
+}))
+'''
+
+# 比較する計測値 (いずれも値が大きいほど悪い)
+COMPARED_METRICS = ('import_ms', 'first_call_ms', 'cold_start_ms')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--services', nargs='+',
+                        default=['event', 'query', 'snapshot',
+                                 'compaction', 'archiver'])
+    parser.add_argument('--modes', nargs='+', choices=sorted(MODES),
+                        default=['default', 'fast'])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='serviceごとの実行回数 (medianを取る)')
+    parser.add_argument('--top', type=int, default=10,
+                        help='self timeの大きいmoduleを何件出すか')
+    parser.add_argument('--backend', choices=['memory', 'dynamodb'],
+                        default='memory',
+                        help='EVENT_STORE_BACKEND')
+    parser.add_argument('--tracing', choices=['enabled', 'disabled'],
+                        default='enabled',
+                        help='AWS_XRAY_SDK_ENABLED (Tracing: Active相当)')
+    parser.add_argument('--output', help='結果のJSONを書き込むfile')
+    parser.add_argument('--compare', help='比較する過去の結果JSON')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='regressionとみなす悪化率 (default 20%%)')
+    return parser.parse_args(argv)
+
+
+def parse_importtime(stderr):
+    """
+    -X importtime の行 'import time: self [us] | cumulative | name'
+    return: [(module名, self us, cumulative us)]
+    """
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue  # header行
+        modules.append((fields[2].strip(),
+                        int(fields[0]), int(fields[1])))
+    return modules
+
+
+def package_of(module):
+    return module.split('.')[0]
+
+
+def run_once(service, mode, options):
+    env = dict(os.environ)
+    env.update(MODES[mode])
+    env.update({
+        'PYTHONPATH': LAYER,
+        'EVENT_STORE_BACKEND': options.backend,
+        'AWS_XRAY_SDK_ENABLED':
+            'true' if options.tracing == 'enabled' else 'false',
+        'AWS_XRAY_CONTEXT_MISSING': 'IGNORE_ERROR',
+    })
+    env.setdefault('AWS_DEFAULT_REGION', 'ap-northeast-1')
+    first_event = None
+    if options.backend == 'dynamodb':
+        # client生成でcredentialを探しに行かないように
+        env.setdefault('AWS_ACCESS_KEY_ID', 'importtime')
+        env.setdefault('AWS_SECRET_ACCESS_KEY', 'importtime')
+    else:
+        first_event = FIRST_EVENTS.get(service)
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', CHILD,
+         json.dumps(first_event)],
+        cwd=os.path.join(ROOT, service), env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+    timing = json.loads(process.stdout.strip().splitlines()[-1])
+    return timing, parse_importtime(process.stderr)
+
+
+def median(values):
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    return round(statistics.median(values), 2)
+
+
+def measure(service, mode, options):
+    timings, packages, modules = [], {}, {}
+    for _ in range(options.repeat):
+        timing, imported = run_once(service, mode, options)
+        timings.append(timing)
+        run_packages = {}
+        for name, self_us, _ in imported:
+            package = package_of(name)
+            run_packages[package] = run_packages.get(package, 0) + self_us
+            modules.setdefault(name, []).append(self_us)
+        for package, self_us in run_packages.items():
+            packages.setdefault(package, []).append(self_us)
+
+    import_ms = median([timing['import_ms'] for timing in timings])
+    first_call_ms = median([timing['first_call_ms'] for timing in timings])
+    slowest = sorted(modules.items(),
+                     key=lambda module: statistics.median(module[1]),
+                     reverse=True)[:options.top]
+    return {
+        'import_ms': import_ms,
+        'first_call_ms': first_call_ms,
+        'cold_start_ms': round(import_ms + (first_call_ms or 0), 2),
+        # top-level packageごとのself timeの合計 (ms)
+        'packages_ms': {
+            package: round(statistics.median(values) / 1000.0, 2)
+            for package, values in sorted(
+                packages.items(),
+                key=lambda package: statistics.median(package[1]),
+                reverse=True)[:options.top]},
+        'slowest_modules_ms': [
+            [name, round(statistics.median(values) / 1000.0, 2)]
+            for name, values in slowest],
+    }
+
+
+def compare(result, baseline, tolerance):
+    regressions = []
+    for service, modes in result['services'].items():
+        for mode, metrics in modes.items():
+            base = baseline.get('services', {}).get(service, {}).get(mode)
+            if not base:
+                continue
+            for metric in COMPARED_METRICS:
+                current, previous = metrics.get(metric), base.get(metric)
+                if current is None or not previous:
+                    continue
+                change = (current - previous) / float(previous)
+                if change > tolerance:
+                    regressions.append({
+                        'service': service, 'mode': mode,
+                        'metric': metric, 'baseline': previous,
+                        'current': current, 'change': round(change, 3)})
+    return regressions
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    result = {
+        'meta': {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'options': vars(options),
+        },
+        'services': {},
+    }
+    for service in options.services:
+        result['services'][service] = {
+            mode: measure(service, mode, options) for mode in options.modes}
+
+    if options.compare:
+        with open(options.compare) as f:
+            result['regressions'] = compare(result, json.load(f),
+                                            options.tolerance)
+
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+    return 1 if result.get('regressions') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+"""
+event / snapshot / query Lambdaのbenchmark
+
+    $ python benchmark/run.py --output bench.json
+    $ python benchmark/run.py --latency-ms 5 --throttle-rate 0.01 \\
+        --compare bench.json
+"""
+
+# 比較する計測値と、値が大きいほど悪いかどうか
+COMPARED_METRICS = {
+    'p50_ms': True,
+    'p99_ms': True,
+    'throughput_per_s': False,
+    'retries': True,
+    'conflict_rate': True,
+    'rcu': True,
+    'wcu': True,
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--scenarios', nargs='+',
+                        default=['hot_item', 'hot_item_batched',
+                                 'hot_item_queued',
+                                 'uniform_items', 'long_history',
+                                 'duplicate_heavy', 'replay'])
+    parser.add_argument('--commands', type=int, default=200)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--items', type=int, default=20)
+    parser.add_argument('--history', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--window', type=int, default=10,
+                        help='hot_item_batchedで1 invocationに送るcommand数')
+    parser.add_argument('--group-commit', action='store_true')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.3)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--snapshot-policy', default=None)
+    parser.add_argument('--shards', type=int, default=0,
+                        help='hot item (00000001) をshardする数 (SHARDED_ITEMS)')
+    parser.add_argument('--consistency', choices=['eventual', 'strong'],
+                        default='eventual',
+                        help='strongはInventoryViewを使わずreplayする')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='結果のJSONを書き込むfile')
+    parser.add_argument('--compare', help='比較する過去の結果JSON')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='regressionとみなす悪化率 (default 20%%)')
+    return parser.parse_args(argv)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(result, baseline, tolerance):
+    regressions = []
+    for scenario, phases in result['scenarios'].items():
+        for phase, metrics in phases.items():
+            base = baseline.get('scenarios', {}).get(scenario, {}).get(phase)
+            if not base:
+                continue
+            for metric, higher_is_worse in COMPARED_METRICS.items():
+                current, previous = metrics.get(metric), base.get(metric)
+                if current is None or not previous:
+                    continue
+                change = (current - previous) / float(previous)
+                if not higher_is_worse:
+                    change = -change
+                if change > tolerance:
+                    regressions.append({
+                        'scenario': scenario, 'phase': phase,
+                        'metric': metric, 'baseline': previous,
+                        'current': current, 'change': round(change, 3)})
+    return regressions
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    os.environ['EVENT_STORE_BACKEND'] = 'simulated'
+    # hot_item_queuedのcommand queueはprocess内のstand-in
+    os.environ['COMMAND_QUEUE'] = 'inprocess'
+    if options.group_commit:
+        os.environ['GROUP_COMMIT'] = 'true'
+    if options.snapshot_policy:
+        os.environ['SNAPSHOT_POLICY'] = options.snapshot_policy
+    if options.shards > 1:
+        os.environ['SHARDED_ITEMS'] = '00000001:{}'.format(options.shards)
+
+    import logging
+    logging.disable(logging.WARNING)
+    import services
+    from backend import SimulatedDynamoDB
+    from scenarios import SCENARIOS, Runner
+
+    dynamodb = SimulatedDynamoDB(
+        latency_ms=options.latency_ms,
+        jitter_ms=options.jitter_ms,
+        throttle_rate=options.throttle_rate,
+        seed=options.seed)
+    dynamodb.register('simulated')
+    runner = Runner(services.load_services(), dynamodb, options)
+
+    result = {
+        'meta': {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'options': vars(options),
+        },
+        'scenarios': {},
+    }
+    for name in options.scenarios:
+        runner.reset()
+        result['scenarios'][name] = SCENARIOS[name](runner)
+
+    if options.compare:
+        with open(options.compare) as f:
+            result['regressions'] = compare(result, json.load(f),
+                                            options.tolerance)
+
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+    return 1 if result.get('regressions') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+import copy
+import datetime
+import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from escqrs.replay import ReplayEngine
+from escqrs.storage.memory import InMemoryBackend
+from backend import Stream
+
+"""
+benchmark scenario
+各scenarioは event -> snapshot -> query の順に各Lambdaを駆動し、
+phaseごとの計測値を返す
+"""
+
+
+def command(item_id, event_type, quantity, event_id=None):
+    event = dict(
+        item_id=str(item_id).zfill(8),
+        event_type=event_type,
+        name='Product {}'.format(item_id),
+        quantity=quantity,
+        fired_at=str(datetime.datetime.utcnow()),
+        event_id=event_id or str(uuid.uuid4())
+    )
+    if event_type != 'stock_add':
+        event['order_id'] = str(uuid.uuid4())
+    return event
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(q / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Runner:
+
+    def __init__(self, services, dynamodb, options):
+        self.services = services
+        self.dynamodb = dynamodb
+        self.options = options
+        self.random = random.Random(options.seed)
+        self.__stream_cursor = 0
+
+    def reset(self):
+        InMemoryBackend.clear()
+        self.dynamodb.stream = Stream()
+        self.__stream_cursor = 0
+        for service in self.services.values():
+            service.clear_caches()
+
+    def measure(self, calls, concurrency=1, before_each=None):
+        """calls: 引数なしcallableのlist"""
+        latencies = []
+        errors = [0]
+
+        def timed(call):
+            if before_each:
+                before_each()
+            started = time.perf_counter()
+            try:
+                call()
+            except Exception:
+                errors[0] += 1
+            latencies.append(time.perf_counter() - started)
+
+        self.dynamodb.stats.reset()
+        started = time.perf_counter()
+        if concurrency > 1:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                list(executor.map(timed, calls))
+        else:
+            for call in calls:
+                timed(call)
+        elapsed = time.perf_counter() - started
+        return self.summarize(latencies, elapsed, errors[0])
+
+    def summarize(self, latencies, elapsed, errors):
+        stats = self.dynamodb.stats.snapshot()
+        return {
+            'count': len(latencies),
+            'errors': errors,
+            'elapsed_s': round(elapsed, 6),
+            'throughput_per_s': round(len(latencies) / elapsed, 3)
+            if elapsed else None,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3)
+            if latencies else None,
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3)
+            if latencies else None,
+            'retries': stats['conditional_failures'],
+            'conflict_rate': round(
+                stats['conditional_failures'] / float(len(latencies)), 3)
+            if latencies else None,
+            'throttles': stats['throttles'],
+            'requests': stats['requests'],
+            'rcu': stats['rcu'],
+            'wcu': stats['wcu'],
+        }
+
+    def run_commands(self, commands, concurrency=None, cold=False):
+        handler = self.services['event'].lambda_handler
+        before_each = self.services['event'].clear_caches if cold else None
+        return self.measure(
+            [lambda c=c: handler(c, None) for c in commands],
+            concurrency or self.options.concurrency,
+            before_each)
+
+    def run_queued(self, commands, concurrency=None):
+        """
+        commandをcommand queueに送り、consumerが全て適用し終えるまで
+        latencyは送信からconsumerが適用し終えるまで
+        """
+        module = self.services['event'].modules['lambda_function']
+        queue = module.get_command_queue()
+        queue.reset_stats()
+        self.dynamodb.stats.reset()
+        workers = concurrency or self.options.concurrency
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(
+                lambda c: module.enqueue_controller([c]), commands))
+        queue.drain()
+        elapsed = time.perf_counter() - started
+        result = self.summarize(queue.latencies, elapsed,
+                                len(queue.dead_letters))
+        result['redeliveries'] = queue.redeliveries
+        return result
+
+    def drain_stream(self):
+        """ここまでに記録されたstreamをbatch単位でsnapshot Lambdaに渡す"""
+        handler = self.services['snapshot'].lambda_handler
+        end = len(self.dynamodb.stream)
+        batches = []
+        for start in range(self.__stream_cursor, end,
+                           self.options.batch_size):
+            records = self.dynamodb.stream.read(
+                start, min(start + self.options.batch_size, end))
+            batches.append({'Records': records})
+        self.__stream_cursor = end
+        failures = []
+
+        def process(batch):
+            response = handler(batch, None) or {}
+            failures.extend(response.get('batchItemFailures', []))
+
+        result = self.measure([lambda b=b: process(b) for b in batches])
+        result['records'] = sum(len(b['Records']) for b in batches)
+        result['batch_item_failures'] = len(failures)
+        return result
+
+    def run_queries(self, item_ids, cold=False):
+        handler = self.services['query'].lambda_handler
+        before_each = self.services['query'].clear_caches if cold else None
+        requests = [{
+            'path': '/inventory',
+            'httpMethod': 'GET',
+            'queryStringParameters': {
+                'item_id': str(i).zfill(8),
+                'consistency': self.options.consistency,
+            },
+        } for i in item_ids]
+        return self.measure(
+            [lambda r=r: handler(r, None) for r in requests],
+            self.options.concurrency,
+            before_each)
+
+    def seed_stock(self, item_ids, quantity):
+        handler = self.services['event'].lambda_handler
+        for item_id in item_ids:
+            handler(command(item_id, 'stock_add', quantity), None)
+
+
+def hot_item(runner):
+    """1 itemにcommandが集中する"""
+    options = runner.options
+    runner.seed_stock([1], options.commands * 10)
+    commands = [command(1, 'item_reserve', 1)
+                for _ in range(options.commands)]
+    return {
+        'event': runner.run_commands(commands),
+        'snapshot': runner.drain_stream(),
+        'query': runner.run_queries([1] * options.queries),
+    }
+
+
+def hot_item_queued(runner):
+    """hot_itemのcommandをitem_idごとの順序付きqueue経由で適用する"""
+    options = runner.options
+    runner.seed_stock([1], options.commands * 10)
+    commands = [command(1, 'item_reserve', 1)
+                for _ in range(options.commands)]
+    return {
+        'event': runner.run_queued(commands),
+        'snapshot': runner.drain_stream(),
+        'query': runner.run_queries([1] * options.queries),
+    }
+
+
+def hot_item_batched(runner):
+    """hot_itemのcommandを options.window 件ずつ1 invocationで送る"""
+    options = runner.options
+    runner.seed_stock([1], options.commands * 10)
+    commands = [command(1, 'item_reserve', 1)
+                for _ in range(options.commands)]
+    batches = [commands[start:start + options.window]
+               for start in range(0, len(commands), options.window)]
+    return {
+        'event': runner.run_commands(batches),
+        'snapshot': runner.drain_stream(),
+        'query': runner.run_queries([1] * options.queries),
+    }
+
+
+def uniform_items(runner):
+    """options.items個のitemに一様にcommandが分散する"""
+    options = runner.options
+    item_ids = list(range(1, options.items + 1))
+    runner.seed_stock(item_ids, options.commands * 10)
+    commands = [command(runner.random.choice(item_ids), 'item_reserve', 1)
+                for _ in range(options.commands)]
+    return {
+        'event': runner.run_commands(commands),
+        'snapshot': runner.drain_stream(),
+        'query': runner.run_queries(
+            [runner.random.choice(item_ids) for _ in range(options.queries)]),
+    }
+
+
+def long_history(runner):
+    """snapshotの無い長い履歴を持つitemのreplay (cacheは毎回捨てる)"""
+    options = runner.options
+    cycle = ['stock_add', 'item_reserve', 'item_reserve_complete']
+    history = []
+    for version in range(1, options.history + 1):
+        event = command(1, cycle[(version - 1) % len(cycle)], 1)
+        event['version'] = version
+        event['saved_at'] = event['fired_at']
+        history.append(event)
+    runner.services['event'].modules['model'].event_store.batch_write(
+        history)
+    return {
+        'query': runner.run_queries([1] * options.queries, cold=True),
+        'event': runner.run_commands(
+            [command(1, 'stock_add', 1) for _ in range(options.queries)],
+            concurrency=1, cold=True),
+        'snapshot': runner.drain_stream(),
+    }
+
+
+def duplicate_heavy(runner):
+    """options.duplicate_ratioの割合でevent_idが重複するstream"""
+    options = runner.options
+    runner.seed_stock([1], options.commands * 10)
+    commands = []
+    for _ in range(options.commands):
+        if commands and runner.random.random() < options.duplicate_ratio:
+            original = runner.random.choice(commands)
+            commands.append(copy.deepcopy(original))
+        else:
+            commands.append(command(1, 'item_reserve', 1))
+    return {
+        'event': runner.run_commands(commands),
+        'snapshot': runner.drain_stream(),
+        'query': runner.run_queries([1] * options.queries),
+    }
+
+
+def replay(runner):
+    """ReplayEngineのvectorized/scalarの一致確認と所要時間"""
+    options = runner.options
+    state_handler = runner.services['query'].modules['model'].State()
+    engine = ReplayEngine(state_handler.apply, threshold=0)
+    event_types = ['stock_add', 'item_reserve',
+                   'item_reserve_complete', 'item_reserve_cancel']
+    events = [{'event_type': runner.random.choice(event_types),
+               'quantity': runner.random.randint(1, 10)}
+              for _ in range(options.history)]
+    initial_state = {'available': 0, 'reserved': 0, 'bought': 0}
+
+    started = time.perf_counter()
+    expected = engine.replay_scalar(dict(initial_state), events)
+    scalar_elapsed = time.perf_counter() - started
+    started = time.perf_counter()
+    actual = engine.replay(dict(initial_state), events)
+    vectorized_elapsed = time.perf_counter() - started
+
+    if actual != expected:
+        raise AssertionError(
+            'vectorized replay {} != State.apply {}'.format(actual, expected))
+    return {
+        'replay': {
+            'events': len(events),
+            'scalar_ms': round(scalar_elapsed * 1000, 3),
+            'vectorized_ms': round(vectorized_elapsed * 1000, 3),
+            'equivalent': True,
+        }
+    }
+
+
+SCENARIOS = {
+    'hot_item': hot_item,
+    'hot_item_batched': hot_item_batched,
+    'hot_item_queued': hot_item_queued,
+    'uniform_items': uniform_items,
+    'long_history': long_history,
+    'duplicate_heavy': duplicate_heavy,
+    'replay': replay,
+}
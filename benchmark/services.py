@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import importlib
+import os
+import sys
+
+"""
+event / snapshot / query のLambdaを1つのprocessに読み込む
+
+各serviceは model.py などの同名moduleをflatにimportするため、
+serviceごとにsys.pathを切り替えて読み込み、読み込み後にsys.modulesから外す
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAYER = os.path.join(ROOT, 'lambda', 'layer', 'python')
+
+if LAYER not in sys.path:
+    sys.path.insert(0, LAYER)
+os.environ.setdefault('AWS_XRAY_SDK_ENABLED', 'false')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'ap-northeast-1')
+
+
+class Service:
+
+    def __init__(self, name):
+        self.name = name
+        self.directory = os.path.join(ROOT, name)
+        self.modules = {}
+        self.__load()
+
+    def __load(self):
+        sys.path.insert(0, self.directory)
+        try:
+            importlib.import_module('lambda_function')
+        finally:
+            sys.path.remove(self.directory)
+            for name, module in list(sys.modules.items()):
+                if self.__is_service_module(module):
+                    self.modules[name] = sys.modules.pop(name)
+
+    def __is_service_module(self, module):
+        path = getattr(module, '__file__', None) or ''
+        return os.path.dirname(os.path.abspath(path)) == self.directory
+
+    @property
+    def lambda_handler(self):
+        return self.modules['lambda_function'].lambda_handler
+
+    def clear_caches(self):
+        """warm containerのcacheを捨てて cold 相当にする"""
+        for module in self.modules.values():
+            for value in vars(module).values():
+                if hasattr(value, 'clear') and \
+                        type(value).__name__ == 'LRUCache':
+                    value.clear()
+
+
+def load_services(names=('event', 'snapshot', 'query')):
+    return {name: Service(name) for name in names}
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+
+"""
+snapshot LambdaのDynamoDB Streams decodeのmicrobenchmark
+
+DynamoDBStreamsRecord (1 recordずつTypeDeserializer) と
+StreamImageDecoder.decode_batch を同じRecords batchで比べる
+計測の前に、全recordのdecode結果が一致することを確かめる
+
+    $ python benchmark/stream_decode.py --records 1000 --repeat 20
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (os.path.join(ROOT, 'lambda', 'layer', 'python'),
+             os.path.join(ROOT, 'snapshot')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from backend import serialize  # noqa: E402
+from dynamodb_stream_derecord import (  # noqa: E402
+    DynamoDBStreamsRecord, event_store_decoder)
+
+NON_EVENT_SUFFIXES = ('-snapshot', '-deduplication', '-idempotency')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--records', type=int, default=1000,
+                        help='1 batchのevent数 (guard rowなどは別に足す)')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--snapshot-every', type=int, default=10)
+    parser.add_argument('--output', help='結果のJSONを書き込むfile')
+    return parser.parse_args(argv)
+
+
+def stream_record(sequence_number, item):
+    return {
+        'eventID': str(sequence_number),
+        'eventName': 'INSERT',
+        'eventSource': 'aws:dynamodb',
+        'awsRegion': 'local',
+        'eventSourceARN': 'arn:aws:dynamodb:local:000000000000:'
+                          'table/EventStore/stream/local',
+        'dynamodb': {
+            'NewImage': serialize(item)['M'],
+            'SequenceNumber': str(sequence_number).zfill(21),
+            'StreamViewType': 'NEW_IMAGE',
+        }
+    }
+
+
+def make_batch(options):
+    """event + idempotency guard row + 一定間隔でstate mapを持つsnapshot row"""
+    items = []
+    for version in range(1, options.records + 1):
+        item_id = str(version % 10).zfill(8)
+        event_id = str(uuid.uuid4())
+        items.append({
+            'item_id': item_id, 'version': version,
+            'event_id': event_id,
+            'event_type': 'stock_add' if version % 3 else 'reserve',
+            'name': 'Product {}'.format(item_id), 'quantity': version % 7,
+            'fired_at': '2020-01-01 00:00:00.000000',
+            'saved_at': '2020-01-01 00:00:00.100000',
+            'order_id': None if version % 3 else str(uuid.uuid4()),
+        })
+        items.append({
+            'item_id': '{}-idempotency'.format(event_id), 'version': 0,
+            'event_item_id': item_id, 'event_version': version,
+            'expires_at': 1577836800 + 604800,
+        })
+        if version % options.snapshot_every == 0:
+            items.append({
+                'item_id': '{}-snapshot'.format(item_id), 'version': version,
+                'from_version': version - options.snapshot_every,
+                'name': 'Product {}'.format(item_id),
+                'saved_at': '2020-01-01 00:00:00.200000',
+                'state': {
+                    'available': version, 'reserved': 2, 'bought': 1,
+                    'ratio': 0.25,
+                    'last': {'version': version, 'quantity': 1.5,
+                             'tags': {'hot': True, 'note': None}},
+                },
+            })
+    return [stream_record(sequence_number, item)
+            for sequence_number, item in enumerate(items, 1)]
+
+
+def is_command_event(item_id):
+    return not item_id.endswith(NON_EVENT_SUFFIXES)
+
+
+def decode_per_record(records):
+    """変更前のsnapshot Lambdaと同じく1 recordずつdecodeしてから捨てる"""
+    events = []
+    for record in records:
+        if record['eventName'] != 'INSERT':
+            continue
+        event = DynamoDBStreamsRecord(record).image
+        if is_command_event(event['item_id']):
+            events.append(event)
+    return events
+
+
+def decode_batch(records):
+    return [event for _, event in event_store_decoder.decode_batch(
+        records, accept_key=is_command_event)]
+
+
+def decode_batch_all(records):
+    # 捨てるrowもdecodeする (attributeのdecodeだけの比較)
+    return [event for _, event in event_store_decoder.decode_batch(records)]
+
+
+def verify(records):
+    for record in records:
+        expected = DynamoDBStreamsRecord(record).image
+        actual = event_store_decoder.decode(record['dynamodb']['NewImage'])
+        if expected != actual or \
+                [type(v) for v in expected.values()] != \
+                [type(v) for v in actual.values()]:
+            raise AssertionError('decode mismatch: {} != {}'.format(
+                expected, actual))
+    if decode_per_record(records) != decode_batch(records):
+        raise AssertionError('decode_batch mismatch')
+
+
+def measure(decode, records, repeat):
+    elapsed = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        decode(records)
+        elapsed.append(time.perf_counter() - started)
+    elapsed.sort()
+    return {
+        'median_ms': round(elapsed[len(elapsed) // 2] * 1000, 3),
+        'min_ms': round(elapsed[0] * 1000, 3),
+        'records_per_s': round(len(records) / elapsed[len(elapsed) // 2]),
+    }
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    # logger.info のformatは計測に含め、出力だけ止める
+    logging.disable(logging.INFO)
+    records = make_batch(options)
+    verify(records)
+    result = {
+        'records': len(records),
+        'per_record': measure(decode_per_record, records, options.repeat),
+        'batch': measure(decode_batch, records, options.repeat),
+        'batch_all_rows': measure(decode_batch_all, records, options.repeat),
+    }
+    result['speedup'] = round(result['per_record']['median_ms'] /
+                              result['batch']['median_ms'], 2)
+
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
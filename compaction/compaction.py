@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from retrying import retry
+from exception_handler import Throttled, is_throttled
+from model import SnapshotStore, ItemIndex, item_size
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+"""
+Snapshot Compaction
+<item_id>-snapshot partitionのうち、
+    - 最新 KEEP_LATEST 件
+    - CHECKPOINT_INTERVAL versionごとの区間で最後のsnapshot (as_of_version用)
+を残し、それ以外を削除する
+"""
+
+KEEP_LATEST = int(os.environ.get('COMPACTION_KEEP_LATEST', '3'))
+CHECKPOINT_INTERVAL = int(
+    os.environ.get('COMPACTION_CHECKPOINT_INTERVAL', '1000'))
+CONCURRENCY = int(os.environ.get('COMPACTION_CONCURRENCY', '4'))
+# 残り時間がこれを下回ったら次のchunkを始めずにcursorを返す
+TIME_MARGIN_MS = int(os.environ.get('COMPACTION_TIME_MARGIN_MS', '30000'))
+
+# BatchWriteItemの上限
+DELETE_BATCH_SIZE = 25
+
+
+def select_expired(snapshots, keep_latest=KEEP_LATEST,
+                   checkpoint_interval=CHECKPOINT_INTERVAL):
+    """
+    snapshots: version昇順のiterable
+    削除してよいsnapshotを順にyieldする (最新keep_latest件分だけ先読みする)
+    """
+    def bucket(snapshot):
+        if not checkpoint_interval:
+            return None
+        return snapshot['from_version'] // checkpoint_interval
+
+    recent = deque()
+    previous = None
+    for snapshot in snapshots:
+        if previous is not None:
+            # 区間で最後のsnapshotはcheckpointとして残す
+            is_checkpoint = checkpoint_interval and \
+                bucket(previous) != bucket(snapshot)
+            recent.append((previous, is_checkpoint))
+        previous = snapshot
+        while len(recent) >= keep_latest:
+            expired, is_checkpoint = recent.popleft()
+            if not is_checkpoint:
+                yield expired
+
+
+class Throttle:
+    """
+    throttlingされたら削除の間隔を広げ、成功したら狭める
+    全threadで共有する
+    """
+
+    def __init__(self, min_delay=0.05, max_delay=5.0):
+        self.__min_delay = min_delay
+        self.__max_delay = max_delay
+        self.__delay = 0.0
+        self.__lock = threading.Lock()
+        self.throttles = 0
+
+    def wait(self):
+        with self.__lock:
+            delay = self.__delay
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttled(self):
+        with self.__lock:
+            self.__delay = min(self.__max_delay,
+                               max(self.__min_delay, self.__delay * 2))
+            self.throttles += 1
+
+    def succeeded(self):
+        with self.__lock:
+            self.__delay = self.__delay / 2 \
+                if self.__delay > self.__min_delay else 0.0
+
+
+class Compaction:
+
+    def __init__(self, keep_latest=KEEP_LATEST,
+                 checkpoint_interval=CHECKPOINT_INTERVAL,
+                 concurrency=CONCURRENCY, dry_run=False):
+        if keep_latest < 1:
+            raise ValueError('keep_latest must be >= 1')
+        self.keep_latest = keep_latest
+        self.checkpoint_interval = checkpoint_interval
+        self.concurrency = max(1, concurrency)
+        self.dry_run = dry_run
+        self.__throttle = Throttle()
+
+    def run(self, item_ids=None, cursor=None, remaining_time_ms=None):
+        """
+        item_ids: 対象item 省略時はInventoryViewの全item
+        cursor: 前回の実行で最後に処理したitem_id (その次から再開する)
+        remaining_time_ms: Lambdaの残り時間を返す関数
+        """
+        report = {
+            'dry_run': self.dry_run,
+            'keep_latest': self.keep_latest,
+            'checkpoint_interval': self.checkpoint_interval,
+            'items': 0,
+            'snapshots': 0,
+            'expired': 0,
+            'reclaimed_bytes': 0,
+            'throttles': 0,
+            'failed': [],
+            'cursor': cursor,
+            'done': True,
+        }
+        chunks = self.__chunks(self.__item_ids(item_ids, cursor))
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for chunk in chunks:
+                if remaining_time_ms and remaining_time_ms() < TIME_MARGIN_MS:
+                    report['done'] = False
+                    break
+                for item_id, result in zip(
+                        chunk, executor.map(self.__compact_or_error, chunk)):
+                    self.__add_result(report, item_id, result)
+                report['cursor'] = chunk[-1]
+        report['throttles'] = self.__throttle.throttles
+        return report
+
+    def compact_item(self, item_id):
+        """return: {'snapshots', 'expired', 'reclaimed_bytes'}"""
+        store = SnapshotStore(item_id)
+        result = {'snapshots': 0, 'expired': 0, 'reclaimed_bytes': 0}
+
+        def counted(snapshots):
+            for snapshot in snapshots:
+                result['snapshots'] += 1
+                yield snapshot
+
+        batch = []
+        for snapshot in select_expired(counted(store.iter_snapshots()),
+                                       self.keep_latest,
+                                       self.checkpoint_interval):
+            result['expired'] += 1
+            result['reclaimed_bytes'] += item_size(snapshot)
+            if self.dry_run:
+                continue
+            batch.append(snapshot)
+            if len(batch) == DELETE_BATCH_SIZE:
+                self.__delete(store, batch)
+                batch = []
+        if batch:
+            self.__delete(store, batch)
+        return result
+
+    @retry(wait_exponential_multiplier=100,
+           wait_exponential_max=1000,
+           stop_max_attempt_number=5,
+           retry_on_exception=is_throttled)
+    def __compact_with_retry(self, item_id):
+        # 途中まで削除していても、読み直して残りだけを削除する
+        return self.compact_item(item_id)
+
+    def __compact_or_error(self, item_id):
+        # 1 itemの失敗でjob全体を止めない
+        try:
+            return self.__compact_with_retry(item_id)
+        except Exception as e:
+            logger.warning('compaction: {} {}: {}'.format(
+                item_id, type(e).__name__, e))
+            return e
+
+    def __delete(self, store, snapshots):
+        self.__throttle.wait()
+        try:
+            store.delete(snapshots)
+        except Throttled:
+            self.__throttle.throttled()
+            raise
+        self.__throttle.succeeded()
+
+    def __item_ids(self, item_ids, cursor):
+        if item_ids is None:
+            return ItemIndex().iter_item_ids(cursor)
+        if cursor is not None and cursor in item_ids:
+            return iter(item_ids[item_ids.index(cursor) + 1:])
+        return iter(item_ids)
+
+    def __chunks(self, item_ids):
+        # chunkごとにcursorを進める (並行処理中のitemを飛ばさない)
+        size = self.concurrency * 4
+        while True:
+            chunk = list(itertools.islice(item_ids, size))
+            if not chunk:
+                return
+            yield chunk
+
+    @staticmethod
+    def __add_result(report, item_id, result):
+        report['items'] += 1
+        if isinstance(result, Exception):
+            report['failed'].append(
+                {'item_id': item_id, 'error': type(result).__name__})
+            return
+        for key in ('snapshots', 'expired', 'reclaimed_bytes'):
+            report[key] += result[key]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from contextlib import contextmanager
+from botocore.exceptions import ClientError
+from pynamodb.exceptions import PynamoDBException
+import logging
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+THROTTLING_ERROR_CODES = (
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+)
+
+
+class Throttled(Exception):
+    """SDKのretryを使い切ってもthrottlingされた"""
+    pass
+
+
+def is_throttling_error(e):
+    """ProvisionedThroughputExceededException などか"""
+    cause = getattr(e, 'cause', e)
+    if isinstance(cause, ClientError):
+        code = cause.response['Error'].get('Code')
+        return code in THROTTLING_ERROR_CODES
+    return False
+
+
+def is_throttled(e):
+    return isinstance(e, Throttled)
+
+
+@contextmanager
+def raise_for_throttling(item_id=None):
+    try:
+        yield
+    except (PynamoDBException, ClientError) as e:
+        if is_throttling_error(e):
+            message = 'Throttled: id={}: {}'.format(item_id, e)
+            logger.warning(message)
+            raise Throttled(message)
+        raise e
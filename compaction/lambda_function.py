@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+from compaction import Compaction
+from escqrs.startup import startup
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# 時間内に終わらなかった場合、cursorを付けて自分を非同期で呼び直す
+REINVOKE = os.environ.get('COMPACTION_REINVOKE', 'true').lower() == 'true'
+DRY_RUN = os.environ.get('COMPACTION_DRY_RUN', 'false').lower() == 'true'
+
+lmbd = None
+
+
+def extract_options(event):
+    """
+    {
+        'dry_run': true,             # 削除せずに reclaimed_bytes を報告する
+        'keep_latest': 3,
+        'checkpoint_interval': 1000,
+        'item_ids': ['00000001'],    # 省略時はInventoryViewの全item
+        'cursor': '00000001'         # 前回の続きから
+    }
+    """
+    options = {'dry_run': bool(event.get('dry_run', DRY_RUN))}
+    for key in ('keep_latest', 'checkpoint_interval', 'concurrency'):
+        if event.get(key) is not None:
+            options[key] = int(event[key])
+    return options
+
+
+def reinvoke(context, event):
+    global lmbd
+    if lmbd is None:
+        # reinvokeする時だけ使うのでimportも遅らせる
+        import boto3
+        lmbd = boto3.client('lambda')
+    lmbd.invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps(event))
+
+
+@startup
+def lambda_handler(event, context):
+    event = event or {}
+    logger.info('COMPACTION: {}'.format(event))
+    compaction = Compaction(**extract_options(event))
+    remaining_time_ms = getattr(context, 'get_remaining_time_in_millis', None)
+    report = compaction.run(event.get('item_ids'),
+                            event.get('cursor'),
+                            remaining_time_ms)
+    logger.info('COMPACTION report: {}'.format(json.dumps(report)))
+
+    if not report['done'] and REINVOKE and context is not None:
+        reinvoke(context, dict(event, cursor=report['cursor']))
+    return report
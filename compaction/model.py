@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+from pynamodb.models import Model
+from pynamodb.attributes import (
+    UnicodeAttribute,
+    NumberAttribute,
+    JSONAttribute
+)
+from exception_handler import raise_for_throttling
+from escqrs.storage import get_backend
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+# --------------------------
+# snapshot Table
+# --------------------------
+class SnapshotModel(Model):
+    class Meta:
+        table_name = 'EventStore'
+        region = 'ap-northeast-1'
+        max_retry_attempts = 8
+        base_backoff_ms = 297
+
+    item_id = UnicodeAttribute(hash_key=True)
+    version = NumberAttribute(range_key=True)
+    from_version = NumberAttribute()
+    name = UnicodeAttribute()
+    state = JSONAttribute()
+    saved_at = UnicodeAttribute()
+    order_id = UnicodeAttribute(null=True)
+
+
+snapshot_store = get_backend(SnapshotModel)
+
+
+class SnapshotStore:
+
+    __snapshot_suffix = '-snapshot'
+
+    def __init__(self, item_id):
+        self.__item_id = item_id
+        self.__storage = snapshot_store
+
+    def iter_snapshots(self):
+        """version昇順 page単位で読み、1件ずつyieldする"""
+        with raise_for_throttling(self.item_id):
+            for snapshots in self.__storage.iter_pages(self.item_id):
+                for snapshot in snapshots:
+                    yield snapshot
+
+    def delete(self, snapshots):
+        with raise_for_throttling(self.item_id):
+            self.__storage.batch_delete(snapshots)
+
+    @property
+    def item_id(self):
+        return self.__item_id + self.__snapshot_suffix
+
+
+# --------------------------
+# InventoryView Table
+# --------------------------
+class InventoryViewModel(Model):
+    class Meta:
+        table_name = 'InventoryView'
+        region = 'ap-northeast-1'
+        max_retry_attempts = 8
+        base_backoff_ms = 297
+
+    item_id = UnicodeAttribute(hash_key=True)
+    version = NumberAttribute()
+    name = UnicodeAttribute()
+    state = JSONAttribute()
+    updated_at = UnicodeAttribute()
+
+
+inventory_view_store = get_backend(InventoryViewModel)
+
+
+class ItemIndex:
+    """
+    InventoryViewの1行 = 1 item として、compaction対象のitem_idを列挙する
+    (EventStoreの全eventをscanしない) snapshotはInventoryViewと同じ
+    snapshot Lambdaが書くため、viewの無いitemは通常snapshotも持たない
+    それ以外のitemは item_ids を指定してcompactionする
+    """
+
+    def __init__(self):
+        self.__storage = inventory_view_store
+
+    def iter_item_ids(self, start_after=None):
+        with raise_for_throttling():
+            for item_id in self.__storage.iter_hash_keys(start_after):
+                yield item_id
+
+
+def item_size(item):
+    """DynamoDBのitem sizeの見積もり (attribute名 + 値のbyte数)"""
+    size = 0
+    for name, value in item.items():
+        if value is None:
+            continue
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value, separators=(',', ':'))
+        size += len(name.encode('utf-8')) + len(str(value).encode('utf-8'))
+    return size
@@ -11,3 +11,11 @@ class IntegrityError(Exception):
 
 class ItemRanShort(Exception):
     pass
+
+
+class DuplicateCommand(Exception):
+    """同じevent_idのcommandは受付済み versions: {event_id: version}"""
+
+    def __init__(self, versions):
+        super().__init__(versions)
+        self.versions = versions
@@ -1,14 +1,233 @@
 # -*- coding: utf-8 -*-
+import copy
+import datetime
 import logging
-from functools import reduce
+import os
+import uuid
 from retrying import retry
-from model import EventStore, Snapshot
-from error import ItemRanShort, IntegrityError
-from retry_handler import is_integrity_error, is_not_item_ran_short
+from escqrs.cache import LRUCache
+from escqrs.reconstruct import reconstruct
+from escqrs.sharding import (
+    shard_count, shard_item_id, shard_item_ids, shard_of, is_shard,
+    base_item_id)
+from model import EventStore, Snapshot, IdempotencyKey, IDEMPOTENCY
+from error import ItemRanShort, IntegrityError, DuplicateCommand
+from retry_handler import (
+    is_integrity_error, is_not_item_ran_short, MAX_ATTEMPTS)
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# warm containerで使い回す item_id -> (state, version) のaggregate cache
+# 古いcacheは条件付き書き込みのIntegrityErrorで検出する
+aggregate_cache = LRUCache(
+    maxsize=int(os.environ.get('AGGREGATE_CACHE_SIZE', '1024')),
+    ttl=float(os.environ.get('AGGREGATE_CACHE_TTL', '300')))
+
+
+class Aggregate:
+    """
+    aggregate_cacheを通してitemの最新stateを読み書きする
+    前回の試行で読んだstateとversionも持っておき、IntegrityErrorの後は
+    cacheが無くても (evict / TTL切れ / AGGREGATE_CACHE_SIZE=0)
+    そのversion以降のeventだけを取得する
+    """
+
+    def __init__(self, item_id, event_store, snapshot):
+        self.__item_id = item_id
+        self.__es = event_store
+        self.__ss = snapshot
+        self.__last = None
+        self.needs_catch_up = False
+
+    @property
+    def is_cached(self):
+        return self.__item_id in aggregate_cache
+
+    def get_latest_state(self):
+        """
+        return: (state, current_version, is_fresh)
+        is_fresh: DynamoDBから読み直したstateかどうか
+        """
+        cached = aggregate_cache.get(self.__item_id)
+        if cached is not None and not self.needs_catch_up:
+            state, current_version = copy.deepcopy(cached)
+            return state, current_version, False
+
+        known = self.__latest_known(cached)
+        if known is None:
+            state, current_version = self.__load_state()
+        else:
+            state, current_version = self.__catch_up(*copy.deepcopy(known))
+
+        self.needs_catch_up = False
+        self.__remember(state, current_version)
+        aggregate_cache.put(self.__item_id,
+                            (copy.deepcopy(state), current_version))
+        return state, current_version, True
+
+    def persisted(self, state, current_version):
+        """書き込みに成功した後のstateとversion"""
+        self.__remember(state, current_version)
+        aggregate_cache.put(self.__item_id, (state, current_version))
+
+    def __remember(self, state, current_version):
+        self.__last = (copy.deepcopy(state), current_version)
+
+    def __latest_known(self, cached):
+        """cacheと前回の試行のうち、versionの新しい方 どちらも無ければNone"""
+        known = [entry for entry in (cached, self.__last) if entry is not None]
+        if not known:
+            return None
+        return max(known, key=lambda entry: entry[1])
+
+    def __load_state(self):
+        # snapshotとevent tailを並行に取得する
+        _, state, current_version = reconstruct(
+            self.__item_id, self.__ss, self.__es)
+        return state, current_version
+
+    def __catch_up(self, state, current_version):
+        state, last_version = self.__ss.fold_rows(
+            state, self.__es.iter_replay_rows(current_version))
+        if last_version is not None:
+            current_version = last_version
+        return state, current_version
+
+
+def route(event):
+    """
+    sharded itemのcommandのitem_idを <item_id>#<shard> に書き換える
+    order_id (無ければevent_id) から決まるshardを使う
+    reserveはそのshardから順に、aggregate_cacheで在庫が足りているshardを選ぶ
+    (COMMAND_MODE=queue ではcommandを送るだけでaggregate_cacheが無いため、
+    常にorder_idのshardになる 在庫不足はconsumerが在庫移動で補う)
+    """
+    item_id = event['item_id']
+    count = shard_count(item_id)
+    if not count:
+        return event
+    first = shard_of(item_id, event.get('order_id') or event['event_id'])
+    shard = first
+    if event['event_type'].lower().split('_')[-1] == 'reserve':
+        for offset in range(count):
+            cached = aggregate_cache.get(
+                shard_item_id(item_id, (first + offset) % count))
+            if cached and cached[0]['available'] >= event['quantity']:
+                shard = (first + offset) % count
+                break
+    event['item_id'] = shard_item_id(item_id, shard)
+    return event
+
+
+def plan_transfer(needed, target_available, sources):
+    """
+    sources: [(key, available)]
+    return: [(key, quantity)] 全shardを合わせても足りなければNone
+    在庫の最も多いshardからは、不足分か、移動先との差の半分の多い方を移す
+    (次のreserveでまた移動しなくて済むように)
+    """
+    sources = sorted([source for source in sources if source[1] > 0],
+                     key=lambda source: source[1], reverse=True)
+    if sum(available for _, available in sources) < needed:
+        return None
+    plan = []
+    for index, (key, available) in enumerate(sources):
+        if needed <= 0:
+            break
+        quantity = min(available, needed)
+        if index == 0:
+            quantity = min(available,
+                           max(needed, (available - target_available) // 2))
+        plan.append((key, quantity))
+        needed -= quantity
+    return plan
+
+
+class ShardRebalancer:
+    """
+    予約先shardの在庫が足りない場合に、同じitemの他のshardとbase itemから
+    在庫を移す
+    移動元ごとの rebalance_withdraw と移動先の rebalance_add を1 transactionで
+    書き込むため、途中でどれかのshardのversionが進んでいれば全体が
+    IntegrityError になる
+    """
+
+    def __init__(self, event, event_store, snapshot, aggregate):
+        self.__event = event
+        self.__es = event_store
+        self.__ss = snapshot
+        self.__aggregate = aggregate
+
+    def fill(self, state, current_version):
+        """
+        予約先shardの在庫をquantityまで補う
+        return: 移動後の (state, current_version) 他のshardにも無ければNone
+        """
+        sources = self.__load_sources()
+        plan = plan_transfer(
+            self.__event['quantity'] - state['available'],
+            state['available'],
+            [(item_id, source[1]['available'])
+             for item_id, source in sources.items()])
+        if plan is None:
+            return None
+
+        events = []
+        for item_id, quantity in plan:
+            events.append(self.__transfer_event(
+                item_id, sources[item_id][2], 'rebalance_withdraw', quantity))
+        events.append(self.__transfer_event(
+            self.__event['item_id'], current_version, 'rebalance_add',
+            sum(quantity for _, quantity in plan)))
+        try:
+            self.__es.persist_transfer(events)
+        except IntegrityError as e:
+            self.__aggregate.needs_catch_up = True
+            raise e
+        logger.info('rebalanced: {}'.format(
+            [(event['item_id'], event['quantity']) for event in events]))
+
+        for event in events[:-1]:
+            aggregate, source_state, _ = sources[event['item_id']]
+            aggregate.persisted(
+                self.__ss.calculate_state(source_state, event),
+                event['version'])
+        state = self.__ss.calculate_state(state, events[-1])
+        self.__aggregate.persisted(copy.deepcopy(state), current_version + 1)
+        return state, current_version + 1
+
+    def __load_sources(self):
+        """
+        予約先以外のshardとbase item -> (aggregate, state, version)
+        base itemにはshardする前の在庫が残っている
+        """
+        sources = {}
+        for item_id in shard_item_ids(base_item_id(self.__event['item_id']),
+                                      include_base=True):
+            if item_id == self.__event['item_id']:
+                continue
+            event = dict(self.__event, item_id=item_id)
+            aggregate = Aggregate(item_id, EventStore(event), Snapshot(event))
+            # 移動元のcacheが古いとtransactionが失敗するため追いついておく
+            aggregate.needs_catch_up = True
+            state, version, _ = aggregate.get_latest_state()
+            sources[item_id] = (aggregate, state, version)
+        return sources
+
+    def __transfer_event(self, item_id, current_version, event_type,
+                         quantity):
+        return {
+            'item_id': item_id,
+            'version': current_version + 1,
+            'event_id': str(uuid.uuid4()),
+            'event_type': event_type,
+            'name': self.__event['name'],
+            'quantity': quantity,
+            'fired_at': str(datetime.datetime.utcnow()),
+            'order_id': self.__event.get('order_id'),
+        }
+
 
 class EventHandler:
 
@@ -16,8 +235,14 @@ class EventHandler:
         self.__event = event
         self.__es = EventStore(event)
         self.__ss = Snapshot(event)
+        self.__aggregate = Aggregate(event['item_id'], self.__es, self.__ss)
 
     def apply(self):
+        if IDEMPOTENCY:
+            # 受付済みのcommandの再送は、元のversionを返す
+            version = IdempotencyKey(self.__event).get_accepted_version()
+            if version is not None:
+                raise DuplicateCommand({self.__event['event_id']: version})
         handler = getattr(self, '_{}'.format(self.event_type), None)
         if handler:
             return handler()
@@ -37,33 +262,59 @@ class EventHandler:
 
     @retry(wait_exponential_multiplier=100,
            wait_exponential_max=1000,
+           stop_max_attempt_number=MAX_ATTEMPTS,
            retry_on_exception=is_integrity_error)
     def __persist_with_optimistic_lock(self):
+        if self.__aggregate.is_cached:
+            state, current_version, _ = self.__aggregate.get_latest_state()
+            self.__persist(state, current_version)
+            return
         latest_event = self.__es.get_latest_event()
         self.__es.persist(latest_event['version'])
 
     @retry(wait_exponential_multiplier=100,
            wait_exponential_max=1000,
+           stop_max_attempt_number=MAX_ATTEMPTS,
            retry_on_exception=is_not_item_ran_short)
     def __persist_with_check_stock(self):
-        state, current_version = self.__get_latest_state()
+        state, current_version, is_fresh = \
+            self.__aggregate.get_latest_state()
+        if not self.__is_item_available(state) and not is_fresh:
+            # 古いcacheで在庫不足と判定している可能性があるため追いつく
+            self.__aggregate.needs_catch_up = True
+            state, current_version, _ = self.__aggregate.get_latest_state()
+
         if self.__is_item_available(state):
+            self.__persist(state, current_version)
+            return
+        self.__raise_if_accepted()
+        if is_shard(self.item_id):
+            # 他のshardから在庫を移してから予約する
+            rebalanced = ShardRebalancer(
+                self.__event, self.__es, self.__ss, self.__aggregate).fill(
+                    state, current_version)
+            if rebalanced is not None:
+                self.__persist(*rebalanced)
+                return
+        raise ItemRanShort
+
+    def __raise_if_accepted(self):
+        # 受付済みのreserveの再送を、その後の在庫で在庫不足と判定しない
+        if not IDEMPOTENCY:
+            return
+        version = IdempotencyKey(self.__event).find_accepted_version()
+        if version is not None:
+            raise DuplicateCommand({self.__event['event_id']: version})
+
+    def __persist(self, state, current_version):
+        try:
             self.__es.persist(current_version)
-        else:
-            raise ItemRanShort
-
-    def __get_latest_state(self):
-        snapshot = self.__ss.get_snapshot()
-        events = self.__es.get_events_from(snapshot['from_version'])
-
-        if len(events):
-            state = reduce(self.__ss.calculate_state,
-                           events,
-                           self.__ss.get_state(snapshot))
-            current_version = events[-1]['version']
-            return state, current_version
-        else:
-            return snapshot['state'], snapshot['from_version']
+        except IntegrityError as e:
+            # cacheが古い → 次の試行でcached version以降を取得する
+            self.__aggregate.needs_catch_up = True
+            raise e
+        state = self.__ss.calculate_state(state, self.__event)
+        self.__aggregate.persisted(state, current_version + 1)
 
     def __is_item_available(self, state):
         if state['available'] >= self.__event['quantity']:
@@ -71,6 +322,14 @@ class EventHandler:
         else:
             return False
 
+    @property
+    def is_supported(self):
+        return hasattr(self, '_{}'.format(self.event_type))
+
+    @property
+    def item_id(self):
+        return self.__event['item_id']
+
     @property
     def event_type(self):
         keys = self.__event['event_type'].lower().split('_')
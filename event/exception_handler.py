@@ -5,6 +5,7 @@ from pynamodb.exceptions import (
     PutError,
     QueryError)
 import logging
+from escqrs.storage import ConditionalCheckFailed
 from error import ItemDoesNotExist, IntegrityError
 
 
@@ -25,6 +26,10 @@ def is_conditional_check_failed(e):
 def raise_for_save_exception(event_id=None):
     try:
         yield
+    except ConditionalCheckFailed:
+        message = 'ConditionalCheckFailedException: id={}'.format(event_id)
+        logger.warning(message)
+        raise IntegrityError
     except PutError as e:
         if is_conditional_check_failed(e):
             message = 'ConditionalCheckFailedException: id={}'.format(event_id)
@@ -34,6 +39,7 @@ def raise_for_save_exception(event_id=None):
         else:
             message = 'PutError: {}'.format(e)
             logger.exception(message)
+            raise e
 
 
 @contextmanager
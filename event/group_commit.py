@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import copy
+import logging
+from retrying import retry
+from model import EventStore, Snapshot, IdempotencyKey, IDEMPOTENCY
+from error import IntegrityError, DuplicateCommand
+from event_handler import Aggregate
+from retry_handler import is_integrity_error, MAX_ATTEMPTS
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+ACCEPTED = 'accepted'
+RAN_SHORT = 'ran_short'
+IGNORED = 'ignored'
+
+
+class GroupCommit:
+    """
+    同じitem_idのcommandを1つのin-memory stateで順に検証し、
+    受け付けたcommandを連続したversionとして1 transactionで書き込む
+    結果はcommandごとに ACCEPTED / RAN_SHORT / IGNORED
+    途中のchunkを書き込んだ後に失敗した場合も確定した結果は返し、
+    未確定のcommandは None にする
+    """
+
+    __event_types = ('add', 'reserve', 'complete', 'cancel')
+
+    def __init__(self, events):
+        """events: 同一item_idのcommand list (到着順)"""
+        self.__events = events
+        self.__es = EventStore(events[0])
+        self.__ss = Snapshot(events[0])
+        self.__aggregate = Aggregate(events[0]['item_id'],
+                                     self.__es, self.__ss)
+        self.__outcomes = [None] * len(events)
+        # batch内で同じevent_idが再送されたcommand index -> 最初のindex
+        self.__followers = {}
+
+    def apply(self):
+        if IDEMPOTENCY:
+            self.__resolve_duplicates()
+        try:
+            self.__commit()
+        except Exception as e:
+            logger.exception('GroupCommit Exception: {}'.format(e))
+        for index, first in self.__followers.items():
+            if self.__outcomes[first] is not None:
+                self.__accept_as(index, self.__outcomes[first],
+                                 self.__events[first].get('version'))
+        return self.__outcomes
+
+    def __resolve_duplicates(self):
+        first_indexes = {}
+        for index, event in enumerate(self.__events):
+            first = first_indexes.setdefault(event['event_id'], index)
+            if first != index:
+                self.__followers[index] = first
+                continue
+            version = IdempotencyKey(event).get_accepted_version()
+            if version is not None:
+                self.__accept_as(index, ACCEPTED, version)
+
+    @retry(wait_exponential_multiplier=100,
+           wait_exponential_max=1000,
+           stop_max_attempt_number=MAX_ATTEMPTS,
+           retry_on_exception=is_integrity_error)
+    def __commit(self):
+        # 前回の試行で確定したcommandはそのまま、未確定分を検証し直す
+        state, current_version = self.__get_latest_state()
+        accepted, decided = [], []
+        for index in self.__pending():
+            event = self.__events[index]
+            if self.__is_acceptable(state, event):
+                state = self.__ss.calculate_state(state, event)
+                accepted.append(index)
+            decided.append(index)
+            if len(accepted) == self.__es.max_transaction_items:
+                current_version = self.__persist(
+                    accepted, decided, state, current_version)
+                accepted, decided = [], []
+        if decided:
+            self.__persist(accepted, decided, state, current_version)
+
+    def __persist(self, accepted, decided, state, current_version):
+        if accepted:
+            try:
+                self.__es.persist_all(
+                    [self.__events[index] for index in accepted],
+                    current_version)
+            except IntegrityError as e:
+                self.__aggregate.needs_catch_up = True
+                raise e
+            except DuplicateCommand as e:
+                # 受付済みのcommandを確定させ、残りを検証し直す
+                self.__aggregate.needs_catch_up = True
+                for index in accepted:
+                    event_id = self.__events[index]['event_id']
+                    if event_id in e.versions:
+                        self.__accept_as(index, ACCEPTED,
+                                         e.versions[event_id])
+                raise IntegrityError(e)
+            current_version += len(accepted)
+            self.__aggregate.persisted(copy.deepcopy(state), current_version)
+
+        for index in decided:
+            self.__outcomes[index] = self.__outcome(index, accepted)
+        return current_version
+
+    def __accept_as(self, index, outcome, version):
+        self.__outcomes[index] = outcome
+        if outcome == ACCEPTED:
+            self.__events[index]['version'] = version
+
+    def __get_latest_state(self):
+        state, current_version, is_fresh = \
+            self.__aggregate.get_latest_state()
+        if not is_fresh and self.__has_ran_short(copy.deepcopy(state)):
+            # 古いcacheで在庫不足と判定している可能性があるため追いつく
+            self.__aggregate.needs_catch_up = True
+            state, current_version, _ = self.__aggregate.get_latest_state()
+        return state, current_version
+
+    def __has_ran_short(self, state):
+        for index in self.__pending():
+            event = self.__events[index]
+            if self.__event_type(event) == 'reserve' and \
+                    not self.__is_acceptable(state, event):
+                return True
+            if self.__is_acceptable(state, event):
+                state = self.__ss.calculate_state(state, event)
+        return False
+
+    def __pending(self):
+        return [index for index, outcome in enumerate(self.__outcomes)
+                if outcome is None and index not in self.__followers]
+
+    def __is_acceptable(self, state, event):
+        event_type = self.__event_type(event)
+        if event_type not in self.__event_types:
+            return False
+        if event_type == 'reserve':
+            return state['available'] >= event['quantity']
+        return True
+
+    def __outcome(self, index, accepted):
+        if index in accepted:
+            return ACCEPTED
+        event = self.__events[index]
+        if self.__event_type(event) not in self.__event_types:
+            return IGNORED
+        if IDEMPOTENCY:
+            # 受付済みのreserveの再送を、その後の在庫で在庫不足と判定しない
+            version = IdempotencyKey(event).find_accepted_version()
+            if version is not None:
+                event['version'] = version
+                return ACCEPTED
+        return RAN_SHORT
+
+    @staticmethod
+    def __event_type(event):
+        return event['event_type'].lower().split('_')[-1]
@@ -1,15 +1,46 @@
 # -*- coding: utf-8 -*-
+import json
 import logging
-from error import ItemRanShort
-from event_handler import EventHandler
-from aws_xray_sdk.core import patch_all
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from error import ItemRanShort, DuplicateCommand
+from event_handler import EventHandler, route
+from group_commit import GroupCommit, ACCEPTED, RAN_SHORT, IGNORED
+from escqrs.command_queue import get_queue, to_message
+from escqrs.sharding import is_shard, base_item_id
+from escqrs.startup import startup
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-patch_all()
+
+# 1回のinvocationで届いた同じitemのcommandをまとめて書き込む (opt-in)
+# template.ymlのEventFunctionで有効にしている
+GROUP_COMMIT = os.environ.get('GROUP_COMMIT', 'false').lower() == 'true'
+# batchのitem_idごとのpartitionを並行に処理する数
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '8'))
+
+# optimistic : commandをこのLambdaで適用する (default)
+# queue      : item_idをmessage groupとしてcommand queueに送り、
+#              queue_handler (groupごとに1つのconsumer) が適用する
+COMMAND_MODE = os.environ.get('COMMAND_MODE', 'optimistic')
+
+INVALID = 'invalid'
+ERROR = 'error'
+QUEUED = 'queued'
+
+command_queue = None
+
+REQUIRED_KEYS = ('item_id', 'event_id', 'event_type', 'name', 'quantity')
 
 
 def extract_event(event):
+    """
+    1件のcommand (dict)
+    または batch: [command, ...] / {'commands': [command, ...]}
+    """
+    if isinstance(event, dict) and 'commands' in event:
+        return list(event['commands'])
     return event
 
 
@@ -24,9 +55,17 @@ def publish(event):
 
 def event_controller(event):
     try:
-        handler = EventHandler(event)
+        handler = EventHandler(route(event))
+        if not handler.is_supported:
+            # 未知のevent_typeはGroupCommitと同じく書き込まない
+            return IGNORED
         handler.apply()
-        return None
+        return ACCEPTED
+    except DuplicateCommand as e:
+        # 再送されたcommand 書き込まずに元の結果を返す
+        event['version'] = e.versions[event['event_id']]
+        logger.info('duplicate command: {}'.format(e.versions))
+        return ACCEPTED
     except ItemRanShort as e:
         """
         AWS Stepfunctionsの場合、CustomErrorをraiseする
@@ -35,14 +74,155 @@ def event_controller(event):
         AWS AppSyncなどでErrorをpublish()するなど
         """
         publish(event)
-        return None
+        return RAN_SHORT
     except Exception as e:
         logger.exception('Event Save Exception: {}'.format(e))
         raise e
 
 
+def is_valid_command(event):
+    return isinstance(event, dict) and \
+        all(key in event for key in REQUIRED_KEYS)
+
+
+def group_by_item(events):
+    item_events = OrderedDict()
+    for event in events:
+        item_events.setdefault(event['item_id'], []).append(event)
+    return item_events
+
+
+def command_controller(event):
+    """失敗したcommandだけをERRORにする (event_controllerでlog済み)"""
+    try:
+        return event_controller(event)
+    except Exception:
+        return ERROR
+
+
+def partition_controller(item_events):
+    """
+    同じitem_idのcommandを順に処理し、commandごとの結果を返す
+    失敗したcommand以降は処理せずERRORにし、それまでに書き込んだcommandの
+    結果は返す (queue_handlerは失敗以降のmessageを再配信させる)
+    """
+    if GROUP_COMMIT:
+        outcomes = GroupCommit(item_events).apply()
+        for index, (event, outcome) in enumerate(zip(item_events, outcomes)):
+            if outcome is None:
+                # 書き込めなかったcommand
+                outcomes[index] = ERROR
+            elif outcome != RAN_SHORT:
+                continue
+            elif is_shard(event['item_id']):
+                # shardの在庫不足は他のshardから在庫を移してやり直す
+                outcomes[index] = command_controller(event)
+            else:
+                publish(event)
+        return outcomes
+    outcomes = []
+    for event in item_events:
+        outcomes.append(ERROR if ERROR in outcomes
+                        else command_controller(event))
+    return outcomes
+
+
+def batch_controller(events):
+    """
+    itemごとのpartitionを並行に処理する
+    partition内のstock checkは順番に行い、1つのpartitionの失敗は
+    そのpartitionの未確定のcommandだけをERRORにする
+    """
+    results = dict()
+    valid_events = [route(e) for e in events if is_valid_command(e)]
+    partitions = list(group_by_item(valid_events).values())
+
+    def process(item_events):
+        try:
+            return partition_controller(item_events)
+        except Exception as e:
+            logger.exception('Event Save Exception: {}'.format(e))
+            return [ERROR] * len(item_events)
+
+    if partitions:
+        workers = max(1, min(BATCH_CONCURRENCY, len(partitions)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for item_events, outcomes in zip(
+                    partitions, executor.map(process, partitions)):
+                for event, outcome in zip(item_events, outcomes):
+                    results[id(event)] = outcome
+
+    return [outcome_of(index, event, results.get(id(event), INVALID))
+            for index, event in enumerate(events)]
+
+
+def get_command_queue():
+    global command_queue
+    if command_queue is None:
+        command_queue = get_queue(consumer=queue_handler)
+    return command_queue
+
+
+def enqueue_controller(events):
+    """
+    commandをitem_id (shardされたitemはshard) ごとのmessage groupに送る
+    同じgroupのcommandは送った順に適用される
+    """
+    valid_events = [route(e) for e in events if is_valid_command(e)]
+    get_command_queue().send([to_message(e) for e in valid_events])
+    queued = {id(e) for e in valid_events}
+    return [outcome_of(index, event,
+                       QUEUED if id(event) in queued else INVALID)
+            for index, event in enumerate(events)]
+
+
+def outcome_of(index, event, result):
+    outcome = {'index': index, 'result': result}
+    if isinstance(event, dict):
+        outcome['event_id'] = event.get('event_id')
+        outcome['item_id'] = event.get('item_id')
+        if isinstance(outcome['item_id'], str) and \
+                is_shard(outcome['item_id']):
+            outcome['item_id'] = base_item_id(event['item_id'])
+            outcome['shard'] = event['item_id']
+        if result == ACCEPTED:
+            outcome['version'] = event.get('version')
+    return outcome
+
+
+@startup
 def lambda_handler(event, context):
     event = extract_event(event)
     logger.info('EVENT Inventory: {}'.format(event))
+    if COMMAND_MODE == 'queue':
+        if isinstance(event, list):
+            return enqueue_controller(event)
+        enqueue_controller([event])
+        return
+    if isinstance(event, list):
+        return batch_controller(event)
     event_controller(event)
     return
+
+
+@startup
+def queue_handler(event, context):
+    """
+    command queue (SQS FIFO) のconsumer
+    message groupごとに1つのconsumerしか動かないため、aggregate_cacheのstateが
+    最新で、条件付き書き込みは競合しない
+    失敗したmessageと同じgroupのそれ以降のmessageはbatchItemFailuresで返し、
+    順序を保って再配信させる
+    """
+    records = event['Records']
+    commands = [json.loads(record['body']) for record in records]
+    logger.info('QUEUE Inventory: {} commands'.format(len(commands)))
+    outcomes = batch_controller(commands)
+    failed_groups = set()
+    failures = []
+    for record, outcome in zip(records, outcomes):
+        group_id = record['attributes']['MessageGroupId']
+        if outcome['result'] == ERROR or group_id in failed_groups:
+            failed_groups.add(group_id)
+            failures.append({'itemIdentifier': record['messageId']})
+    return {'batchItemFailures': failures}
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
+import copy
 import datetime
 import logging
+import os
+import time
 from pynamodb.models import Model
 from pynamodb.attributes import (
     UnicodeAttribute,
@@ -8,9 +11,13 @@ from pynamodb.attributes import (
     JSONAttribute
 )
 from exception_handler import (
+    raise_for_save_exception,
     raise_for_query_exception,
     raise_with_no_item_exception)
-from error import ItemDoesNotExist
+from error import ItemDoesNotExist, IntegrityError, DuplicateCommand
+from escqrs.cache import LRUCache
+from escqrs.replay import ReplayEngine, REPLAY_ATTRIBUTES
+from escqrs.storage import get_backend
 
 
 logger = logging.getLogger()
@@ -38,6 +45,9 @@ class EventStoreModel(Model):
     order_id = UnicodeAttribute(null=True)
 
 
+event_store = get_backend(EventStoreModel)
+
+
 class EventStore:
 
     __initial_event = {
@@ -53,12 +63,11 @@ class EventStore:
 
     def __init__(self, event):
         self.__event = event
-        self.__model = EventStoreModel
+        self.__storage = event_store
 
     def get_latest_event(self):
         try:
-            event = self.__query_latest_event()
-            return event.attribute_values
+            return self.__query_latest_event()
         except ItemDoesNotExist:
             return self.__get_initial_event()
 
@@ -66,40 +75,204 @@ class EventStore:
         # 楽観的並行性制御 Optimistic concurrency control
         self.__event['version'] = current_version + 1
         self.__event['saved_at'] = str(datetime.datetime.utcnow())
-        item = self.__model(**self.__event)
-        with raise_with_no_item_exception(self.__event['item_id']):
-            item.save(
-                condition=(self.__model.item_id != self.__event['item_id']) &
-                          (self.__model.version != self.__event['version'])
-            )
-
-    def get_events_from(self, from_version):
+        if not IDEMPOTENCY:
+            with raise_for_save_exception(self.__event['event_id']), \
+                    raise_with_no_item_exception(self.__event['item_id']):
+                self.__storage.append(self.__event)
+            return
+        self.__transact_append([self.__event])
+
+    def persist_all(self, events, current_version):
+        """
+        eventsを current_version + 1 から連続したversionとして
+        1 transactionで書き込む
+        """
+        saved_at = str(datetime.datetime.utcnow())
+        for offset, event in enumerate(events, 1):
+            event['version'] = current_version + offset
+            event['saved_at'] = saved_at
+        if not IDEMPOTENCY:
+            with raise_for_save_exception(events[0]['event_id']), \
+                    raise_with_no_item_exception(self.__event['item_id']):
+                self.__storage.transact_append(events)
+            return
+        self.__transact_append(events)
+
+    def __transact_append(self, events):
+        """
+        eventとevent_idのguard rowを1 transactionで書き込む
+        guard rowは IdempotencyKeyModel のitemとして渡す
+        失敗した場合、guard rowがあれば DuplicateCommand
+        無ければ楽観的ロックの競合として IntegrityError
+        """
+        keys = [IdempotencyKey(event) for event in events]
+        try:
+            with raise_for_save_exception(events[0]['event_id']), \
+                    raise_with_no_item_exception(self.__event['item_id']):
+                self.__storage.transact_append(
+                    events + [(IdempotencyKeyModel, key.guard_item())
+                              for key in keys])
+        except IntegrityError as e:
+            versions = {}
+            for key in keys:
+                version = key.find_accepted_version()
+                if version is not None:
+                    versions[key.event_id] = version
+            if versions:
+                raise DuplicateCommand(versions)
+            raise e
+        for key in keys:
+            key.remember()
+
+    def persist_transfer(self, events):
+        """
+        shard間の在庫移動 (移動元のwithdrawと移動先のadd) を1 transactionで
+        書き込む 各eventは自shardの current_version + 1 への条件付き書き込み
+        """
+        saved_at = str(datetime.datetime.utcnow())
+        for event in events:
+            event['saved_at'] = saved_at
+        with raise_for_save_exception(self.__event['event_id']), \
+                raise_with_no_item_exception(self.__event['item_id']):
+            self.__storage.transact_append(events)
+
+    @property
+    def max_transaction_items(self):
+        # guard rowの分、1 transactionに入れられるevent数は半分になる
+        if IDEMPOTENCY:
+            return self.__storage.max_transaction_items // 2
+        return self.__storage.max_transaction_items
+
+    def get_events_from(self, from_version, to_version=None):
         # 強整合性
         with raise_for_query_exception(self.__event['item_id']):
-            event_list = list()
-            for event in self.__model.query(
+            return self.__storage.query(self.__event['item_id'],
+                                        from_version,
+                                        to_version,
+                                        consistent_read=True)
+
+    def iter_events_from(self, from_version, to_version=None,
+                         page_size=None):
+        # 強整合性 page単位でyieldする
+        with raise_for_query_exception(self.__event['item_id']):
+            for events in self.__storage.iter_pages(self.__event['item_id'],
+                                                    from_version,
+                                                    to_version,
+                                                    page_size,
+                                                    consistent_read=True):
+                yield events
+
+    def iter_replay_rows(self, from_version, to_version=None,
+                         page_size=None):
+        """
+        replayに必要な (version, event_type, quantity) だけを
+        projectionして、tupleのlistをpage単位でyieldする
+        """
+        with raise_for_query_exception(self.__event['item_id']):
+            for rows in self.__storage.iter_projected_pages(
                     self.__event['item_id'],
-                    self.__model.version > from_version,
-                    consistent_read=True,
-                    scan_index_forward=False):
-                event_list.append(event.attribute_values)
-            event_list.reverse()
-            return event_list
+                    REPLAY_ATTRIBUTES,
+                    from_version,
+                    to_version,
+                    page_size,
+                    consistent_read=True):
+                yield rows
+
+    def get_replay_rows(self, from_version, to_version=None):
+        return [row for rows in self.iter_replay_rows(from_version,
+                                                      to_version)
+                for row in rows]
 
     def __query_latest_event(self):
         with raise_for_query_exception(self.__event['item_id']):
-            event = self.__model.query(self.__event['item_id'],
-                                       self.__model.version > 0,
-                                       limit=1,
-                                       scan_index_forward=False).next()
-            return event
+            event = self.__storage.get_latest(self.__event['item_id'])
+        if event is None:
+            raise ItemDoesNotExist(self.__event['item_id'])
+        return event
 
     def __get_initial_event(self):
-        initial_event = self.__initial_event
+        initial_event = copy.deepcopy(self.__initial_event)
         initial_event['item_id'] = self.__event['item_id']
         return initial_event
 
 
+# --------------------------
+# Idempotency Key Model
+# --------------------------
+class IdempotencyKeyModel(Model):
+    class Meta:
+        table_name = 'EventStore'
+        region = 'ap-northeast-1'
+        max_retry_attempts = 8
+        base_backoff_ms = 297
+
+    item_id = UnicodeAttribute(hash_key=True)
+    version = NumberAttribute(range_key=True)
+    event_item_id = UnicodeAttribute()
+    event_version = NumberAttribute()
+    # DynamoDB TTL (epoch秒)
+    expires_at = NumberAttribute()
+
+
+idempotency_key_store = get_backend(IdempotencyKeyModel)
+
+# event_idをidempotency keyとして、eventと同じtransactionでguard rowを書く
+IDEMPOTENCY = os.environ.get('IDEMPOTENCY', 'true').lower() == 'true'
+# clientが再送してくる期間より十分長く
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', str(7 * 86400)))
+
+# 受け付けた event_id -> version (warm containerの再送はDynamoDBを読まない)
+accepted_event_ids = LRUCache(
+    maxsize=int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', '100000')))
+
+
+class IdempotencyKey:
+
+    __item_suffix = '-idempotency'
+
+    def __init__(self, event):
+        self.__event = event
+        self.__storage = idempotency_key_store
+
+    def get_accepted_version(self):
+        """cacheだけを見る 受付済みならversion"""
+        return accepted_event_ids.get(self.event_id)
+
+    def find_accepted_version(self):
+        """cacheに無ければguard rowを読む 受付済みならversion"""
+        version = self.get_accepted_version()
+        if version is not None:
+            return version
+        # guard rowは version 0 (get_latestの範囲外) なのでkeyで読む
+        with raise_for_query_exception(self.event_id):
+            guard = self.__storage.get(self.guard_id, 0,
+                                       consistent_read=True)
+        if guard is None:
+            return None
+        accepted_event_ids.put(self.event_id, guard['event_version'])
+        return guard['event_version']
+
+    def remember(self):
+        accepted_event_ids.put(self.event_id, self.__event['version'])
+
+    def guard_item(self):
+        return {
+            'item_id': self.guard_id,
+            'version': 0,
+            'event_item_id': self.__event['item_id'],
+            'event_version': self.__event['version'],
+            'expires_at': int(time.time()) + IDEMPOTENCY_TTL,
+        }
+
+    @property
+    def event_id(self):
+        return self.__event['event_id']
+
+    @property
+    def guard_id(self):
+        return self.__event['event_id'] + self.__item_suffix
+
+
 # --------------------------
 # Snapshot Model
 # --------------------------
@@ -117,6 +290,11 @@ class SnapshotModel(Model):
     state = JSONAttribute()
     saved_at = UnicodeAttribute()
     order_id = UnicodeAttribute(null=True)
+    # event / query Lambdaが計測したreplayコスト (ms/event)
+    replay_cost_ms = NumberAttribute(null=True)
+
+
+snapshot_store = get_backend(SnapshotModel)
 
 
 class State:
@@ -160,9 +338,14 @@ class State:
         state['reserved'] -= event['quantity']
         return state
 
+    @staticmethod
+    def _on_withdraw(state, event):
+        # shard間の在庫移動の移動元 (移動先は add)
+        state['available'] -= event['quantity']
+        return state
+
     @staticmethod
     def __get_event_type(event):
-        logger.info('_get_event_type: {}'.format(event))
         splited = event['event_type'].lower().split('_')
         return splited[-1]
 
@@ -187,13 +370,13 @@ class Snapshot:
 
     def __init__(self, event):
         self.__event = event
-        self.__model = SnapshotModel
+        self.__storage = snapshot_store
         self.__state = State()
+        self.__replay = ReplayEngine(self.calculate_state)
 
     def get_snapshot(self):
         try:
-            snapshot = self.__get_latest_snapshot()
-            return snapshot.attribute_values
+            return self.__get_latest_snapshot()
         except ItemDoesNotExist:
             logger.warning('No Snapshot')
             return self.__get_initial_snapshot()
@@ -201,21 +384,37 @@ class Snapshot:
     def calculate_state(self, current_state, next_event):
         return self.__state.apply(current_state, next_event)
 
+    def replay_state(self, current_state, events):
+        return self.__replay.replay(current_state, events)
+
+    def fold_events(self, current_state, pages):
+        """return: (state, 最後にfoldしたversion 無ければNone)"""
+        return self.__replay.replay_pages(current_state, pages)
+
+    def fold_rows(self, current_state, pages):
+        """pages: iter_replay_rowsのpage return: fold_eventsと同じ"""
+        return self.__replay.replay_row_pages(current_state, pages)
+
     @staticmethod
     def get_state(snapshot):
         return snapshot['state']
 
+    def record_replay_cost(self, snapshot, cost_ms):
+        """readで計測したreplayコストをsnapshot rowに書く (reconstruct参照)"""
+        self.__storage.set_attributes(
+            self.__event['item_id'] + self.__snapshot_suffix,
+            snapshot['version'], {'replay_cost_ms': cost_ms})
+
     def __get_latest_snapshot(self):
+        snapshot_item_id = self.__event['item_id'] + self.__snapshot_suffix
         with raise_for_query_exception(self.__event['item_id']):
-            snapshot_item_id = self.__event['item_id'] + self.__snapshot_suffix
-            snapshot = self.__model.query(snapshot_item_id,
-                                          self.__model.version > 0,
-                                          limit=1,
-                                          scan_index_forward=False).next()
+            snapshot = self.__storage.get_latest(snapshot_item_id)
+        if snapshot is None:
+            raise ItemDoesNotExist(snapshot_item_id)
         return snapshot
 
     def __get_initial_snapshot(self):
-        initial_snapshot = self.__initial_snapshot
+        initial_snapshot = copy.deepcopy(self.__initial_snapshot)
         initial_snapshot['item_id'] = self.__event[
                                           'item_id'] + self.__snapshot_suffix
         initial_snapshot['name'] = self.__event['name']
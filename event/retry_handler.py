@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
+import os
 from error import ItemRanShort, IntegrityError
 
+# 楽観的ロックの競合で書き込みをやり直す回数の上限
+# 超えた場合は最後のIntegrityErrorをraiseする
+MAX_ATTEMPTS = int(os.environ.get('OPTIMISTIC_LOCK_MAX_ATTEMPTS', '20'))
+
 
 def is_integrity_error(e):
     return isinstance(e, IntegrityError)
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+import bisect
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+"""
+Event Archive
+古いeventをitemごとのsegment fileに移し、DynamoDBを読まずにreplayする
+
+<ARCHIVE_ROOT>/<item_id>/
+    manifest.json                        archived_version とsegment一覧
+    <first:012d>-<last:012d>.seg         segment
+    <first:012d>-<last:012d>.idx         block先頭version -> offset
+
+segment: MAGIC + block*
+    block  = <I 圧縮後の長さ> + zlib(record*)
+    record = <I 長さ> + eventのJSON (utf-8)
+index  : MAGIC + (<Q block先頭version> <Q blockのoffset>)*
+"""
+
+ARCHIVE_ROOT = os.environ.get('ARCHIVE_ROOT')
+# 1 blockにまとめるevent数 (圧縮率とrandom accessの粒度)
+BLOCK_EVENTS = int(os.environ.get('ARCHIVE_BLOCK_EVENTS', '512'))
+
+SEGMENT_MAGIC = b'ESEG\x01'
+INDEX_MAGIC = b'EIDX\x01'
+LENGTH = struct.Struct('<I')
+INDEX_ENTRY = struct.Struct('<QQ')
+
+
+def open_temp(directory, prefix, mode='wb'):
+    """
+    renameする前の一時file
+    同じdirectory (EFS) に並行に書く他のinvocationと名前が衝突しないようにする
+    """
+    f = tempfile.NamedTemporaryFile(mode=mode, dir=directory, prefix=prefix,
+                                    suffix='.tmp', delete=False)
+    # mkstempは0600で作るため、query Lambdaからも読めるようにする
+    os.chmod(f.name, 0o644)
+    return f
+
+
+class SegmentWriter:
+    """version昇順のeventを1 segmentに書き込む"""
+
+    def __init__(self, directory, block_events=BLOCK_EVENTS):
+        self.__directory = directory
+        self.__block_events = block_events
+        self.__block = []
+        self.__index = []
+        self.__file = open_temp(directory, 'segment-')
+        self.__tmp_path = self.__file.name
+        self.__file.write(SEGMENT_MAGIC)
+        self.first_version = None
+        self.last_version = None
+        self.count = 0
+        self.bytes = 0
+
+    def write(self, events):
+        for event in events:
+            if self.last_version is not None and \
+                    event['version'] <= self.last_version:
+                raise ValueError('events must be in ascending version order')
+            if self.first_version is None:
+                self.first_version = event['version']
+            self.last_version = event['version']
+            self.__block.append(event)
+            self.count += 1
+            if len(self.__block) >= self.__block_events:
+                self.__flush_block()
+
+    def close(self):
+        """return: segment名 (eventが無ければNone)"""
+        self.__flush_block()
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        self.__file.close()
+        if self.count == 0:
+            os.remove(self.__tmp_path)
+            return None
+
+        name = segment_name(self.first_version, self.last_version)
+        with open_temp(self.__directory, name + '.idx-') as f:
+            f.write(INDEX_MAGIC)
+            for entry in self.__index:
+                f.write(INDEX_ENTRY.pack(*entry))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f.name, os.path.join(self.__directory, name + '.idx'))
+        os.replace(self.__tmp_path,
+                   os.path.join(self.__directory, name + '.seg'))
+        return name
+
+    def __flush_block(self):
+        if not self.__block:
+            return
+        records = bytearray()
+        for event in self.__block:
+            record = json.dumps(event, separators=(',', ':')).encode('utf-8')
+            records += LENGTH.pack(len(record)) + record
+        compressed = zlib.compress(bytes(records))
+        self.__index.append((self.__block[0]['version'], self.__file.tell()))
+        self.__file.write(LENGTH.pack(len(compressed)) + compressed)
+        self.bytes += LENGTH.size + len(compressed)
+        self.__block = []
+
+
+class SegmentReader:
+    """segmentをmemory-mapし、必要なblockだけを展開して読む"""
+
+    def __init__(self, path):
+        with open(path + '.idx', 'rb') as f:
+            data = f.read()
+        if not data.startswith(INDEX_MAGIC):
+            raise ValueError('not an archive index: {}'.format(path))
+        entries = [INDEX_ENTRY.unpack_from(data, offset) for offset in
+                   range(len(INDEX_MAGIC), len(data), INDEX_ENTRY.size)]
+        self.__versions = [version for version, _ in entries]
+        self.__offsets = [offset for _, offset in entries]
+        self.__path = path + '.seg'
+
+    def iter_pages(self, from_version=0, to_version=None):
+        """from_version < version <= to_version のeventをblock単位でyieldする"""
+        with open(self.__path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as segment:
+            if segment[:len(SEGMENT_MAGIC)] != SEGMENT_MAGIC:
+                raise ValueError('not an archive segment: {}'.format(
+                    self.__path))
+            start = max(0, bisect.bisect_right(self.__versions,
+                                               from_version + 1) - 1)
+            for block in range(start, len(self.__offsets)):
+                if to_version is not None and \
+                        self.__versions[block] > to_version:
+                    return
+                events = [event for event in self.__read_block(segment, block)
+                          if event['version'] > from_version and
+                          (to_version is None or
+                           event['version'] <= to_version)]
+                if events:
+                    yield events
+
+    def __read_block(self, segment, block):
+        offset = self.__offsets[block]
+        length, = LENGTH.unpack_from(segment, offset)
+        start = offset + LENGTH.size
+        records = zlib.decompress(segment[start:start + length])
+        events = []
+        position = 0
+        while position < len(records):
+            size, = LENGTH.unpack_from(records, position)
+            position += LENGTH.size
+            events.append(json.loads(
+                records[position:position + size].decode('utf-8')))
+            position += size
+        return events
+
+
+class Archive:
+
+    def __init__(self, root):
+        self.root = root
+        self.__lock = threading.Lock()
+
+    def archived_version(self, item_id):
+        """archiveに移したversionの上限 (0 = 未archive)"""
+        return self.manifest(item_id)['archived_version']
+
+    def manifest(self, item_id):
+        try:
+            with open(self.__manifest_path(item_id)) as f:
+                return json.load(f)
+        except (IOError, OSError):
+            return {'archived_version': 0, 'segments': []}
+
+    def writer(self, item_id):
+        directory = self.__directory(item_id)
+        os.makedirs(directory, exist_ok=True)
+        return SegmentWriter(directory)
+
+    def commit(self, item_id, writer):
+        """
+        書き終えたsegmentをmanifestに追加する
+        manifestを書き換えた後でDynamoDBから削除すること
+        """
+        name = writer.close()
+        if name is None:
+            return None
+        with self.__lock:
+            manifest = self.manifest(item_id)
+            if writer.first_version != manifest['archived_version'] + 1:
+                raise ValueError(
+                    'segment {} does not follow version {}'.format(
+                        name, manifest['archived_version']))
+            manifest['segments'].append(
+                [writer.first_version, writer.last_version, name])
+            manifest['archived_version'] = writer.last_version
+            path = self.__manifest_path(item_id)
+            with open_temp(os.path.dirname(path), 'manifest-',
+                           mode='w') as f:
+                json.dump(manifest, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(f.name, path)
+        return name
+
+    def iter_pages(self, item_id, from_version=0, to_version=None):
+        """archive内の from_version < version <= to_version をpage単位でyieldする"""
+        for first, last, name in self.manifest(item_id)['segments']:
+            if last <= from_version:
+                continue
+            if to_version is not None and first > to_version:
+                return
+            reader = SegmentReader(os.path.join(self.__directory(item_id),
+                                                name))
+            for events in reader.iter_pages(from_version, to_version):
+                yield events
+
+    def __directory(self, item_id):
+        return os.path.join(self.root, item_id)
+
+    def __manifest_path(self, item_id):
+        return os.path.join(self.__directory(item_id), 'manifest.json')
+
+
+def segment_name(first_version, last_version):
+    return '{:012d}-{:012d}'.format(first_version, last_version)
+
+
+def get_archive(root=None):
+    """ARCHIVE_ROOTが無ければNone (archiveを使わない)"""
+    root = root or ARCHIVE_ROOT
+    if not root:
+        return None
+    return Archive(root)
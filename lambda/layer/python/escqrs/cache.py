@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import OrderedDict
+
+"""
+warm container間で保持するin-memory cache
+"""
+
+
+class LRUCache:
+    """件数上限(maxsize)と有効期限(ttl秒)付きのLRU cache"""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.__maxsize = maxsize
+        self.__ttl = ttl
+        self.__items = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.__lock:
+            entry = self.__items.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self.__items[key]
+                return default
+            self.__items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.__maxsize <= 0:
+            return
+        expires_at = None
+        if self.__ttl is not None:
+            expires_at = time.monotonic() + self.__ttl
+        with self.__lock:
+            self.__items[key] = (value, expires_at)
+            self.__items.move_to_end(key)
+            while len(self.__items) > self.__maxsize:
+                self.__items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.__lock:
+            entry = self.__items.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        with self.__lock:
+            self.__items.clear()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.__items)
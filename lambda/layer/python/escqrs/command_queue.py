@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+"""
+item_idごとに順序付けたcommand queue
+
+同じitem_id (message group) のcommandは到着順に、同時に1つのconsumerだけが
+適用するため、楽観的ロックの競合が起きない
+
+COMMAND_QUEUE (環境変数)
+    sqs       : COMMAND_QUEUE_URL のSQS FIFO queue (default)
+                consumerはSQSのevent source mappingで起動されるLambda
+    inprocess : process内でSQS FIFOのmessage groupを模したqueue
+                (load test / benchmark用) consumerをthreadで呼び出す
+"""
+
+logger = logging.getLogger()
+
+# SQS FIFOのMessageDeduplicationIdの有効期間
+DEDUPLICATION_INTERVAL = 300
+# SQSのsend_message_batchの上限
+SEND_BATCH_SIZE = 10
+
+
+class SendFailed(Exception):
+    """queueに送れなかったmessage failed: send_message_batchのFailed"""
+
+    def __init__(self, failed):
+        super().__init__(failed)
+        self.failed = failed
+
+
+class SQSQueue:
+
+    def __init__(self, url):
+        self.__url = url
+        self.__client = None
+
+    def send(self, messages):
+        """messages: [(group_id, deduplication_id, body)]"""
+        if self.__client is None:
+            import boto3
+            self.__client = boto3.client('sqs')
+        for start in range(0, len(messages), SEND_BATCH_SIZE):
+            entries = [{
+                'Id': str(index),
+                'MessageBody': body,
+                'MessageGroupId': group_id,
+                'MessageDeduplicationId': deduplication_id,
+            } for index, (group_id, deduplication_id, body) in enumerate(
+                messages[start:start + SEND_BATCH_SIZE])]
+            response = self.__client.send_message_batch(
+                QueueUrl=self.__url, Entries=entries)
+            if response.get('Failed'):
+                raise SendFailed(response['Failed'])
+
+
+class InProcessQueue:
+    """
+    SQS FIFOのmessage groupを模したqueue
+    groupごとに到着順のbatchを、同時に1つのworkerだけがconsumerに渡す
+    consumer({'Records': [...]}) はSQSのLambda consumerと同じく
+    {'batchItemFailures': [{'itemIdentifier': messageId}]} を返す
+    失敗したmessage以降はgroupの先頭に戻して再配信し、max_receivesを超えた
+    messageはdead_lettersに移す
+    """
+
+    def __init__(self, consumer, batch_size=10, workers=8, max_receives=5):
+        self.__consumer = consumer
+        self.__batch_size = batch_size
+        self.__workers = workers
+        self.__max_receives = max_receives
+        self.__groups = OrderedDict()
+        self.__active = set()
+        self.__condition = threading.Condition()
+        self.__threads = []
+        self.__sequence = 0
+        self.__deduplication = {}
+        self.__sent_at = {}
+        self.__receives = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        # 送信からconsumerが処理を終えるまでの秒数
+        self.latencies = []
+        self.redeliveries = 0
+        self.dead_letters = []
+
+    def send(self, messages):
+        """messages: [(group_id, deduplication_id, body)]"""
+        now = time.perf_counter()
+        with self.__condition:
+            for group_id, deduplication_id, body in messages:
+                if self.__is_duplicate(deduplication_id, now):
+                    continue
+                self.__sequence += 1
+                record = {
+                    'messageId': str(uuid.uuid4()),
+                    'body': body,
+                    'attributes': {
+                        'MessageGroupId': group_id,
+                        'MessageDeduplicationId': deduplication_id,
+                        'SequenceNumber': str(self.__sequence).zfill(20),
+                    },
+                    'eventSource': 'aws:sqs',
+                }
+                self.__sent_at[record['messageId']] = now
+                self.__groups.setdefault(group_id, deque()).append(record)
+            self.__start_workers()
+            self.__condition.notify_all()
+
+    def drain(self):
+        """送信済みのmessageが全て処理されるまで待つ"""
+        with self.__condition:
+            while self.__groups or self.__active:
+                self.__condition.wait()
+
+    def __is_duplicate(self, deduplication_id, now):
+        sent_at = self.__deduplication.get(deduplication_id)
+        if sent_at is not None and now - sent_at < DEDUPLICATION_INTERVAL:
+            return True
+        self.__deduplication[deduplication_id] = now
+        return False
+
+    def __start_workers(self):
+        while len(self.__threads) < self.__workers:
+            thread = threading.Thread(target=self.__work, daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+
+    def __work(self):
+        while True:
+            with self.__condition:
+                group_id = self.__next_group()
+                while group_id is None:
+                    self.__condition.wait()
+                    group_id = self.__next_group()
+                group = self.__groups[group_id]
+                records = [group.popleft() for _ in range(
+                    min(self.__batch_size, len(group)))]
+                self.__active.add(group_id)
+
+            failed = self.__deliver(records)
+
+            with self.__condition:
+                self.__complete(group_id, records, failed)
+                self.__active.discard(group_id)
+                if not self.__groups.get(group_id, True):
+                    del self.__groups[group_id]
+                self.__condition.notify_all()
+
+    def __next_group(self):
+        for group_id, group in self.__groups.items():
+            if group and group_id not in self.__active:
+                # 他のgroupにも順番が回るように末尾へ
+                self.__groups.move_to_end(group_id)
+                return group_id
+        return None
+
+    def __deliver(self, records):
+        for record in records:
+            self.__receives[record['messageId']] = \
+                self.__receives.get(record['messageId'], 0) + 1
+        try:
+            response = self.__consumer({'Records': records}, None) or {}
+        except Exception as e:
+            logger.exception('InProcessQueue consumer: {}'.format(e))
+            return {record['messageId'] for record in records}
+        return {failure['itemIdentifier']
+                for failure in response.get('batchItemFailures', [])}
+
+    def __complete(self, group_id, records, failed):
+        now = time.perf_counter()
+        retry = []
+        for record in records:
+            message_id = record['messageId']
+            if retry or message_id in failed:
+                # FIFO: 失敗したmessage以降は順序を保って再配信する
+                if self.__receives[message_id] >= self.__max_receives:
+                    self.dead_letters.append(record)
+                    self.__forget(message_id)
+                    continue
+                retry.append(record)
+                continue
+            self.latencies.append(now - self.__sent_at[message_id])
+            self.__forget(message_id)
+        if retry:
+            self.redeliveries += len(retry)
+            self.__groups.setdefault(group_id, deque()).extendleft(
+                reversed(retry))
+
+    def __forget(self, message_id):
+        self.__sent_at.pop(message_id, None)
+        self.__receives.pop(message_id, None)
+
+
+def get_queue(consumer=None, kind=None):
+    """consumer: inprocessでmessageを渡すhandler(event, context)"""
+    kind = kind or os.environ.get('COMMAND_QUEUE', 'sqs')
+    if kind == 'sqs':
+        return SQSQueue(os.environ['COMMAND_QUEUE_URL'])
+    if kind == 'inprocess':
+        return InProcessQueue(
+            consumer,
+            batch_size=int(os.environ.get('COMMAND_QUEUE_BATCH_SIZE', '10')),
+            workers=int(os.environ.get('COMMAND_QUEUE_WORKERS', '8')))
+    raise ValueError('unknown COMMAND_QUEUE: {}'.format(kind))
+
+
+def to_message(command):
+    """command -> (group_id, deduplication_id, body)"""
+    return (command['item_id'], command['event_id'],
+            json.dumps(command, default=str))
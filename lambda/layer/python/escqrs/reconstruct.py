@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import itertools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from escqrs.cache import LRUCache
+
+"""
+State Reconstruction
+snapshot + event tail からitemの最新stateを組み立てる (event/query 共通)
+
+hint (前回見たsnapshotのfrom_version) がある場合は、snapshot queryと
+hint以降のtail queryを並行に実行し、結果を突き合わせる
+    snapshot.from_version >= hint : tailのうちsnapshotに含まれる分を捨てる
+    snapshot.from_version <  hint : 間のeventだけを追加で取得する
+hintが無い場合は履歴全体を読まないよう、snapshot -> tail の順に取得する
+
+REPLAY_COST_PUBLISH=true の場合、tailのreplayにかかった event 1件あたりの
+時間を最新snapshot rowの replay_cost_ms に書き込む
+snapshot Lambdaの SNAPSHOT_POLICY=adaptive はこの値で書き込みを判断する
+"""
+
+logger = logging.getLogger()
+
+RECONSTRUCT_CONCURRENCY = int(
+    os.environ.get('RECONSTRUCT_CONCURRENCY', '4'))
+
+REPLAY_COST_PUBLISH = \
+    os.environ.get('REPLAY_COST_PUBLISH', 'false').lower() == 'true'
+# replayしたeventが少ないとsnapshotの読み込みなど固定の時間が大きく出るため
+# この件数以上の場合だけ計測する
+REPLAY_COST_MIN_EVENTS = int(os.environ.get('REPLAY_COST_MIN_EVENTS', '10'))
+# 同じitemのreplay_cost_msを書き込む間隔 (秒) 前回の値との指数移動平均にする
+REPLAY_COST_PUBLISH_INTERVAL = float(
+    os.environ.get('REPLAY_COST_PUBLISH_INTERVAL', '60'))
+REPLAY_COST_SMOOTHING = 0.2
+
+# item_id -> 最後に見たsnapshotのfrom_version
+snapshot_hints = LRUCache(
+    maxsize=int(os.environ.get('SNAPSHOT_HINT_CACHE_SIZE', '4096')))
+
+# replay_cost_msを書き込んだitem_id (REPLAY_COST_PUBLISH_INTERVAL の間は書かない)
+published_replay_costs = LRUCache(maxsize=4096,
+                                  ttl=REPLAY_COST_PUBLISH_INTERVAL)
+
+__executor = None
+__executor_lock = threading.Lock()
+
+
+def get_executor():
+    global __executor
+    with __executor_lock:
+        if __executor is None:
+            __executor = ThreadPoolExecutor(
+                max_workers=RECONSTRUCT_CONCURRENCY)
+        return __executor
+
+
+def reconstruct(item_id, snapshot, event_store, hint=None):
+    """
+    snapshot: get_snapshot() / get_state() / fold_rows() /
+              record_replay_cost() を持つobject
+    event_store: get_replay_rows() / iter_replay_rows() を持つobject
+    return: (snapshot, state, current_version)
+    """
+    if hint is None:
+        hint = snapshot_hints.get(item_id)
+
+    if hint is None:
+        latest_snapshot = snapshot.get_snapshot()
+        from_version = latest_snapshot['from_version']
+        # 初回replayは履歴が長いことがあるのでpage単位でfoldする
+        pages = event_store.iter_replay_rows(from_version)
+    else:
+        tail = get_executor().submit(event_store.get_replay_rows, hint)
+        latest_snapshot = snapshot.get_snapshot()
+        rows = tail.result()
+        from_version = latest_snapshot['from_version']
+        if from_version < hint:
+            pages = itertools.chain(
+                event_store.iter_replay_rows(from_version, hint), [rows])
+        else:
+            pages = [[row for row in rows if row[0] > from_version]]
+
+    snapshot_hints.put(item_id, from_version)
+
+    started = time.time()
+    state, last_version = snapshot.fold_rows(
+        snapshot.get_state(latest_snapshot), pages)
+    current_version = from_version if last_version is None else last_version
+    publish_replay_cost(item_id, snapshot, latest_snapshot,
+                        current_version - from_version, time.time() - started)
+    return latest_snapshot, state, current_version
+
+
+def publish_replay_cost(item_id, snapshot, latest_snapshot, event_count,
+                        elapsed):
+    """
+    tailのreplayコスト (ms/event) をsnapshot rowに書き込む
+    書き込みに失敗してもreadは失敗させない
+    """
+    if not REPLAY_COST_PUBLISH or event_count < REPLAY_COST_MIN_EVENTS:
+        return
+    # snapshot rowがまだ無い (初期snapshot) itemには書かない
+    if not latest_snapshot.get('version') or \
+            item_id in published_replay_costs:
+        return
+    published_replay_costs.put(item_id, True)
+    cost_ms = elapsed * 1000 / event_count
+    previous = latest_snapshot.get('replay_cost_ms')
+    if previous is not None:
+        cost_ms = previous + REPLAY_COST_SMOOTHING * (cost_ms - previous)
+    try:
+        snapshot.record_replay_cost(latest_snapshot, cost_ms)
+    except Exception as e:
+        logger.warning('replay cost: {} {}: {}'.format(
+            item_id, type(e).__name__, e))
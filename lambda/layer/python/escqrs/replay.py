@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import os
+from functools import reduce
+
+"""
+Replay Engine
+event listをまとめてstateに反映する
+
+件数が多い場合はevent_typeごとの増減量をNumPy配列にして1回の集計で
+available/reserved/boughtを求める。少ない場合はState.applyでfoldする。
+numpyはcold startのimport時間を抑えるため、初めてvectorizeする時にimportする。
+"""
+
+VECTORIZE_THRESHOLD = int(os.environ.get('REPLAY_VECTORIZE_THRESHOLD', '256'))
+
+STATE_KEYS = ('available', 'reserved', 'bought')
+
+# replayに必要なattribute projectionしたrowはこの順のtuple
+REPLAY_ATTRIBUTES = ('version', 'event_type', 'quantity')
+
+# event_type(末尾) と (available, reserved, bought) の増減係数
+EVENT_TYPES = ('add', 'reserve', 'complete', 'cancel', 'withdraw')
+STATE_DELTAS = (
+    (1, 0, 0),
+    (-1, 1, 0),
+    (0, -1, 1),
+    (1, -1, 0),
+    (-1, 0, 0),
+)
+
+
+# 未importはFalse、numpyが無い環境ではNone
+_numpy = False
+
+
+def get_numpy():
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy
+        except ImportError:  # numpyが無い環境ではscalarでreplayする
+            numpy = None
+        _numpy = numpy
+    return _numpy
+
+
+class ReplayEngine:
+
+    def __init__(self, apply, threshold=VECTORIZE_THRESHOLD):
+        """apply: scalar fallback (State.apply)"""
+        self.__apply = apply
+        self.__threshold = threshold
+        self.__type_codes = {}
+        self.__deltas = None
+
+    def replay(self, current_state, events):
+        if len(events) < self.__threshold or get_numpy() is None:
+            return self.replay_scalar(current_state, events)
+        deltas = self.__sum_deltas(
+            [event['event_type'] for event in events],
+            [event['quantity'] for event in events])
+        if deltas is None:
+            return self.replay_scalar(current_state, events)
+        return self.__add_deltas(current_state, deltas)
+
+    def replay_rows(self, current_state, rows):
+        """rows: REPLAY_ATTRIBUTES順のtuple list"""
+        if len(rows) >= self.__threshold and get_numpy() is not None:
+            _, event_types, quantities = zip(*rows)
+            deltas = self.__sum_deltas(event_types, quantities)
+            if deltas is not None:
+                return self.__add_deltas(current_state, deltas)
+        return self.replay_scalar(
+            current_state,
+            (dict(zip(REPLAY_ATTRIBUTES, row)) for row in rows))
+
+    def replay_row_pages(self, current_state, pages):
+        """replay_pagesのtuple版 return: (state, 最後のversion 無ければNone)"""
+        last_version = None
+        for rows in pages:
+            if not rows:
+                continue
+            current_state = self.replay_rows(current_state, rows)
+            last_version = rows[-1][0]
+        return current_state, last_version
+
+    def replay_pages(self, current_state, pages):
+        """
+        pages: version昇順のevent listを順にyieldするiterable
+        pageが届くたびにfoldし、読み終えたpageは保持しない
+        return: (state, 最後にfoldしたversion 無ければNone)
+        """
+        last_version = None
+        for events in pages:
+            if not events:
+                continue
+            current_state = self.replay(current_state, events)
+            last_version = events[-1]['version']
+        return current_state, last_version
+
+    def replay_scalar(self, current_state, events):
+        return reduce(self.__apply, events, current_state)
+
+    def __sum_deltas(self, event_types, quantities):
+        np = get_numpy()
+        try:
+            codes = np.fromiter(
+                (self.__type_code(event_type) for event_type in event_types),
+                dtype=np.intp, count=len(event_types))
+        except KeyError:
+            # 未知のevent_typeはState.applyと同じ扱いにする
+            return None
+        quantities = np.array(quantities)
+        if quantities.dtype.kind not in 'iu':
+            return None
+        return (self.deltas[codes] * quantities[:, None]).sum(axis=0)
+
+    @staticmethod
+    def __add_deltas(current_state, deltas):
+        for key, delta in zip(STATE_KEYS, deltas):
+            current_state[key] += int(delta)
+        return current_state
+
+    def __type_code(self, event_type):
+        code = self.__type_codes.get(event_type)
+        if code is None:
+            try:
+                code = EVENT_TYPES.index(event_type.lower().split('_')[-1])
+            except ValueError:
+                raise KeyError(event_type)
+            self.__type_codes[event_type] = code
+        return code
+
+    @property
+    def deltas(self):
+        if self.__deltas is None:
+            np = get_numpy()
+            self.__deltas = np.array(STATE_DELTAS, dtype=np.int64)
+        return self.__deltas
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import os
+import zlib
+
+"""
+hot itemのsharding
+
+1つのitem_idへのcommandは1つのversion列で直列化されるため、
+注文の集中するitemはpartition keyあたりの条件付き書き込みの上限で頭打ちになる。
+SHARDED_ITEMSに指定したitemの在庫は N個のsub aggregate
+(item_id = <item_id>#<shard>) に分け、shardごとのversion列に書き込む。
+
+SHARDED_ITEMS (環境変数)
+    'item_id:shard数,...'  例: '00000001:4,00000002:8'
+    event / query Lambdaに同じ値を設定する
+
+available が0未満にならないことだけをshardごとに保証する。
+reserved / bought はshardを合計した値が正しい
+(complete / cancel は予約したshardと別のshardに書かれることがある)。
+
+既存のitemをSHARDED_ITEMSに加えた場合、それまでのeventと在庫は
+base item (item_id) に残る。base itemは在庫移動の移動元としてshardと同じに扱い、
+queryはshardとbase itemを合計する (shard_item_ids の include_base)。
+"""
+
+SHARD_SEPARATOR = '#'
+
+
+def parse_sharded_items(value):
+    """'item_id:shard数,...' -> {item_id: shard数}"""
+    sharded_items = {}
+    for entry in (value or '').split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        item_id, _, shards = entry.rpartition(':')
+        if not item_id or SHARD_SEPARATOR in item_id or int(shards) < 2:
+            raise ValueError('invalid SHARDED_ITEMS: {}'.format(entry))
+        sharded_items[item_id] = int(shards)
+    return sharded_items
+
+
+SHARDED_ITEMS = parse_sharded_items(os.environ.get('SHARDED_ITEMS'))
+
+
+def shard_count(item_id):
+    """shardされていないitemは0"""
+    return SHARDED_ITEMS.get(item_id, 0)
+
+
+def shard_item_id(item_id, shard):
+    return '{}{}{}'.format(item_id, SHARD_SEPARATOR, shard)
+
+
+def shard_item_ids(item_id, include_base=False):
+    """
+    include_base: shardする前のeventを持つbase item (item_id) も先頭に含める
+    shardされていないitemは []
+    """
+    shards = [shard_item_id(item_id, shard)
+              for shard in range(shard_count(item_id))]
+    if include_base and shards:
+        return [item_id] + shards
+    return shards
+
+
+def is_shard(item_id):
+    return SHARD_SEPARATOR in item_id
+
+
+def base_item_id(item_id):
+    return item_id.split(SHARD_SEPARATOR, 1)[0]
+
+
+def shard_of(item_id, key):
+    """keyから決まるshard番号 (同じcommandの再送は同じshardになる)"""
+    return zlib.crc32(key.encode('utf-8')) % shard_count(item_id)
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Lambdaのcold start
+
+FAST_STARTUP (環境変数)
+    false : aws_xray_sdkをimportしてpatch_allする (default)
+    true  : 実際に使うclient (TRACING_PATCH_MODULES) だけをpatchし、
+            tracingが無効ならaws_xray_sdk自体をimportしない
+            backendのbotocore clientはinit中(handlerの外)で作っておく
+
+lambda_function moduleの最後でlambda_handlerに適用する
+
+    @startup
+    def lambda_handler(event, context):
+        ...
+
+X-Rayのrecorderはimport時にsampling用のbotocore clientを作るため重いが、
+tracingが有効なら毎回のinvocationで必要なので最初の呼び出しまでは遅らせない
+(Lambdaのinit phaseで済ませた方がrequestのlatencyに乗らない)
+"""
+import os
+from escqrs.storage import warm_up_backends
+
+FAST_STARTUP = os.environ.get('FAST_STARTUP', 'false').lower() == 'true'
+
+# FAST_STARTUPでpatchするmodule (pynamodbもboto3もbotocoreを通る)
+TRACING_PATCH_MODULES = tuple(
+    name for name in
+    os.environ.get('TRACING_PATCH_MODULES', 'botocore').split(',') if name)
+
+
+def is_tracing_enabled():
+    return os.environ.get('AWS_XRAY_SDK_ENABLED', 'true').lower() != 'false'
+
+
+def patch_tracing():
+    if not FAST_STARTUP:
+        from aws_xray_sdk.core import patch_all
+        patch_all()
+        return
+    if not is_tracing_enabled():
+        return
+    from aws_xray_sdk.core import patch
+    patch(TRACING_PATCH_MODULES)
+
+
+def startup(handler):
+    patch_tracing()
+    if FAST_STARTUP:
+        warm_up_backends()
+    return handler
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+from escqrs.storage.base import StorageBackend, ConditionalCheckFailed
+
+"""
+EventStore Storage Backend
+
+EVENT_STORE_BACKEND (環境変数)
+    dynamodb : PynamoDB Model経由でDynamoDBを使う (default)
+    memory   : process内のdict (load test / offline replay用)
+    sqlite   : EVENT_STORE_SQLITE_PATH のSQLite (local cache tier用)
+               default は一時directoryの eventstore.db
+"""
+
+__all__ = ['StorageBackend', 'ConditionalCheckFailed', 'get_backend',
+           'register_backend', 'warm_up_backends']
+
+# kind -> factory(model) (benchmarkなどで独自backendを差し込む)
+_backend_factories = {}
+
+# get_backendで作ったbackend (warm_up_backendsの対象)
+_backends = []
+
+
+def register_backend(kind, factory):
+    _backend_factories[kind] = factory
+
+
+def get_backend(model, kind=None):
+    """
+    model: PynamoDB Model class (table名とkeyの定義に使う)
+    """
+    backend = _create_backend(model, kind)
+    _backends.append(backend)
+    return backend
+
+
+def warm_up_backends():
+    """module importで作られたbackendのclientを先に初期化する"""
+    for backend in _backends:
+        backend.warm_up()
+    del _backends[:]
+
+
+def _create_backend(model, kind=None):
+    kind = kind or os.environ.get('EVENT_STORE_BACKEND', 'dynamodb')
+    if kind in _backend_factories:
+        return _backend_factories[kind](model)
+    table_name = model.Meta.table_name
+    if kind == 'dynamodb':
+        from escqrs.storage.dynamodb import DynamoDBBackend
+        return DynamoDBBackend(model)
+    if kind == 'memory':
+        from escqrs.storage.memory import InMemoryBackend
+        return InMemoryBackend(table_name)
+    if kind == 'sqlite':
+        from escqrs.storage.sqlite import SQLiteBackend
+        path = os.environ.get(
+            'EVENT_STORE_SQLITE_PATH',
+            os.path.join(tempfile.gettempdir(), 'eventstore.db'))
+        return SQLiteBackend(table_name, path)
+    raise ValueError('unknown EVENT_STORE_BACKEND: {}'.format(kind))
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+import os
+
+# iter_pagesで1回に読むitem数
+EVENT_PAGE_SIZE = int(os.environ.get('EVENT_PAGE_SIZE', '1000'))
+
+
+class ConditionalCheckFailed(Exception):
+    """同じkey(item_id, version)のitemが既に存在する"""
+    pass
+
+
+class StorageBackend:
+    """
+    EventStore tableのstorage interface
+    itemはdictで扱い、hash key = item_id, range key = version
+    """
+
+    hash_key = 'item_id'
+    range_key = 'version'
+    # 1 transactionで書き込めるitem数の上限
+    max_transaction_items = 100
+
+    def append(self, item):
+        """
+        条件付き追加 (楽観的並行性制御)
+        同じkeyが既に存在する場合は ConditionalCheckFailed
+        """
+        raise NotImplementedError
+
+    def get_latest(self, hash_key):
+        """
+        range keyが最大のitem 無ければNone
+        range key 0 のrow (guard rowなど) は含まない (getで読む)
+        """
+        raise NotImplementedError
+
+    def get(self, hash_key, range_key, consistent_read=False):
+        """(hash_key, range_key) のitem 無ければNone"""
+        raise NotImplementedError
+
+    def query(self, hash_key, from_version=0, to_version=None,
+              ascending=True, limit=None, consistent_read=False):
+        """from_version < version <= to_version のitem list"""
+        raise NotImplementedError
+
+    def iter_pages(self, hash_key, from_version=0, to_version=None,
+                   page_size=None, consistent_read=False):
+        """
+        from_version < version <= to_version のitemをversion昇順に
+        page_size件ずつのlistでyieldする
+        全件をmemoryに載せずにfoldするために使う
+        """
+        page_size = page_size or EVENT_PAGE_SIZE
+        while True:
+            page = self.query(hash_key, from_version, to_version,
+                              limit=page_size,
+                              consistent_read=consistent_read)
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            from_version = page[-1][self.range_key]
+
+    def iter_projected_pages(self, hash_key, attributes, from_version=0,
+                             to_version=None, page_size=None,
+                             consistent_read=False):
+        """
+        iter_pagesと同じ範囲を、attributesの順に並べたtupleのlistでyieldする
+        replayのように一部のattributeだけが必要な読み込みに使う
+        """
+        for page in self.iter_pages(hash_key, from_version, to_version,
+                                    page_size, consistent_read):
+            yield [tuple(item.get(name) for name in attributes)
+                   for item in page]
+
+    def query_at_or_before(self, hash_key, attribute, value, limit=1):
+        """
+        attribute <= value のitemをattributeの降順にlimit件返す
+        DynamoDBではModelの '<attribute>_index' (GSI) をqueryする
+        GSIは結果整合性なので、直前に書いたitemは含まれないことがある
+        """
+        raise NotImplementedError
+
+    def transact_append(self, items):
+        """
+        複数itemの条件付き追加をまとめて行う (all or nothing)
+        1件でも同じkeyが存在するか、items内でkeyが重複すれば
+        何も書き込まず ConditionalCheckFailed
+        同じtableの別Modelのitem (guard rowなど) は (model, item) で渡す
+        """
+        raise NotImplementedError
+
+    def set_attributes(self, hash_key, range_key, attributes):
+        """
+        既存item (hash_key, range_key) のattributesだけを上書きする
+        itemが無ければ ConditionalCheckFailed (DynamoDBではUpdateError)
+        """
+        raise NotImplementedError
+
+    def batch_write(self, items):
+        """条件なしでまとめて書き込む"""
+        raise NotImplementedError
+
+    def batch_delete(self, items):
+        """items (hash key と range key) を条件なしでまとめて削除する"""
+        raise NotImplementedError
+
+    # ----------------------------------------
+    # hash keyだけのtable (read model) 用
+    # range_keyの属性はversion guardとして使う
+    # ----------------------------------------
+    def get_item(self, hash_key, consistent_read=False):
+        """hash_keyのitem 無ければNone"""
+        raise NotImplementedError
+
+    def batch_get(self, hash_keys):
+        """存在するitemのlist (順序は保証しない)"""
+        raise NotImplementedError
+
+    def iter_hash_keys(self, start_after=None, page_size=None):
+        """
+        hash keyを順にyieldする (scan)
+        start_after: 前回最後に返したhash key (ここから再開する)
+        """
+        raise NotImplementedError
+
+    def warm_up(self):
+        """初回requestの前に済ませておけるclientなどの初期化"""
+        pass
+
+    def put_if_newer(self, item):
+        """
+        itemが無いか、既存itemのrange_key属性が小さい場合だけ上書きする
+        既存itemの方が新しい(同じ)場合は ConditionalCheckFailed
+        """
+        raise NotImplementedError
+
+
+def transact_items(items):
+    """
+    transact_appendのitemsを (model, item) でyieldする
+    dictだけで渡されたitemのmodelはNone (backendのModel)
+    """
+    for entry in items:
+        if isinstance(entry, tuple):
+            yield entry
+        else:
+            yield None, entry
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+from pynamodb.exceptions import TransactWriteError
+from pynamodb.transactions import TransactWrite
+from escqrs.storage.base import (
+    StorageBackend,
+    ConditionalCheckFailed,
+    EVENT_PAGE_SIZE,
+    transact_items)
+
+
+class DynamoDBBackend(StorageBackend):
+    """
+    PynamoDB Modelを使うbackend
+    PutError/QueryErrorはそのままraiseし、各serviceのexception_handlerで扱う
+    """
+
+    def __init__(self, model):
+        self.__model = model
+
+    def append(self, item):
+        self.__model(**item).save(condition=self.__not_exists())
+
+    def transact_append(self, items):
+        # Modelのconnection(botocore client)を使い回す
+        connection = self.__model._get_connection().connection
+        keys = [(item[self.hash_key], item[self.range_key])
+                for _, item in transact_items(items)]
+        if len(set(keys)) < len(keys):
+            # DynamoDBはValidationExceptionにするため、他のbackendに合わせる
+            raise ConditionalCheckFailed('duplicate keys: {}'.format(keys))
+        try:
+            with TransactWrite(connection=connection) as transaction:
+                for model, item in transact_items(items):
+                    model = model or self.__model
+                    transaction.save(model(**item),
+                                     condition=self.__not_exists(model))
+        except TransactWriteError as e:
+            if is_transaction_conflict(e):
+                raise ConditionalCheckFailed(str(e))
+            raise e
+
+    def get_latest(self, hash_key):
+        for item in self.__model.query(
+                hash_key,
+                getattr(self.__model, self.range_key) > 0,
+                limit=1,
+                scan_index_forward=False):
+            return item.attribute_values
+        return None
+
+    def get(self, hash_key, range_key, consistent_read=False):
+        try:
+            return self.__model.get(
+                hash_key, range_key,
+                consistent_read=consistent_read).attribute_values
+        except self.__model.DoesNotExist:
+            return None
+
+    def query(self, hash_key, from_version=0, to_version=None,
+              ascending=True, limit=None, consistent_read=False):
+        return [item.attribute_values for item in self.__model.query(
+            hash_key,
+            self.__range_condition(from_version, to_version),
+            limit=limit,
+            consistent_read=consistent_read,
+            scan_index_forward=ascending)]
+
+    def iter_pages(self, hash_key, from_version=0, to_version=None,
+                   page_size=None, consistent_read=False):
+        # ResultIteratorはpage_size件ずつQueryを発行する
+        page_size = page_size or EVENT_PAGE_SIZE
+        page = []
+        for item in self.__model.query(
+                hash_key,
+                self.__range_condition(from_version, to_version),
+                consistent_read=consistent_read,
+                page_size=page_size):
+            page.append(item.attribute_values)
+            if len(page) == page_size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    def iter_projected_pages(self, hash_key, attributes, from_version=0,
+                             to_version=None, page_size=None,
+                             consistent_read=False):
+        # ProjectionExpressionを付けたlow-level Query
+        # Modelを組み立てずにattribute値を直接decodeする
+        page_size = page_size or EVENT_PAGE_SIZE
+        connection = self.__model._get_connection()
+        exclusive_start_key = None
+        while True:
+            data = connection.query(
+                hash_key,
+                range_key_condition=self.__range_condition(from_version,
+                                                           to_version),
+                attributes_to_get=list(attributes),
+                consistent_read=consistent_read,
+                exclusive_start_key=exclusive_start_key,
+                limit=page_size)
+            items = data.get('Items', [])
+            if items:
+                yield [tuple(decode_attribute(item.get(name))
+                             for name in attributes)
+                       for item in items]
+            exclusive_start_key = data.get('LastEvaluatedKey')
+            if not exclusive_start_key:
+                return
+
+    def query_at_or_before(self, hash_key, attribute, value, limit=1):
+        index = getattr(self.__model, '{}_index'.format(attribute))
+        return [item.attribute_values for item in index.query(
+            hash_key,
+            getattr(self.__model, attribute) <= value,
+            limit=limit,
+            scan_index_forward=False)]
+
+    def set_attributes(self, hash_key, range_key, attributes):
+        self.__model(hash_key, range_key).update(
+            actions=[getattr(self.__model, name).set(value)
+                     for name, value in attributes.items()],
+            condition=getattr(self.__model, self.hash_key).exists())
+
+    def batch_write(self, items):
+        with self.__model.batch_write() as batch:
+            for item in items:
+                batch.save(self.__model(**item))
+
+    def batch_delete(self, items):
+        # 25件ごとのBatchWriteItemとUnprocessedItemsの再送はPynamoDBが行う
+        with self.__model.batch_write() as batch:
+            for item in items:
+                batch.delete(self.__model(item[self.hash_key],
+                                          item[self.range_key]))
+
+    def get_item(self, hash_key, consistent_read=False):
+        try:
+            return self.__model.get(
+                hash_key, consistent_read=consistent_read).attribute_values
+        except self.__model.DoesNotExist:
+            return None
+
+    def batch_get(self, hash_keys):
+        # 100件ごとのBatchGetItemとUnprocessedKeysの再送はPynamoDBが行う
+        return [item.attribute_values
+                for item in self.__model.batch_get(hash_keys)]
+
+    def iter_hash_keys(self, start_after=None, page_size=None):
+        last_evaluated_key = None
+        if start_after is not None:
+            last_evaluated_key = {self.hash_key: {'S': start_after}}
+        for item in self.__model.scan(
+                attributes_to_get=[self.hash_key],
+                last_evaluated_key=last_evaluated_key,
+                page_size=page_size or EVENT_PAGE_SIZE):
+            yield getattr(item, self.hash_key)
+
+    def put_if_newer(self, item):
+        version = getattr(self.__model, self.range_key)
+        self.__model(**item).save(
+            condition=(getattr(self.__model, self.hash_key).does_not_exist() |
+                       (version < item[self.range_key])))
+
+    def warm_up(self):
+        # botocore clientの生成(endpointとcredentialの解決)をinit中に済ませる
+        # session (明示的なcredentialを含む) はpynamodbのConnectionに任せる
+        self.__model._get_connection().connection.client
+
+    def __range_condition(self, from_version, to_version):
+        range_key = getattr(self.__model, self.range_key)
+        if to_version is None:
+            return range_key > from_version
+        return range_key.between(from_version + 1, to_version)
+
+    def __not_exists(self, model=None):
+        model = model or self.__model
+        return (getattr(model, self.hash_key).does_not_exist() &
+                getattr(model, self.range_key).does_not_exist())
+
+
+def is_transaction_conflict(e):
+    """条件付き書き込みの失敗、または同じitemへの並行transaction"""
+    reasons = getattr(e, 'cancellation_reasons', None) or []
+    codes = {reason.code for reason in reasons if reason}
+    if codes:
+        return bool(codes & {'ConditionalCheckFailed',
+                             'TransactionConflict'})
+    return e.cause_response_code == 'TransactionCanceledException'
+
+
+def decode_attribute(value):
+    """low-level attribute値 ({'N': '3'} など) をpythonの値にする"""
+    if not value:
+        return None
+    if 'N' in value:
+        number = value['N']
+        return float(number) if '.' in number or 'e' in number.lower() \
+            else int(number)
+    if 'S' in value:
+        return value['S']
+    if 'NULL' in value:
+        return None
+    if 'BOOL' in value:
+        return value['BOOL']
+    raise ValueError('unsupported attribute: {}'.format(value))
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import bisect
+import copy
+import threading
+from escqrs.storage.base import (
+    StorageBackend,
+    ConditionalCheckFailed,
+    transact_items)
+
+
+class InMemoryBackend(StorageBackend):
+    """
+    process内のdictを使うbackend
+    同じtable名のbackendはdataを共有する (EventStore/Snapshot/Deduplication)
+    """
+
+    __tables = {}
+    __tables_lock = threading.Lock()
+
+    def __init__(self, table_name):
+        with self.__tables_lock:
+            self.__table = self.__tables.setdefault(
+                table_name,
+                {'partitions': {}, 'rows': {}, 'lock': threading.Lock()})
+        self.__lock = self.__table['lock']
+
+    def append(self, item):
+        with self.__lock:
+            versions, items = self.__partition(item[self.hash_key])
+            version = item[self.range_key]
+            index = bisect.bisect_left(versions, version)
+            if index < len(versions) and versions[index] == version:
+                raise ConditionalCheckFailed(
+                    '{}: {}'.format(item[self.hash_key], version))
+            versions.insert(index, version)
+            items.insert(index, copy.deepcopy(item))
+
+    def transact_append(self, items):
+        # 同じtable名のbackendはdataを共有するので、modelは見なくてよい
+        items = [item for _, item in transact_items(items)]
+        with self.__lock:
+            # transaction内で同じkeyが重複する場合も何も書き込まない
+            keys = set()
+            for item in items:
+                key = item[self.hash_key], item[self.range_key]
+                versions, _ = self.__partition(key[0])
+                if key in keys or \
+                        self.__index_of(versions, key[1]) is not None:
+                    raise ConditionalCheckFailed('{}: {}'.format(*key))
+                keys.add(key)
+            for item in items:
+                versions, _items = self.__partition(item[self.hash_key])
+                index = bisect.bisect_left(versions, item[self.range_key])
+                versions.insert(index, item[self.range_key])
+                _items.insert(index, copy.deepcopy(item))
+
+    def get_latest(self, hash_key):
+        with self.__lock:
+            versions, items = self.__partition(hash_key)
+            if not items or versions[-1] <= 0:
+                return None
+            return copy.deepcopy(items[-1])
+
+    def get(self, hash_key, range_key, consistent_read=False):
+        with self.__lock:
+            versions, items = self.__partition(hash_key)
+            index = self.__index_of(versions, range_key)
+            return copy.deepcopy(items[index]) if index is not None else None
+
+    def query(self, hash_key, from_version=0, to_version=None,
+              ascending=True, limit=None, consistent_read=False):
+        with self.__lock:
+            versions, items = self.__partition(hash_key)
+            start = bisect.bisect_right(versions, from_version)
+            end = len(versions) if to_version is None \
+                else bisect.bisect_right(versions, to_version)
+            selected = items[start:end]
+            if not ascending:
+                selected = selected[::-1]
+            if limit is not None:
+                selected = selected[:limit]
+            return copy.deepcopy(selected)
+
+    def query_at_or_before(self, hash_key, attribute, value, limit=1):
+        with self.__lock:
+            _, items = self.__partition(hash_key)
+            selected = [item for item in reversed(items)
+                        if item.get(attribute) is not None and
+                        item[attribute] <= value]
+            # 同じ値の場合はrange keyの降順
+            selected.sort(key=lambda item: item[attribute], reverse=True)
+            return copy.deepcopy(selected[:limit])
+
+    def set_attributes(self, hash_key, range_key, attributes):
+        with self.__lock:
+            versions, items = self.__partition(hash_key)
+            index = self.__index_of(versions, range_key)
+            if index is None:
+                raise ConditionalCheckFailed(
+                    '{}: {}'.format(hash_key, range_key))
+            items[index].update(copy.deepcopy(attributes))
+
+    def batch_write(self, items):
+        with self.__lock:
+            for item in items:
+                versions, _items = self.__partition(item[self.hash_key])
+                version = item[self.range_key]
+                index = bisect.bisect_left(versions, version)
+                if index < len(versions) and versions[index] == version:
+                    _items[index] = copy.deepcopy(item)
+                else:
+                    versions.insert(index, version)
+                    _items.insert(index, copy.deepcopy(item))
+
+    def batch_delete(self, items):
+        with self.__lock:
+            for item in items:
+                versions, _items = self.__partition(item[self.hash_key])
+                index = self.__index_of(versions, item[self.range_key])
+                if index is not None:
+                    del versions[index]
+                    del _items[index]
+
+    def get_item(self, hash_key, consistent_read=False):
+        with self.__lock:
+            return copy.deepcopy(self.__table['rows'].get(hash_key))
+
+    def batch_get(self, hash_keys):
+        with self.__lock:
+            rows = self.__table['rows']
+            return [copy.deepcopy(rows[hash_key])
+                    for hash_key in hash_keys if hash_key in rows]
+
+    def iter_hash_keys(self, start_after=None, page_size=None):
+        with self.__lock:
+            hash_keys = sorted(self.__table['rows'])
+        index = 0 if start_after is None \
+            else bisect.bisect_right(hash_keys, start_after)
+        for hash_key in hash_keys[index:]:
+            yield hash_key
+
+    def put_if_newer(self, item):
+        with self.__lock:
+            rows = self.__table['rows']
+            current = rows.get(item[self.hash_key])
+            if current is not None and \
+                    current[self.range_key] >= item[self.range_key]:
+                raise ConditionalCheckFailed(
+                    '{}: {}'.format(item[self.hash_key],
+                                    item[self.range_key]))
+            rows[item[self.hash_key]] = copy.deepcopy(item)
+
+    @staticmethod
+    def __index_of(versions, version):
+        index = bisect.bisect_left(versions, version)
+        if index < len(versions) and versions[index] == version:
+            return index
+        return None
+
+    def __partition(self, hash_key):
+        return self.__table['partitions'].setdefault(hash_key, ([], []))
+
+    @classmethod
+    def clear(cls):
+        with cls.__tables_lock:
+            for table in cls.__tables.values():
+                with table['lock']:
+                    table['partitions'].clear()
+                    table['rows'].clear()
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import json
+import sqlite3
+import threading
+from escqrs.storage.base import (
+    StorageBackend,
+    ConditionalCheckFailed,
+    transact_items)
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    SQLiteを使うbackend
+    (hash_key, range_key)のPRIMARY KEYで楽観的並行性制御を行う
+    """
+
+    def __init__(self, table_name, path=':memory:'):
+        self.__table_name = table_name
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__lock = threading.Lock()
+        with self.__lock, self.__connection:
+            self.__connection.execute(
+                'CREATE TABLE IF NOT EXISTS "{}" ('
+                'hash_key TEXT NOT NULL, '
+                'range_key INTEGER NOT NULL, '
+                'item TEXT NOT NULL, '
+                'PRIMARY KEY (hash_key, range_key))'.format(table_name))
+
+    def append(self, item):
+        try:
+            with self.__lock, self.__connection:
+                self.__connection.execute(
+                    'INSERT INTO "{}" VALUES (?, ?, ?)'.format(
+                        self.__table_name),
+                    self.__row(item))
+        except sqlite3.IntegrityError:
+            raise ConditionalCheckFailed(
+                '{}: {}'.format(item[self.hash_key], item[self.range_key]))
+
+    def transact_append(self, items):
+        try:
+            with self.__lock, self.__connection:
+                self.__connection.executemany(
+                    'INSERT INTO "{}" VALUES (?, ?, ?)'.format(
+                        self.__table_name),
+                    [self.__row(item) for _, item in transact_items(items)])
+        except sqlite3.IntegrityError as e:
+            raise ConditionalCheckFailed(str(e))
+
+    def get_latest(self, hash_key):
+        with self.__lock:
+            row = self.__connection.execute(
+                'SELECT item FROM "{}" WHERE hash_key = ? AND range_key > 0 '
+                'ORDER BY range_key DESC LIMIT 1'.format(self.__table_name),
+                (hash_key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get(self, hash_key, range_key, consistent_read=False):
+        with self.__lock:
+            row = self.__connection.execute(
+                'SELECT item FROM "{}" WHERE hash_key = ? '
+                'AND range_key = ?'.format(self.__table_name),
+                (hash_key, range_key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def query(self, hash_key, from_version=0, to_version=None,
+              ascending=True, limit=None, consistent_read=False):
+        sql = 'SELECT item FROM "{}" WHERE hash_key = ? ' \
+              'AND range_key > ?'.format(self.__table_name)
+        params = [hash_key, from_version]
+        if to_version is not None:
+            sql += ' AND range_key <= ?'
+            params.append(to_version)
+        sql += ' ORDER BY range_key {}'.format('ASC' if ascending else 'DESC')
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        with self.__lock:
+            rows = self.__connection.execute(sql, params).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def query_at_or_before(self, hash_key, attribute, value, limit=1):
+        # local用途なのでpartitionを読んでpythonで絞り込む
+        selected = [item for item in self.query(hash_key, ascending=False)
+                    if item.get(attribute) is not None and
+                    item[attribute] <= value]
+        selected.sort(key=lambda item: item[attribute], reverse=True)
+        return selected[:limit]
+
+    def set_attributes(self, hash_key, range_key, attributes):
+        with self.__lock, self.__connection:
+            row = self.__connection.execute(
+                'SELECT item FROM "{}" WHERE hash_key = ? '
+                'AND range_key = ?'.format(self.__table_name),
+                (hash_key, range_key)).fetchone()
+            if row is None:
+                raise ConditionalCheckFailed(
+                    '{}: {}'.format(hash_key, range_key))
+            item = json.loads(row[0])
+            item.update(attributes)
+            self.__connection.execute(
+                'UPDATE "{}" SET item = ? WHERE hash_key = ? '
+                'AND range_key = ?'.format(self.__table_name),
+                (json.dumps(item), hash_key, range_key))
+
+    def batch_write(self, items):
+        with self.__lock, self.__connection:
+            self.__connection.executemany(
+                'INSERT OR REPLACE INTO "{}" VALUES (?, ?, ?)'.format(
+                    self.__table_name),
+                [self.__row(item) for item in items])
+
+    def batch_delete(self, items):
+        with self.__lock, self.__connection:
+            self.__connection.executemany(
+                'DELETE FROM "{}" WHERE hash_key = ? AND range_key = ?'.format(
+                    self.__table_name),
+                [(item[self.hash_key], item[self.range_key])
+                 for item in items])
+
+    # read modelのitemは range_key = 0 の1行で持つ
+    def get_item(self, hash_key, consistent_read=False):
+        with self.__lock:
+            row = self.__select_item(hash_key)
+        return json.loads(row[0]) if row else None
+
+    def batch_get(self, hash_keys):
+        with self.__lock:
+            rows = [self.__select_item(hash_key) for hash_key in hash_keys]
+        return [json.loads(row[0]) for row in rows if row]
+
+    def iter_hash_keys(self, start_after=None, page_size=None):
+        with self.__lock:
+            rows = self.__connection.execute(
+                'SELECT hash_key FROM "{}" WHERE range_key = 0 '
+                'AND hash_key > ? ORDER BY hash_key'.format(
+                    self.__table_name),
+                (start_after or '',)).fetchall()
+        for row in rows:
+            yield row[0]
+
+    def put_if_newer(self, item):
+        with self.__lock, self.__connection:
+            row = self.__select_item(item[self.hash_key])
+            if row and json.loads(row[0])[self.range_key] >= \
+                    item[self.range_key]:
+                raise ConditionalCheckFailed(
+                    '{}: {}'.format(item[self.hash_key],
+                                    item[self.range_key]))
+            self.__connection.execute(
+                'INSERT OR REPLACE INTO "{}" VALUES (?, 0, ?)'.format(
+                    self.__table_name),
+                (item[self.hash_key], json.dumps(item)))
+
+    def __select_item(self, hash_key):
+        return self.__connection.execute(
+            'SELECT item FROM "{}" WHERE hash_key = ? '
+            'AND range_key = 0'.format(self.__table_name),
+            (hash_key,)).fetchone()
+
+    def __row(self, item):
+        return (item[self.hash_key], item[self.range_key], json.dumps(item))
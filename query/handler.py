@@ -1,11 +1,25 @@
 # -*- coding: utf-8 -*-
+import copy
 import logging
-from functools import reduce
-from model import EventStore, Snapshot
+import os
+from concurrent.futures import ThreadPoolExecutor
+from escqrs.cache import LRUCache
+from escqrs.reconstruct import reconstruct
+from escqrs.sharding import shard_count, shard_item_ids
+from error import ItemDoesNotExist
+from model import EventStore, Snapshot, InventoryView
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# warm containerで使い回す item_id -> (item, version) のcache
+state_cache = LRUCache(
+    maxsize=int(os.environ.get('STATE_CACHE_SIZE', '1024')),
+    ttl=float(os.environ.get('STATE_CACHE_TTL', '60')))
+
+# 複数item取得時に並行してqueryする数
+QUERY_CONCURRENCY = int(os.environ.get('QUERY_CONCURRENCY', '8'))
+
 
 class Handler:
 
@@ -21,20 +35,187 @@ class Handler:
         return None
 
     def _get(self):
-        snapshot = self.__ss.get_snapshot()
-        events = self.__es.get_events_from(snapshot['from_version'])
-
-        if len(events):
-            snapshot['state'] = reduce(self.__ss.calculate_state,
-                                       events,
-                                       self.__ss.get_state(snapshot))
-        return {
+        if self.__request.get('item_ids'):
+            return self.__get_items(self.__request['item_ids'])
+        if shard_count(self.__request['item_id']):
+            return self.__get_sharded_item(self.__request['item_id'])
+        if self.is_point_in_time:
+            item, _ = self.__get_state_at()
+            return item
+        view = None if self.is_strong_read else self.__get_view()
+        if view is not None:
+            return to_item(view)
+        # read-your-writes、またはviewが未作成の場合はreplayする
+        item, _ = self.__get_state()
+        return item
+
+    def __get_items(self, item_ids):
+        # sharded itemはshardごとに取得して合算する
+        # shardする前の在庫が残っているbase itemも合算する
+        shards = {item_id: shard_item_ids(item_id, include_base=True)
+                  for item_id in item_ids}
+        items = self.__get_unsharded_items(
+            [shard_id for item_id in item_ids
+             for shard_id in shards[item_id] or [item_id]])
+        return {'items': [
+            merge_shards(item_id, [items[shard_id]
+                                   for shard_id in shards[item_id]])
+            if shards[item_id] else items[item_id]
+            for item_id in item_ids]}
+
+    def __get_sharded_item(self, item_id):
+        item = self.__get_items([item_id])['items'][0]
+        if item.get('error') == ItemDoesNotExist.__name__:
+            raise ItemDoesNotExist(item_id)
+        return item
+
+    def __get_unsharded_items(self, item_ids):
+        """return: {item_id: item または {'item_id', 'error'}}"""
+        views = {} if self.is_strong_read or self.is_point_in_time \
+            else self.__get_views(item_ids)
+        missing = [item_id for item_id in item_ids if item_id not in views]
+        replayed = {}
+        if missing:
+            # viewに無いitemはsnapshotとevent tailを並行に取得する
+            workers = max(1, min(QUERY_CONCURRENCY, len(missing)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                replayed = dict(zip(
+                    missing,
+                    executor.map(self.__get_item_or_error, missing)))
+        return {item_id: to_item(views[item_id]) if item_id in views
+                else replayed[item_id] for item_id in item_ids}
+
+    def __get_view(self):
+        # viewが読めない場合もreplayで応答する
+        try:
+            return InventoryView().get(self.__request['item_id'])
+        except Exception as e:
+            logger.warning('GET: InventoryView {}: {}'.format(
+                type(e).__name__, e))
+            return None
+
+    def __get_views(self, item_ids):
+        try:
+            return InventoryView().batch_get(item_ids)
+        except Exception as e:
+            logger.warning('GET: InventoryView {}: {}'.format(
+                type(e).__name__, e))
+            return {}
+
+    def __get_item_or_error(self, item_id):
+        # 1 itemのerrorでresponse全体を失敗させない
+        request = dict(self.__request, item_id=item_id, item_ids=None)
+        try:
+            item, version = Handler(request).__get_item_state()
+            if version == 0:
+                raise ItemDoesNotExist(item_id)
+            return item
+        except Exception as e:
+            logger.warning('GET: {} {}: {}'.format(
+                item_id, type(e).__name__, e))
+            return {'item_id': item_id, 'error': type(e).__name__}
+
+    def __get_item_state(self):
+        if self.is_point_in_time:
+            return self.__get_state_at()
+        return self.__get_state()
+
+    def __get_state_at(self):
+        """
+        as_of_version / as_of 時点のstate
+        その時点以前の最新snapshotから、対象versionまでのeventだけをreplayする
+        """
+        version = self.__request.get('as_of_version')
+        if version is None:
+            version = self.__es.get_version_at(self.__request['as_of'])
+        snapshot = self.__ss.get_snapshot_at(version)
+        state, last_version = self.__ss.get_state(snapshot), None
+        if snapshot['from_version'] < version:
+            # snapshotがちょうど対象versionなら読むeventは無い
+            # (from_version + 1 > version の範囲はDynamoDBが拒否する)
+            state, last_version = self.__ss.fold_rows(
+                state,
+                self.__es.iter_replay_rows(snapshot['from_version'], version))
+        version = snapshot['from_version'] if last_version is None \
+            else last_version
+        item = {
             'item_id': snapshot['item_id'],
             'name': snapshot['name'],
-            'state': snapshot['state'],
+            'state': state,
+            'version': version,
         }
+        return item, version
+
+    def __get_state(self):
+        cached = state_cache.get(self.__request['item_id'])
+        if cached:
+            # cached versionより新しいeventだけを取得する
+            item, version = copy.deepcopy(cached)
+            item['state'], last_version = self.__ss.fold_rows(
+                item['state'], self.__es.iter_replay_rows(version))
+            if last_version is not None:
+                version = last_version
+        else:
+            # snapshotとevent tailを並行に取得する
+            snapshot, state, version = reconstruct(
+                self.__request['item_id'], self.__ss, self.__es)
+            item = {
+                'item_id': snapshot['item_id'],
+                'name': snapshot['name'],
+                'state': state,
+            }
+
+        state_cache.put(self.__request['item_id'],
+                        (copy.deepcopy(item), version))
+        return item, version
+
+    @property
+    def is_strong_read(self):
+        return self.__request.get('consistency') == 'strong'
+
+    @property
+    def is_point_in_time(self):
+        return self.__request.get('as_of_version') is not None or \
+            bool(self.__request.get('as_of'))
 
     @property
     def request_type(self):
         keys = self.__request['http_method'].lower().split('_')
         return keys[-1]
+
+
+def to_item(view):
+    return {
+        'item_id': view['item_id'],
+        'name': view['name'],
+        'state': view['state'],
+    }
+
+
+def merge_shards(item_id, items):
+    """
+    shardごと (base itemを含む) のitemのstateを合算する
+    eventの無いshard (ItemDoesNotExist) は0として扱い、全shardに無ければ
+    ItemDoesNotExist、それ以外のerrorはitemのerrorにする
+    """
+    errors = [item['error'] for item in items if 'error' in item]
+    found = [item for item in items if 'error' not in item]
+    failed = [error for error in errors
+              if error != ItemDoesNotExist.__name__]
+    if failed or not found:
+        return {'item_id': item_id,
+                'error': failed[0] if failed else ItemDoesNotExist.__name__}
+    state = {}
+    for item in found:
+        for key, value in item['state'].items():
+            state[key] = state.get(key, 0) + value
+    merged = {
+        'item_id': item_id,
+        'name': found[0]['name'],
+        'state': state,
+    }
+    if 'version' in found[0]:
+        # 時点指定のstateはshardごとのversion
+        merged['versions'] = {item['item_id']: item['version']
+                              for item in found}
+    return merged
@@ -1,29 +1,118 @@
 # -*- coding: utf-8 -*-
+import datetime
 import json
 import logging
+import os
+from collections import OrderedDict
 from handler import Handler
-from aws_xray_sdk.core import patch_all
+from escqrs.sharding import shard_count
+from escqrs.startup import startup
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-patch_all()
 
 '''
 クエリ文字列
 '''
 
 
+# 1 requestで取得できるitem数の上限
+MAX_ITEMS = int(os.environ.get('QUERY_MAX_ITEMS', '100'))
+
+# eventual : InventoryView (snapshot Lambdaが更新) を読む
+# strong   : snapshot + event tailからreplayする (read-your-writes)
+CONSISTENCY_LEVELS = ('eventual', 'strong')
+
+
 def extract_event(event):
     """
     'path': '/inventory',
     'httpMethod': 'GET',
     'queryStringParameters': {'item_id': '00000001'},
+    複数item:
+    'queryStringParameters': {'item_ids': '00000001,00000002'},
+    'multiValueQueryStringParameters': {'item_id': ['00000001', ...]},
+    書き込み直後の値が必要な場合:
+    'queryStringParameters': {'item_id': '00000001', 'consistency': 'strong'},
+    過去の時点:
+    'queryStringParameters': {'item_id': '00000001', 'as_of_version': '42'},
+    'queryStringParameters': {'item_id': '00000001',
+                              'as_of': '2019-10-01T09:00:00Z'},
     """
-    return dict(
+    request = dict(
         path=event['path'],
         http_method=event['httpMethod'],
-        item_id=event['queryStringParameters']['item_id']
+        consistency=extract_consistency(event),
     )
+    request.update(extract_point_in_time(event))
+    item_ids = extract_item_ids(event)
+    if not item_ids:
+        raise ValueError('item_id is required')
+    if len(item_ids) > MAX_ITEMS:
+        raise ValueError('too many item_ids: {}'.format(len(item_ids)))
+    if 'as_of_version' in request and \
+            any(shard_count(item_id) for item_id in item_ids):
+        # shardごとにversion列が別なので、versionでは時点を指定できない
+        raise ValueError('as_of_version is not supported for sharded items')
+    if len(item_ids) > 1 or 'item_ids' in (
+            event.get('queryStringParameters') or {}):
+        request['item_ids'] = item_ids
+    else:
+        request['item_id'] = item_ids[0]
+    return request
+
+
+def extract_consistency(event):
+    params = event.get('queryStringParameters') or {}
+    consistency = params.get('consistency') or 'eventual'
+    if consistency not in CONSISTENCY_LEVELS:
+        raise ValueError('unknown consistency: {}'.format(consistency))
+    return consistency
+
+
+def extract_point_in_time(event):
+    params = event.get('queryStringParameters') or {}
+    as_of_version = params.get('as_of_version')
+    as_of = params.get('as_of')
+    if as_of_version and as_of:
+        raise ValueError('specify either as_of_version or as_of')
+    if as_of_version:
+        version = int(as_of_version)
+        if version < 0:
+            raise ValueError('invalid as_of_version: {}'.format(version))
+        return {'as_of_version': version}
+    if as_of:
+        return {'as_of': normalize_timestamp(as_of)}
+    return {}
+
+
+def normalize_timestamp(value):
+    """ISO 8601 -> saved_atと同じ形式 (UTC 'YYYY-MM-DD HH:MM:SS.ffffff')"""
+    value = value.strip()
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    try:
+        timestamp = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError('invalid as_of: {}'.format(value))
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(
+            datetime.timezone.utc).replace(tzinfo=None)
+    return str(timestamp)
+
+
+def extract_item_ids(event):
+    params = event.get('queryStringParameters') or {}
+    multi_params = event.get('multiValueQueryStringParameters') or {}
+    item_ids = list()
+    for value in multi_params.get('item_id') or [params.get('item_id')]:
+        if value:
+            item_ids.append(value)
+    for value in (params.get('item_ids') or '').split(','):
+        if value.strip():
+            item_ids.append(value.strip())
+    # 重複を除き、順序は保つ
+    return list(OrderedDict.fromkeys(item_ids))
 
 
 def controller(request):
@@ -36,9 +125,18 @@ def controller(request):
         raise e
 
 
+@startup
 def lambda_handler(event, context):
     logger.info('GET: Inventories: {}'.format(event))
-    request = extract_event(event)
+    try:
+        request = extract_event(event)
+    except (KeyError, TypeError, ValueError) as e:
+        logger.warning('GET: Inventories - bad request: {}'.format(e))
+        return {
+            'statusCode': 400,
+            "headers": {"Content-Type": "text/html"},
+            'body': json.dumps({'error': str(e)})
+        }
     logger.info('GET: Inventories - request{}'.format(request))
     response = controller(request)
     return {
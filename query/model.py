@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import copy
 import logging
 from pynamodb.models import Model
 from pynamodb.attributes import (
@@ -6,8 +7,16 @@ from pynamodb.attributes import (
     NumberAttribute,
     JSONAttribute
 )
+from pynamodb.indexes import (
+    GlobalSecondaryIndex,
+    AllProjection,
+    KeysOnlyProjection
+)
 from exception_handler import raise_for_query_exception
 from error import ItemDoesNotExist
+from escqrs.archive import get_archive
+from escqrs.replay import ReplayEngine, REPLAY_ATTRIBUTES
+from escqrs.storage import get_backend
 
 
 logger = logging.getLogger()
@@ -17,6 +26,18 @@ logger.setLevel(logging.INFO)
 # --------------------------
 # Event Store Model
 # --------------------------
+class SavedAtIndex(GlobalSecondaryIndex):
+    """saved_at -> version (時刻指定のquery用)"""
+    class Meta:
+        index_name = 'saved_at-index'
+        projection = KeysOnlyProjection()
+        read_capacity_units = 1
+        write_capacity_units = 1
+
+    item_id = UnicodeAttribute(hash_key=True)
+    saved_at = UnicodeAttribute(range_key=True)
+
+
 class EventStoreModel(Model):
     class Meta:
         table_name = 'EventStore'
@@ -33,6 +54,12 @@ class EventStoreModel(Model):
     fired_at = UnicodeAttribute()
     saved_at = UnicodeAttribute()
     order_id = UnicodeAttribute(null=True)
+    saved_at_index = SavedAtIndex()
+
+
+event_store = get_backend(EventStoreModel)
+# ARCHIVE_ROOT (EFSなど) が設定されていれば、archive済みのeventはそこから読む
+archive = get_archive()
 
 
 class EventStore:
@@ -50,28 +77,95 @@ class EventStore:
 
     def __init__(self, request):
         self.__request = request
-        self.__model = EventStoreModel
+        self.__storage = event_store
 
-    def get_events_from(self, from_version):
+    def get_events_from(self, from_version, to_version=None):
         # 強整合性
         with raise_for_query_exception(self.__request['item_id']):
-            event_list = list()
-            for event in self.__model.query(
+            return self.__storage.query(self.__request['item_id'],
+                                        from_version,
+                                        to_version,
+                                        consistent_read=True)
+
+    def iter_events_from(self, from_version, to_version=None,
+                         page_size=None):
+        # 強整合性 page単位でyieldする
+        with raise_for_query_exception(self.__request['item_id']):
+            for events in self.__storage.iter_pages(self.__request['item_id'],
+                                                    from_version,
+                                                    to_version,
+                                                    page_size,
+                                                    consistent_read=True):
+                yield events
+
+    def iter_replay_rows(self, from_version, to_version=None,
+                         page_size=None):
+        """
+        replayに必要な (version, event_type, quantity) だけを
+        projectionして、tupleのlistをpage単位でyieldする
+        archive済みのversionはsegment fileから読む
+        """
+        if archive is not None:
+            archived_version = archive.archived_version(
+                self.__request['item_id'])
+            if from_version < archived_version:
+                for events in archive.iter_pages(self.__request['item_id'],
+                                                 from_version, to_version):
+                    yield [tuple(event.get(name)
+                                 for name in REPLAY_ATTRIBUTES)
+                           for event in events]
+                from_version = archived_version
+                if to_version is not None and to_version <= from_version:
+                    return
+
+        with raise_for_query_exception(self.__request['item_id']):
+            for rows in self.__storage.iter_projected_pages(
                     self.__request['item_id'],
-                    self.__model.version > from_version,
-                    consistent_read=True,
-                    scan_index_forward=False):
-                event_list.append(event.attribute_values)
-            event_list.reverse()
-            return event_list
+                    REPLAY_ATTRIBUTES,
+                    from_version,
+                    to_version,
+                    page_size,
+                    consistent_read=True):
+                yield rows
+
+    def get_replay_rows(self, from_version, to_version=None):
+        return [row for rows in self.iter_replay_rows(from_version,
+                                                      to_version)
+                for row in rows]
+
+    def get_version_at(self, as_of):
+        """
+        as_of (saved_atと同じ形式の文字列) 時点の最新version 無ければ0
+        """
+        with raise_for_query_exception(self.__request['item_id']):
+            events = self.__storage.query_at_or_before(
+                self.__request['item_id'], 'saved_at', as_of,
+                # 1 transactionで書いたeventは同じsaved_atを持つ
+                limit=self.__storage.max_transaction_items)
+        if not events:
+            return self.__get_archived_version_at(as_of)
+        saved_at = events[0]['saved_at']
+        return max(event['version'] for event in events
+                   if event['saved_at'] == saved_at)
+
+    def __get_archived_version_at(self, as_of):
+        # EventStoreに残っていない古い時点はsegmentを先頭から読む (監査用)
+        version = 0
+        if archive is None:
+            return version
+        for events in archive.iter_pages(self.__request['item_id']):
+            for event in events:
+                if event['saved_at'] > as_of:
+                    return version
+                version = event['version']
+        return version
 
     def __query_latest_event(self):
         with raise_for_query_exception(self.__request['item_id']):
-            event = self.__model.query(self.__request['item_id'],
-                                       self.__model.version > 0,
-                                       limit=1,
-                                       scan_index_forward=False).next()
-            return event
+            event = self.__storage.get_latest(self.__request['item_id'])
+        if event is None:
+            raise ItemDoesNotExist(self.__request['item_id'])
+        return event
 
     def __get_initial_event(self):
         initial_event = self.__initial_event
@@ -82,6 +176,18 @@ class EventStore:
 # --------------------------
 # Snapshot Model
 # --------------------------
+class FromVersionIndex(GlobalSecondaryIndex):
+    """from_version -> snapshot (version指定のquery用)"""
+    class Meta:
+        index_name = 'from_version-index'
+        projection = AllProjection()
+        read_capacity_units = 1
+        write_capacity_units = 1
+
+    item_id = UnicodeAttribute(hash_key=True)
+    from_version = NumberAttribute(range_key=True)
+
+
 class SnapshotModel(Model):
     class Meta:
         table_name = 'EventStore'
@@ -96,6 +202,12 @@ class SnapshotModel(Model):
     state = JSONAttribute()
     saved_at = UnicodeAttribute()
     order_id = UnicodeAttribute(null=True)
+    # event / query Lambdaが計測したreplayコスト (ms/event)
+    replay_cost_ms = NumberAttribute(null=True)
+    from_version_index = FromVersionIndex()
+
+
+snapshot_store = get_backend(SnapshotModel)
 
 
 class State:
@@ -139,9 +251,14 @@ class State:
         state['reserved'] -= event['quantity']
         return state
 
+    @staticmethod
+    def _on_withdraw(state, event):
+        # shard間の在庫移動の移動元 (移動先は add)
+        state['available'] -= event['quantity']
+        return state
+
     @staticmethod
     def __get_event_type(event):
-        logger.info('_get_event_type: {}'.format(event))
         splited = event['event_type'].lower().split('_')
         return splited[-1]
 
@@ -166,37 +283,102 @@ class Snapshot:
 
     def __init__(self, request):
         self.__request = request
-        self.__model = SnapshotModel
+        self.__storage = snapshot_store
         self.__state = State()
+        self.__replay = ReplayEngine(self.calculate_state)
 
     def get_snapshot(self):
         try:
-            snapshot = self.__get_latest_snapshot()
-            item = snapshot.attribute_values
+            item = self.__get_latest_snapshot()
             item['item_id'] = item['item_id'].rstrip(self.__snapshot_suffix)
             return item
         except ItemDoesNotExist:
             logger.warning('No Snapshot')
             return self.__get_initial_snapshot()
 
+    def get_snapshot_at(self, version):
+        """from_version <= version の中で最新のsnapshot"""
+        snapshot_item_id = self.__request['item_id'] + self.__snapshot_suffix
+        with raise_for_query_exception(self.__request['item_id']):
+            snapshots = self.__storage.query_at_or_before(
+                snapshot_item_id, 'from_version', version)
+        if not snapshots:
+            return self.__get_initial_snapshot()
+        snapshot = snapshots[0]
+        snapshot['item_id'] = self.__request['item_id']
+        return snapshot
+
     def calculate_state(self, current_state, next_event):
         return self.__state.apply(current_state, next_event)
 
+    def replay_state(self, current_state, events):
+        return self.__replay.replay(current_state, events)
+
+    def fold_events(self, current_state, pages):
+        """return: (state, 最後にfoldしたversion 無ければNone)"""
+        return self.__replay.replay_pages(current_state, pages)
+
+    def fold_rows(self, current_state, pages):
+        """pages: iter_replay_rowsのpage return: fold_eventsと同じ"""
+        return self.__replay.replay_row_pages(current_state, pages)
+
     @staticmethod
     def get_state(snapshot):
         return snapshot['state']
 
+    def record_replay_cost(self, snapshot, cost_ms):
+        """readで計測したreplayコストをsnapshot rowに書く (reconstruct参照)"""
+        self.__storage.set_attributes(
+            self.__request['item_id'] + self.__snapshot_suffix,
+            snapshot['version'], {'replay_cost_ms': cost_ms})
+
     def __get_latest_snapshot(self):
+        snapshot_item_id = self.__request['item_id'] + self.__snapshot_suffix
         with raise_for_query_exception(self.__request['item_id']):
-            snapshot_item_id = self.__request[
-                                   'item_id'] + self.__snapshot_suffix
-            snapshot = self.__model.query(snapshot_item_id,
-                                          self.__model.version > 0,
-                                          limit=1,
-                                          scan_index_forward=False).next()
+            snapshot = self.__storage.get_latest(snapshot_item_id)
+        if snapshot is None:
+            raise ItemDoesNotExist(snapshot_item_id)
         return snapshot
 
     def __get_initial_snapshot(self):
-        initial_snapshot = self.__initial_snapshot
+        initial_snapshot = copy.deepcopy(self.__initial_snapshot)
         initial_snapshot['item_id'] = self.__request['item_id']
         return initial_snapshot
+
+
+# --------------------------
+# InventoryView Model
+# --------------------------
+class InventoryViewModel(Model):
+    class Meta:
+        table_name = 'InventoryView'
+        region = 'ap-northeast-1'
+        max_retry_attempts = 8
+        base_backoff_ms = 297
+
+    item_id = UnicodeAttribute(hash_key=True)
+    version = NumberAttribute()
+    name = UnicodeAttribute()
+    state = JSONAttribute()
+    updated_at = UnicodeAttribute()
+
+
+inventory_view_store = get_backend(InventoryViewModel)
+
+
+class InventoryView:
+    """snapshot Lambdaが更新する itemごとの最新state (結果整合性)"""
+
+    def __init__(self):
+        self.__storage = inventory_view_store
+
+    def get(self, item_id):
+        """1回のGetItem 無ければNone"""
+        with raise_for_query_exception(item_id):
+            return self.__storage.get_item(item_id)
+
+    def batch_get(self, item_ids):
+        """BatchGetItem return: {item_id: view}"""
+        with raise_for_query_exception(','.join(item_ids)):
+            return {view['item_id']: view
+                    for view in self.__storage.batch_get(item_ids)}
@@ -8,8 +8,32 @@ logger.setLevel(logging.INFO)
 
 """
 DynamoDB Streams Record to dict
+
+DynamoDBStreamsRecord : 1 recordずつTypeDeserializerでdecodeする
+StreamImageDecoder    : table schemaのattributeはtype tagから直接
+                        int/strにし、Records batchをまとめてdecodeする
 """
 
+# EventStore tableのattribute -> type tag
+# (event, snapshot, deduplication, idempotency guardの各row)
+EVENT_STORE_SCHEMA = {
+    'item_id': 'S',
+    'version': 'N',
+    'event_id': 'S',
+    'event_type': 'S',
+    'name': 'S',
+    'quantity': 'N',
+    'fired_at': 'S',
+    'saved_at': 'S',
+    'order_id': 'S',
+    'from_version': 'N',
+    'event_item_id': 'S',
+    'event_version': 'N',
+    'expires_at': 'N',
+}
+
+_deserializer = None
+
 
 class DynamoDBStreamsRecord:
     def __init__(self, record):
@@ -44,10 +68,91 @@ class DynamoDBStreamsRecord:
         for key in kwargs.keys():
             if isinstance(kwargs[key], dict):
                 kwargs[key] = \
-                    self._decimal_to_integer_or_float(n, **kwargs[key])
+                    self.__decimal_to_integer_or_float(n, **kwargs[key])
             elif isinstance(kwargs[key], decimal.Decimal):
                 if kwargs[key] % 1 == 0:  # in case int
                     kwargs[key] = int(kwargs[key])
                 else:  # in case float
                     kwargs[key] = float(kwargs[key])
         return kwargs
+
+
+class StreamImageDecoder:
+
+    def __init__(self, schema, hash_key='item_id'):
+        self.__schema = schema
+        self.__hash_key = hash_key
+
+    def decode(self, image):
+        """NewImage -> dict (NはDecimalを経由せずint/floatにする)"""
+        item = {}
+        for key, value in image.items():
+            tag = self.__schema.get(key)
+            if tag == 'S' and 'S' in value:
+                item[key] = value['S']
+            elif tag == 'N' and 'N' in value:
+                item[key] = to_number(value['N'])
+            else:
+                # schema外のattribute、型の違うattribute(state mapなど)
+                item[key] = decode_value(value)
+        return item
+
+    def decode_batch(self, records, event_name='INSERT', accept_key=None):
+        """
+        Streams batch -> [(record, image)]
+        event_nameでないrecordと、hash keyがaccept_keyを満たさないrecordは
+        NewImageをdecodeしない
+        """
+        decoded = []
+        for record in records:
+            if record['eventName'] != event_name:
+                continue
+            image = record['dynamodb'].get('NewImage') or {}
+            if accept_key is not None:
+                hash_key = image.get(self.__hash_key, {}).get('S')
+                if hash_key is None or not accept_key(hash_key):
+                    continue
+            decoded.append((record, self.decode(image)))
+        logger.info('deserialized: {} / {} records'.format(
+            len(decoded), len(records)))
+        return decoded
+
+
+def to_number(value):
+    """DynamoDBのN (文字列) -> int (整数値の場合) / float"""
+    try:
+        return int(value)
+    except ValueError:
+        number = decimal.Decimal(value)
+        if number % 1 == 0:  # in case int
+            return int(number)
+        return float(number)
+
+
+def decode_value(value):
+    """AttributeValue -> python (M/Lは再帰的にdecodeする)"""
+    (tag, data), = value.items()
+    if tag == 'S':
+        return data
+    if tag == 'N':
+        return to_number(data)
+    if tag == 'M':
+        return {key: decode_value(item) for key, item in data.items()}
+    if tag == 'L':
+        return [decode_value(item) for item in data]
+    if tag == 'BOOL':
+        return data
+    if tag == 'NULL':
+        return None
+    if tag == 'SS':
+        return set(data)
+    if tag == 'NS':
+        return set(to_number(item) for item in data)
+    # B / BS
+    global _deserializer
+    if _deserializer is None:
+        _deserializer = TypeDeserializer()
+    return _deserializer.deserialize(value)
+
+
+event_store_decoder = StreamImageDecoder(EVENT_STORE_SCHEMA)
@@ -1,17 +1,22 @@
 # -*- coding: utf-8 -*-
-from model import Snapshot, DeduplicateEvent
+from model import Snapshot, DeduplicateEvent, InventoryView
 
 
 class EventHandler:
 
-    def __init__(self, event):
-        self.snapshot = Snapshot(event)
-        self.deduplication = DeduplicateEvent(event)
-        self.event = event
+    def __init__(self, events):
+        """events: 同一item_idのevent list (version順)"""
+        self.snapshot = Snapshot(events[-1])
+        self.events = events
 
     def update(self):
+        # 重複eventもversionの連続性を保つため渡し、foldだけを省く
+        # 失敗したbatchの再送は同じversionで記録済みなので重複にならない
+        duplicated_versions = {
+            event['version'] for event in self.events
+            if DeduplicateEvent(event).is_duplicate_event()}
 
-        if self.deduplication.is_duplicate_event():
-            return
-
-        self.snapshot.update()
+        state, version = self.snapshot.update(self.events,
+                                              duplicated_versions)
+        if version:
+            InventoryView(self.events[-1]).update(state, version)
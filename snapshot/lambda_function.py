@@ -1,48 +1,57 @@
 # -*- coding: utf-8 -*-
 import logging
-from aws_xray_sdk.core import patch_all
+from collections import OrderedDict
 from event_handler import EventHandler
-from dynamodb_stream_derecord import DynamoDBStreamsRecord
+from dynamodb_stream_derecord import event_store_decoder
+from escqrs.startup import startup
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-patch_all()
 
 
-def extract_event(event):
-    stream_record = DynamoDBStreamsRecord(event['Records'][0])
-    record = stream_record.image
-    logger.info('Stream Deserialze: {}'.format(record))
-    return record
+def sequence_number(record):
+    return record['dynamodb']['SequenceNumber']
 
 
-def is_insert_event(event):
-    # INSERT | MODIFY | REMOVE
-    return True if event['Records'][0]['eventName'] == 'INSERT' else False
+def is_snapshot_event(item_id):
+    return True if item_id.endswith('-snapshot') else False
 
 
-def is_snapshot_event(event):
-    return True if event['item_id'].endswith('-snapshot') else False
+def is_deduplication_event(item_id):
+    return True if item_id.endswith('-deduplication') else False
 
 
-def is_deduplication_event(event):
-    return True if event['item_id'].endswith('-deduplication') else False
+def is_idempotency_event(item_id):
+    # event Lambdaがeventと同じtransactionで書くevent_idのguard row
+    return True if item_id.endswith('-idempotency') else False
 
 
-def filtering_event(event):
-    if not is_insert_event(event):
-        return None
-    event = extract_event(event)
-    if is_snapshot_event(event):
-        return None
-    if is_deduplication_event(event):
-        return None
-    return event
+def is_command_event(item_id):
+    return not (is_snapshot_event(item_id) or
+                is_deduplication_event(item_id) or
+                is_idempotency_event(item_id))
 
 
-def snapshot_controller(event):
+def filtering_event(event):
+    """
+    Streams batch -> {item_id: [(sequence_number, event), ...]}
+    INSERT以外のrecordとsnapshot対象外のrowはdecodeせずに捨てる
+    各item_idのeventはversion順に並べる
+    """
+    item_events = OrderedDict()
+    for record, _event in event_store_decoder.decode_batch(
+            event['Records'], accept_key=is_command_event):
+        item_events.setdefault(_event['item_id'], []).append(
+            (sequence_number(record), _event))
+
+    for item_id in item_events:
+        item_events[item_id].sort(key=lambda pair: pair[1]['version'])
+    return item_events
+
+
+def snapshot_controller(events):
     try:
-        handler = EventHandler(event)
+        handler = EventHandler(events)
         handler.update()
         return
     except Exception as e:
@@ -50,11 +59,19 @@ def snapshot_controller(event):
         raise e
 
 
+@startup
 def lambda_handler(event, context):
-    event = filtering_event(event)
-    if not event:
-        return
-
-    logger.info('######## SNAPSHOT Inventory: {}'.format(event))
-    snapshot_controller(event)
-    return
+    item_events = filtering_event(event)
+
+    batch_item_failures = list()
+    for item_id, pairs in item_events.items():
+        logger.info('######## SNAPSHOT Inventory: {} ({} events)'.format(
+            item_id, len(pairs)))
+        try:
+            snapshot_controller([_event for _, _event in pairs])
+        except Exception:
+            # 失敗したitemのrecordだけを再試行させる
+            batch_item_failures.extend(
+                {'itemIdentifier': seq} for seq, _ in pairs)
+
+    return {'batchItemFailures': batch_item_failures}
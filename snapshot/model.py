@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
+import copy
 import datetime
 import logging
-from functools import reduce
+import os
+import time
 from pynamodb.models import Model
 from pynamodb.attributes import (
     UnicodeAttribute,
@@ -12,13 +14,62 @@ from exception_handler import (
     raise_for_save_exception,
     raise_for_query_exception,
     raise_with_no_snapshot_exception)
-from error import ItemDoesNotExist, IntegrityError
+from error import IntegrityError
 from retrying import retry
 from retry_handler import is_integrity_error
+from snapshot_policy import get_policy
+from escqrs.cache import LRUCache
+from escqrs.replay import ReplayEngine
+from escqrs.storage import get_backend
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+snapshot_policy = get_policy()
+
+# snapshotに書き込んでいないfold済みstate item_id -> (state, version)
+# 同じshardのbatchは同じcontainerで続けて処理されることが多い
+pending_states = LRUCache(maxsize=1024)
+
+
+# --------------------------
+# Event Store Table
+# --------------------------
+class EventStoreModel(Model):
+    class Meta:
+        table_name = 'EventStore'
+        region = 'ap-northeast-1'
+        max_retry_attempts = 8
+        base_backoff_ms = 297
+
+    item_id = UnicodeAttribute(hash_key=True)
+    version = NumberAttribute(range_key=True)
+    event_id = UnicodeAttribute()
+    event_type = UnicodeAttribute()
+    name = UnicodeAttribute()
+    quantity = NumberAttribute()
+    fired_at = UnicodeAttribute()
+    saved_at = UnicodeAttribute()
+    order_id = UnicodeAttribute(null=True)
+
+
+event_store = get_backend(EventStoreModel)
+
+
+class EventStore:
+
+    def __init__(self, event):
+        self.__event = event
+        self.__storage = event_store
+
+    def get_events_between(self, from_version, to_version):
+        # 強整合性
+        with raise_for_query_exception(self.__event['item_id']):
+            return self.__storage.query(self.__event['item_id'],
+                                        from_version,
+                                        to_version,
+                                        consistent_read=True)
+
 
 # --------------------------
 # snapshot Table
@@ -37,6 +88,11 @@ class SnapshotModel(Model):
     state = JSONAttribute()
     saved_at = UnicodeAttribute()
     order_id = UnicodeAttribute(null=True)
+    # event / query Lambdaが計測したreplayコスト (ms/event)
+    replay_cost_ms = NumberAttribute(null=True)
+
+
+snapshot_store = get_backend(SnapshotModel)
 
 
 class State:
@@ -80,6 +136,12 @@ class State:
         state['reserved'] -= event['quantity']
         return state
 
+    @staticmethod
+    def _on_withdraw(state, event):
+        # shard間の在庫移動の移動元 (移動先は add)
+        state['available'] -= event['quantity']
+        return state
+
     @staticmethod
     def __get_event_type(event):
         splited = event['event_type'].lower().split('_')
@@ -104,51 +166,103 @@ class Snapshot:
 
     def __init__(self, event):
         self.__event = event
-        self.__model = SnapshotModel
+        self.__storage = snapshot_store
         self.__state = State()
+        self.__replay = ReplayEngine(self.__calculate_state)
+        self.__es = EventStore(event)
         self.__current_snapshot = {}
 
     @retry(wait_exponential_multiplier=100,
            wait_exponential_max=1000,
            retry_on_exception=is_integrity_error)
-    def update(self):
+    def update(self, events=None, duplicated_versions=()):
+        """
+        events: 同一item_idのevent list (version順)
+        duplicated_versions: 重複eventのversion (foldしない)
+        まとめてfoldし、snapshot_policyが許可した場合だけ1件書き込む
+        return: fold後の (state, version)
+        """
         self.__get_current_snapshot()
-        next_snapshot = self.__get_next_snapshot()
-        self.__persist(next_snapshot)
-        return
+        state, version = self.__get_folded_state()
+        events = events or [self.__event]
+        batch_versions = {event['version'] for event in events}
+        events = self.__get_unapplied_events(events, version)
+        if not events:
+            return state, version
+
+        duplicated_versions = set(duplicated_versions) | \
+            self.__get_duplicated_versions(events, batch_versions)
+        state = self.__replay.replay(
+            state,
+            [event for event in events
+             if event['version'] not in duplicated_versions])
+        version = events[-1]['version']
+
+        if snapshot_policy.should_snapshot(self.current_snapshot, version):
+            next_snapshot = self.__get_next_snapshot(state, version)
+            self.__persist(next_snapshot)
+        pending_states.put(self.__event['item_id'],
+                           (copy.deepcopy(state), version))
+        return state, version
+
+    def __get_folded_state(self):
+        # snapshotより新しいfold済みstateがあればそこから続ける
+        from_version = self.current_snapshot['from_version']
+        pending = pending_states.get(self.__event['item_id'])
+        if pending and pending[1] >= from_version:
+            state, version = copy.deepcopy(pending)
+            return state, version
+        return self.current_snapshot['state'], from_version
+
+    def __get_unapplied_events(self, events, version):
+        # retry時など、既にfold済みのversionは除外する
+        events = [event for event in events if event['version'] > version]
+        if events and events[0]['version'] != version + 1:
+            # 書き込みを省略したsnapshot以降のeventをEventStoreから補う
+            events = self.__get_tail_events(version, events[-1]['version'])
+        return events
+
+    def __get_tail_events(self, from_version, to_version):
+        return self.__es.get_events_between(from_version, to_version)
+
+    @staticmethod
+    def __get_duplicated_versions(events, batch_versions):
+        """
+        同じevent_idは最初の1件だけをfoldする
+        EventStoreから補ったbatch外のeventは、以前のbatchで記録した重複排除rowも
+        見る (tailより前のversionと同じevent_idのeventを再びfoldしない)
+        """
+        seen_event_ids = set()
+        duplicated_versions = set()
+        for event in events:
+            if event['event_id'] in seen_event_ids or (
+                    event['version'] not in batch_versions and
+                    DeduplicateEvent(event).was_duplicate_event()):
+                duplicated_versions.add(event['version'])
+            seen_event_ids.add(event['event_id'])
+        return duplicated_versions
 
     def __get_current_snapshot(self):
-        try:
-            snapshot_item_id = self.item_id
-            with raise_for_query_exception(snapshot_item_id):
-                snapshot = self.__model.query(
-                    snapshot_item_id,
-                    self.__model.version > 0,
-                    limit=1,
-                    scan_index_forward=False).next()
-                self.current_snapshot = snapshot.attribute_values
-
-        except ItemDoesNotExist:
+        snapshot_item_id = self.item_id
+        with raise_for_query_exception(snapshot_item_id):
+            snapshot = self.__storage.get_latest(snapshot_item_id)
+        if snapshot is None:
             self.current_snapshot = self.initial_snapshot
+        else:
+            self.current_snapshot = snapshot
 
     def __persist(self, next_snapshot):
-        snapshot = self.__model(**next_snapshot)
-        logger.info('__persist: {}'.format(snapshot.attribute_values))
-        with raise_with_no_snapshot_exception(snapshot.item_id):
-            snapshot.save(
-                condition=(self.__model.item_id != snapshot.item_id) &
-                          (self.__model.version != snapshot.version)
-            )
-
-    def __get_next_snapshot(self):
+        logger.info('__persist: {}'.format(next_snapshot))
+        with raise_with_no_snapshot_exception(next_snapshot['item_id']):
+            self.__storage.append(next_snapshot)
+
+    def __get_next_snapshot(self, state, version):
         logger.info('__get_next_snapshot: {}'.format(self.current_snapshot))
         next_snapshot = self.current_snapshot
         next_snapshot['version'] += 1
-        next_snapshot['from_version'] = self.__event['version']
+        next_snapshot['from_version'] = version
         next_snapshot['saved_at'] = str(datetime.datetime.utcnow())
-        next_snapshot['state'] = reduce(self.__calculate_state,
-                                        [self.__event],
-                                        self.current_snapshot['state'])
+        next_snapshot['state'] = state
         return next_snapshot
 
     def __calculate_state(self, current_state, next_event):
@@ -156,7 +270,8 @@ class Snapshot:
 
     @property
     def initial_snapshot(self):
-        initial_snapshot = self.__initial_snapshot_form
+        # warm containerで複数itemを処理するため、class属性はcopyして使う
+        initial_snapshot = copy.deepcopy(self.__initial_snapshot_form)
         initial_snapshot['item_id'] = self.item_id
         initial_snapshot['name'] = self.__event['name']
         return initial_snapshot
@@ -166,6 +281,53 @@ class Snapshot:
         return self.__event['item_id'] + self.__snapshot_suffix
 
 
+# --------------------------
+# InventoryView Table
+# --------------------------
+class InventoryViewModel(Model):
+    class Meta:
+        table_name = 'InventoryView'
+        region = 'ap-northeast-1'
+        max_retry_attempts = 8
+        base_backoff_ms = 297
+
+    item_id = UnicodeAttribute(hash_key=True)
+    version = NumberAttribute()
+    name = UnicodeAttribute()
+    state = JSONAttribute()
+    updated_at = UnicodeAttribute()
+
+
+inventory_view_store = get_backend(InventoryViewModel)
+
+
+class InventoryView:
+    """
+    itemごとの最新stateを1行で持つread model
+    Streamsの再送や順不同の処理で古いstateに戻さないよう、
+    versionが新しい場合だけ上書きする
+    """
+
+    def __init__(self, event):
+        self.__event = event
+        self.__storage = inventory_view_store
+
+    def update(self, state, version):
+        view = {
+            'item_id': self.__event['item_id'],
+            'version': version,
+            'name': self.__event['name'],
+            'state': state,
+            'updated_at': str(datetime.datetime.utcnow()),
+        }
+        try:
+            with raise_for_save_exception(self.__event['item_id']):
+                self.__storage.put_if_newer(view)
+        except IntegrityError:
+            logger.info('InventoryView is up to date: {} {}'.format(
+                self.__event['item_id'], version))
+
+
 # --------------------------
 # snapshot Table
 # --------------------------
@@ -178,6 +340,21 @@ class DeduplicateEventModel(Model):
 
     item_id = UnicodeAttribute(hash_key=True)
     version = NumberAttribute(range_key=True)
+    # event_idを最初に記録したeventのversion
+    event_version = NumberAttribute(null=True)
+    # DynamoDB TTL (epoch秒)
+    expires_at = NumberAttribute(null=True)
+
+
+deduplication_store = get_backend(DeduplicateEventModel)
+
+# 重複排除rowを残す期間 (Streamsの保持期間 24h より十分長く)
+DEDUPLICATION_TTL = int(os.environ.get('DEDUPLICATION_TTL', str(7 * 86400)))
+
+# 最近見た event_id -> event_version
+# 同じcontainerで処理済みのevent_idはDynamoDBに問い合わせない
+recent_event_ids = LRUCache(
+    maxsize=int(os.environ.get('DEDUPLICATION_CACHE_SIZE', '100000')))
 
 
 class DeduplicateEvent:
@@ -185,23 +362,69 @@ class DeduplicateEvent:
     __item_suffix = '-deduplication'
 
     def __init__(self, event):
-        self.model = DeduplicateEventModel
+        self.storage = deduplication_store
         self.event = event
 
     def is_duplicate_event(self):
+        """
+        event_idをこのeventのversionで記録し、別のversionが既に記録していれば重複
+        同じversionの記録はStreamsの再送 (前回の処理が途中で失敗) なので
+        重複として扱わずにfoldさせる
+        """
+        event_version = recent_event_ids.get(self.event['event_id'])
+        if event_version is None:
+            event_version = self.__claim()
+            recent_event_ids.put(self.event['event_id'], event_version)
+
+        if event_version != self.event['version']:
+            logger.info('is_duplicate_event: {}'.format(self.event))
+            return True
+        return False
+
+    def was_duplicate_event(self):
+        """
+        以前のbatchで判定済みのeventが重複だったか (記録を読むだけ)
+        記録が無い (TTLで削除された) 場合は重複ではない
+        """
+        event_version = recent_event_ids.get(self.event['event_id'])
+        if event_version is None:
+            event_version = self.__get_claimed_version()
+            if event_version is None:
+                return False
+            recent_event_ids.put(self.event['event_id'], event_version)
+        return event_version != self.event['version']
+
+    def __claim(self):
+        """
+        条件付き書き込みで記録する 既に記録があればそのrowを読む
+        return: event_idを記録したeventのversion
+        """
         try:
-            deduplicate = self.model(
-                self.event['event_id'] + self.__item_suffix,
-                0)
             with raise_for_save_exception(self.event['event_id']):
-                deduplicate.save(
-                    condition=(self.model.item_id != self.event_id) &
-                              (self.model.version != 0)
-                )
-            return False
+                self.storage.append({
+                    'item_id': self.event_id,
+                    'version': 0,
+                    'event_version': self.event['version'],
+                    'expires_at': int(time.time()) + DEDUPLICATION_TTL,
+                })
+            return self.event['version']
         except IntegrityError:
-            logger.info('is_duplicate_event: {}'.format(self.event))
-            return True
+            event_version = self.__get_claimed_version()
+        if event_version is None:
+            # 書き込みと読み込みの間にTTLで削除された
+            return self.event['version']
+        return event_version
+
+    def __get_claimed_version(self):
+        """return: event_idを記録したeventのversion 記録が無ければNone"""
+        # 重複排除rowは version 0 (get_latestの範囲外) なのでkeyで読む
+        with raise_for_query_exception(self.event_id):
+            claimed = self.storage.get(self.event_id, 0,
+                                       consistent_read=True)
+        if claimed is None:
+            return None
+        # event_versionの無い古いrowは0 (常に重複) として扱う
+        return claimed.get('event_version') or 0
 
     @property
     def event_id(self):
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import datetime
+import os
+
+"""
+Snapshot Policy
+Snapshot.update() がsnapshotを書き込むかどうかを決める
+
+SNAPSHOT_POLICY (環境変数)
+    every_event     : eventごとに書き込む
+    every_n:<N>     : 前回のsnapshotからN event以上たまったら書き込む
+    interval:<T>    : 前回のsnapshotからT秒以上経過したら書き込む
+    adaptive:<ms>[:<cost_ms>]
+                    : event 1件あたりのreplayコストから見積もった
+                      tailのreplayコストが <ms> ミリ秒を超えたら書き込む
+
+adaptiveのコストは、event / query Lambdaがsnapshotからtailをreplayした時に
+計測してsnapshot rowに書く replay_cost_ms (escqrs.reconstruct参照) を使う。
+event / query Lambdaに REPLAY_COST_PUBLISH=true を設定する。
+まだ計測されていないsnapshotでは <cost_ms> (default 0.5) を使う。
+"""
+
+
+class EveryEventPolicy:
+
+    def should_snapshot(self, snapshot, latest_version):
+        return latest_version > snapshot['from_version']
+
+
+class EveryNEventsPolicy(EveryEventPolicy):
+
+    def __init__(self, n):
+        self.__n = n
+
+    def should_snapshot(self, snapshot, latest_version):
+        return latest_version - snapshot['from_version'] >= self.__n
+
+
+class IntervalPolicy(EveryEventPolicy):
+
+    __datetime_formats = ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S')
+
+    def __init__(self, seconds):
+        self.__interval = datetime.timedelta(seconds=seconds)
+
+    def should_snapshot(self, snapshot, latest_version):
+        if latest_version <= snapshot['from_version']:
+            return False
+        saved_at = self.__parse(snapshot.get('saved_at'))
+        if saved_at is None:
+            return True
+        return datetime.datetime.utcnow() - saved_at >= self.__interval
+
+    def __parse(self, saved_at):
+        for datetime_format in self.__datetime_formats:
+            try:
+                return datetime.datetime.strptime(saved_at, datetime_format)
+            except (TypeError, ValueError):
+                continue
+        return None
+
+
+class AdaptivePolicy(EveryEventPolicy):
+    """
+    readで計測したevent 1件あたりのreplayコスト (snapshotの replay_cost_ms)
+    から、snapshot以降のtailのreplayコストを見積もり、予算を超えたら書き込む
+    """
+
+    def __init__(self, budget_ms, initial_cost_ms=0.5, max_events=1000):
+        self.__budget_ms = budget_ms
+        self.__initial_cost_ms = initial_cost_ms
+        self.__max_events = max_events
+
+    def should_snapshot(self, snapshot, latest_version):
+        tail = latest_version - snapshot['from_version']
+        if tail <= 0:
+            return False
+        if tail >= self.__max_events:
+            return True
+        return tail * self.cost_ms(snapshot) >= self.__budget_ms
+
+    def cost_ms(self, snapshot):
+        cost_ms = snapshot.get('replay_cost_ms')
+        if cost_ms is None:
+            return self.__initial_cost_ms
+        return cost_ms
+
+
+def get_policy(spec=None):
+    spec = spec or os.environ.get('SNAPSHOT_POLICY', 'every_event')
+    name, _, arg = spec.partition(':')
+    if name == 'every_event':
+        return EveryEventPolicy()
+    if name == 'every_n':
+        return EveryNEventsPolicy(int(arg))
+    if name == 'interval':
+        return IntervalPolicy(float(arg))
+    if name == 'adaptive':
+        budget_ms, _, cost_ms = arg.partition(':')
+        if cost_ms:
+            return AdaptivePolicy(float(budget_ms),
+                                  initial_cost_ms=float(cost_ms))
+        return AdaptivePolicy(float(budget_ms))
+    raise ValueError('unknown SNAPSHOT_POLICY: {}'.format(spec))
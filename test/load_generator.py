@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+import argparse
+import base64
+import bisect
+import copy
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from scenario import base_event, e2e_events
+
+"""
+Load Generator
+EventFunctionにcommandを並行に送り、latencyの分布と
+ItemRanShort / 楽観ロック競合(ConditionalCheckFailed)の発生率を記録する
+再送されたcommandがguard rowで弾かれたConditionalCheckFailedは
+楽観ロック競合と分けて duplicate_conflicts に数える
+
+    # 実際のLambdaに送る
+    $ python test/load_generator.py --target lambda \\
+        --function-name EventFunction --commands 5000 --concurrency 64
+    # 同じprocess内のhandlerに送る (EVENT_STORE_BACKENDのbackendを使う)
+    $ python test/load_generator.py --target inprocess --backend sqlite \\
+        --items 100 --zipf 1.2 --duplicate-ratio 0.05
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Lambdaのlogに出るmessage
+RAN_SHORT_MESSAGE = 'publish RanShort'
+CONFLICT_MESSAGE = 'ConditionalCheckFailedException'
+DUPLICATE_MESSAGE = 'duplicate command'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='EventFunction load generator')
+    parser.add_argument('--target', choices=['lambda', 'inprocess'],
+                        default='inprocess')
+    parser.add_argument('--function-name',
+                        default=os.environ.get('EVENT_FUNCTION',
+                                               'EventFunction'))
+    parser.add_argument('--backend', default='memory',
+                        help='inprocessで使うEVENT_STORE_BACKEND')
+    parser.add_argument('--scenario', choices=['load', 'e2e'],
+                        default='load')
+    parser.add_argument('--commands', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--items', type=int, default=100)
+    parser.add_argument('--zipf', type=float, default=1.1,
+                        help='item選択のZipf指数 (0で一様)')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.0)
+    parser.add_argument('--initial-stock', type=int, default=100)
+    parser.add_argument('--quantity', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', help='結果のJSONを書き込むfile')
+    return parser.parse_args(argv)
+
+
+class ZipfItems:
+    """item_id 1..n を Zipf(s) の重みで選ぶ"""
+
+    def __init__(self, n, s, rnd):
+        self.__random = rnd
+        self.__cumulative = []
+        total = 0.0
+        for rank in range(1, n + 1):
+            total += 1.0 / rank ** s
+            self.__cumulative.append(total)
+
+    def choice(self):
+        point = self.__random.random() * self.__cumulative[-1]
+        return bisect.bisect_left(self.__cumulative, point) + 1
+
+
+def make_commands(options, rnd):
+    """(seed commands, measured commands)"""
+    if options.scenario == 'e2e':
+        return [], [base_event(e) for e in e2e_events()]
+
+    seeds = [base_event(dict(item_id=i, event_type='stock_add',
+                             quantity=options.initial_stock))
+             for i in range(1, options.items + 1)]
+    items = ZipfItems(options.items, options.zipf, rnd)
+    commands = []
+    for _ in range(options.commands):
+        if commands and rnd.random() < options.duplicate_ratio:
+            # 同じevent_idの再送
+            commands.append(copy.deepcopy(rnd.choice(commands)))
+            continue
+        commands.append(base_event(dict(item_id=items.choice(),
+                                        event_type='item_reserve',
+                                        quantity=options.quantity)))
+    return seeds, commands
+
+
+class LambdaTarget:
+
+    def __init__(self, function_name):
+        import boto3
+        self.__client = boto3.client('lambda')
+        self.__function_name = function_name
+
+    def send(self, command):
+        response = self.__client.invoke(
+            FunctionName=self.__function_name,
+            InvocationType='RequestResponse',
+            LogType='Tail',
+            Payload=json.dumps(command))
+        log = base64.b64decode(response.get('LogResult', '')).decode(
+            'utf-8', 'replace')
+        return 'FunctionError' not in response, log.splitlines()
+
+
+class LogCapture(logging.Handler):
+    """thread単位でlog messageを集める"""
+
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.__local = threading.local()
+
+    def emit(self, record):
+        lines = getattr(self.__local, 'lines', None)
+        if lines is not None:
+            lines.append(record.getMessage())
+
+    def start(self):
+        self.__local.lines = []
+
+    def stop(self):
+        lines, self.__local.lines = self.__local.lines, None
+        return lines
+
+
+class InProcessTarget:
+
+    def __init__(self, backend):
+        os.environ['EVENT_STORE_BACKEND'] = backend
+        sys.path.insert(0, os.path.join(ROOT, 'benchmark'))
+        import services
+        self.__handler = services.Service('event').lambda_handler
+        self.__capture = LogCapture()
+        logging.getLogger().addHandler(self.__capture)
+
+    def send(self, command):
+        self.__capture.start()
+        try:
+            self.__handler(command, None)
+            return True, self.__capture.stop()
+        except Exception:
+            self.__capture.stop()
+            return False, []
+
+
+class Recorder:
+
+    # latency histogramのbucket上限 (ms)
+    buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+        self.ran_short = 0
+        self.conflicts = 0
+        self.duplicate_conflicts = 0
+
+    def record(self, latency, ok, lines):
+        with self.__lock:
+            self.latencies.append(latency)
+            if not ok:
+                self.errors += 1
+            self.ran_short += sum(RAN_SHORT_MESSAGE in line for line in lines)
+            conflicts = sum(CONFLICT_MESSAGE in line for line in lines)
+            if conflicts and \
+                    any(DUPLICATE_MESSAGE in line for line in lines):
+                # 最後のConditionalCheckFailedは受付済みのguard rowとの衝突
+                conflicts -= 1
+                self.duplicate_conflicts += 1
+            self.conflicts += conflicts
+
+    def histogram(self):
+        counts = [0] * (len(self.buckets) + 1)
+        for latency in self.latencies:
+            counts[bisect.bisect_left(self.buckets, latency * 1000)] += 1
+        upper_bounds = list(self.buckets) + [None]
+        return [{'le_ms': upper, 'count': count}
+                for upper, count in zip(upper_bounds, counts)]
+
+    def percentile(self, q):
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1,
+                    int(round(q / 100.0 * (len(ordered) - 1))))
+        return round(ordered[index] * 1000, 3)
+
+    def summary(self, elapsed):
+        count = len(self.latencies)
+        return {
+            'commands': count,
+            'errors': self.errors,
+            'elapsed_s': round(elapsed, 3),
+            'throughput_per_s': round(count / elapsed, 3) if elapsed else None,
+            'p50_ms': self.percentile(50) if count else None,
+            'p90_ms': self.percentile(90) if count else None,
+            'p99_ms': self.percentile(99) if count else None,
+            'ran_short': self.ran_short,
+            'ran_short_rate': round(self.ran_short / count, 4)
+            if count else None,
+            'conflicts': self.conflicts,
+            'conflict_rate': round(self.conflicts / count, 4)
+            if count else None,
+            'duplicate_conflicts': self.duplicate_conflicts,
+            'histogram': self.histogram(),
+        }
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    rnd = random.Random(options.seed)
+    if options.target == 'lambda':
+        target = LambdaTarget(options.function_name)
+    else:
+        target = InProcessTarget(options.backend)
+
+    seeds, commands = make_commands(options, rnd)
+    for command in seeds:
+        target.send(command)
+
+    recorder = Recorder()
+
+    def send(command):
+        started = time.perf_counter()
+        ok, lines = target.send(command)
+        recorder.record(time.perf_counter() - started, ok, lines)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=options.concurrency) as executor:
+        list(executor.map(send, commands))
+    result = recorder.summary(time.perf_counter() - started)
+    result['options'] = vars(options)
+
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import uuid
+import datetime
+
+
+def base_event(data):
+    event = dict(
+        item_id=str(data['item_id']).zfill(8),
+        event_type=data['event_type'],
+        name='Product {}'.format(data['item_id']),
+        quantity=data['quantity'],
+        fired_at=str(datetime.datetime.utcnow())
+    )
+    if data['event_type'] != 'stock_add':
+        event['order_id'] = str(uuid.uuid4())
+
+    event['event_id'] = data.get('event_id', str(uuid.uuid4()))
+
+    return event
+
+
+events1 = [
+    dict(item_id=1, event_type='stock_add', quantity=20),
+]
+
+
+def make_duplication_events():
+    event_id = str(uuid.uuid4())
+    _events = list()
+    for _ in range(3):
+        _events.append(dict(item_id=1, event_type='item_reserve',
+                            quantity=1, event_id=event_id))
+    _events.append(dict(item_id=1, event_type='item_reserve_complete',
+                        quantity=1))
+    return _events
+
+
+events3 = [
+    dict(item_id=1, event_type='item_reserve', quantity=3),
+    dict(item_id=1, event_type='item_reserve_complete', quantity=3)
+]
+
+events4 = [
+    dict(item_id=1, event_type='item_reserve', quantity=5),
+    dict(item_id=1, event_type='item_reserve_cancel', quantity=5)
+]
+
+events5 = [
+    dict(item_id=1, event_type='item_reserve', quantity=5),
+    dict(item_id=1, event_type='item_reserve_complete', quantity=5)
+]
+
+
+def e2e_events():
+    events2 = make_duplication_events()
+    return events1 + events2 + events3 + events4 + events5
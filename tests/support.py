@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import importlib
+import os
+import sys
+
+"""
+testからLambdaのmoduleを読み込む
+
+各serviceは model.py などの同名moduleをflatにimportするため、
+serviceごとにsys.pathを切り替えて読み込み、読み込み後にsys.modulesから外す
+backendは EVENT_STORE_BACKEND=memory (InMemoryBackend.clear()で空にする)
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAYER = os.path.join(ROOT, 'lambda', 'layer', 'python')
+if LAYER not in sys.path:
+    sys.path.insert(0, LAYER)
+os.environ.setdefault('EVENT_STORE_BACKEND', 'memory')
+os.environ.setdefault('AWS_XRAY_SDK_ENABLED', 'false')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'ap-northeast-1')
+
+
+class Service:
+    """serviceのmoduleを name -> module で持つ"""
+
+    def __init__(self, name, entry='lambda_function'):
+        self.directory = os.path.join(ROOT, name)
+        self.modules = {}
+        sys.path.insert(0, self.directory)
+        try:
+            importlib.import_module(entry)
+        finally:
+            sys.path.remove(self.directory)
+            for module_name, module in list(sys.modules.items()):
+                if self.__is_service_module(module):
+                    self.modules[module_name] = sys.modules.pop(module_name)
+
+    def __is_service_module(self, module):
+        path = getattr(module, '__file__', None) or ''
+        return os.path.dirname(os.path.abspath(path)) == self.directory
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['modules'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def clear_caches(self):
+        """warm containerのcacheを捨てて cold 相当にする"""
+        for module in self.modules.values():
+            for value in vars(module).values():
+                if type(value).__name__ == 'LRUCache':
+                    value.clear()
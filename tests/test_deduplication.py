@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest import mock
+
+"""
+snapshot LambdaのDeduplicateEvent (event_idの重複排除) の確認
+
+    $ python -m unittest discover tests
+"""
+
+import support  # noqa: E402
+from escqrs.storage.memory import InMemoryBackend  # noqa: E402
+
+ITEM_ID = 'item-1'
+
+
+def event(version, event_id, quantity=1, event_type='stock_add'):
+    return {
+        'item_id': ITEM_ID,
+        'version': version,
+        'event_id': event_id,
+        'event_type': event_type,
+        'name': 'test item',
+        'quantity': quantity,
+        'fired_at': '2026-01-01 00:00:00',
+        'saved_at': '2026-01-01 00:00:00',
+    }
+
+
+class DeduplicateEventTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.snapshot = support.Service('snapshot')
+
+    def setUp(self):
+        InMemoryBackend.clear()
+        self.snapshot.clear_caches()
+
+    def update(self, *events):
+        # EventStoreにも書いておく (tailの読み直しに使われる)
+        self.snapshot.model.event_store.batch_write(list(events))
+        return self.snapshot.event_handler.EventHandler(list(events)).update()
+
+    def view_state(self):
+        view = self.snapshot.model.inventory_view_store.get_item(ITEM_ID)
+        return view['state']['available'], view['version']
+
+    def test_new_events_are_claimed_without_reading(self):
+        store = self.snapshot.model.deduplication_store
+        with mock.patch.object(store, 'get', wraps=store.get) as get, \
+                mock.patch.object(store, 'append',
+                                  wraps=store.append) as append:
+            self.update(event(1, 'event-1', 2), event(2, 'event-2', 3))
+        # 新しいeventは条件付き書き込み1回だけ
+        self.assertEqual(append.call_count, 2)
+        self.assertEqual(get.call_count, 0)
+        self.assertEqual(self.view_state(), (5, 2))
+
+    def test_same_event_id_at_another_version_is_not_folded(self):
+        self.update(event(1, 'event-1', 2))
+        self.update(event(2, 'event-1', 2), event(3, 'event-2', 3))
+        self.assertEqual(self.view_state(), (5, 3))
+
+        # cold containerでは重複排除rowを読んで判定する
+        self.snapshot.clear_caches()
+        store = self.snapshot.model.deduplication_store
+        with mock.patch.object(store, 'get', wraps=store.get) as get:
+            self.update(event(4, 'event-1', 2), event(5, 'event-3', 1))
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(self.view_state(), (6, 5))
+
+    def test_same_event_id_within_batch(self):
+        self.update(event(1, 'event-1', 2), event(2, 'event-1', 2),
+                    event(3, 'event-2', 1))
+        self.assertEqual(self.view_state(), (3, 3))
+
+    def test_redelivered_batch_after_failure_is_folded_once(self):
+        self.update(event(1, 'event-1', 1))
+        batch = (event(2, 'event-2', 2), event(3, 'event-3', 3))
+        store = self.snapshot.model.snapshot_store
+        with mock.patch.object(store, 'append',
+                               side_effect=RuntimeError('throttled')):
+            with self.assertRaises(RuntimeError):
+                self.update(*batch)
+
+        # 記録済みのevent_idは同じversionなので重複にならない
+        for clear_caches in (False, True):
+            with self.subTest(clear_caches=clear_caches):
+                if clear_caches:
+                    self.snapshot.clear_caches()
+                self.update(*batch)
+                self.assertEqual(self.view_state(), (6, 3))
+                latest = store.get_latest(ITEM_ID + '-snapshot')
+                self.assertEqual(latest['from_version'], 3)
+                self.assertEqual(latest['state']['available'], 6)
+
+    def test_tail_event_duplicating_an_event_before_the_snapshot(self):
+        policy = self.snapshot.snapshot_policy.EveryNEventsPolicy(2)
+        with mock.patch.object(self.snapshot.model, 'snapshot_policy',
+                               policy):
+            self.update(event(1, 'event-1', 2), event(2, 'event-2', 3))
+            # snapshot (from_version 2) の後、v3はv1の重複
+            self.update(event(3, 'event-1', 2))
+            self.assertEqual(self.view_state(), (5, 3))
+
+            # cold containerではv3をEventStoreから読み直す
+            self.snapshot.clear_caches()
+            self.update(event(4, 'event-3', 1))
+        self.assertEqual(self.view_state(), (6, 4))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest import mock
+
+"""
+batch_controllerのpartitionの一部が失敗した場合の結果と、
+GROUP_COMMITの有無で同じになるcommandごとの結果の確認
+
+    $ python -m unittest discover tests
+"""
+
+import support  # noqa: E402
+from escqrs.storage.memory import InMemoryBackend  # noqa: E402
+
+ITEM_ID = 'item-1'
+
+
+def command(event_id, event_type='stock_add', quantity=1):
+    return {
+        'item_id': ITEM_ID,
+        'event_id': event_id,
+        'event_type': event_type,
+        'name': 'test item',
+        'quantity': quantity,
+        'fired_at': '2026-01-01 00:00:00',
+    }
+
+
+class GroupCommitTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.event = support.Service('event')
+
+    def setUp(self):
+        InMemoryBackend.clear()
+        self.event.clear_caches()
+
+    def send(self, *commands, group_commit=True):
+        """return: [(result, version)]"""
+        with mock.patch.object(self.event.lambda_function, 'GROUP_COMMIT',
+                               group_commit):
+            return [(outcome['result'], outcome.get('version'))
+                    for outcome in
+                    self.event.lambda_function.batch_controller(
+                        list(commands))]
+
+    def fail_after(self, transactions):
+        """transactions回目より後のtransactionを失敗させる"""
+        store = self.event.model.event_store
+        transact_append = store.transact_append
+        calls = []
+
+        def side_effect(items):
+            calls.append(items)
+            if len(calls) > transactions:
+                raise RuntimeError('throttled')
+            return transact_append(items)
+        return mock.patch.object(store, 'transact_append',
+                                 side_effect=side_effect)
+
+    def stored_versions(self):
+        return [event['version'] for event in
+                self.event.model.event_store.query(ITEM_ID)]
+
+    def test_persisted_chunks_keep_their_outcomes(self):
+        store = self.event.model.event_store
+        commands = [command('event-{}'.format(index)) for index in range(5)]
+        # guard rowと合わせて 1 transactionに2 eventずつ書き込む
+        with mock.patch.object(store, 'max_transaction_items', 4), \
+                self.fail_after(1):
+            outcomes = self.send(*commands)
+        self.assertEqual(outcomes, [('accepted', 1), ('accepted', 2),
+                                    ('error', None), ('error', None),
+                                    ('error', None)])
+        self.assertEqual(self.stored_versions(), [1, 2])
+
+        # 失敗したcommandだけを再送する
+        self.assertEqual(self.send(*commands),
+                         [('accepted', version) for version in range(1, 6)])
+        self.assertEqual(self.stored_versions(), [1, 2, 3, 4, 5])
+
+    def test_commands_after_a_failure_are_not_applied(self):
+        commands = [command('event-{}'.format(index)) for index in range(3)]
+        with self.fail_after(1):
+            outcomes = self.send(*commands, group_commit=False)
+        self.assertEqual(outcomes, [('accepted', 1), ('error', None),
+                                    ('error', None)])
+        self.assertEqual(self.stored_versions(), [1])
+
+    def test_unknown_event_type_is_ignored(self):
+        for group_commit in (True, False):
+            with self.subTest(group_commit=group_commit):
+                InMemoryBackend.clear()
+                self.event.clear_caches()
+                outcomes = self.send(
+                    command('event-1'),
+                    command('event-2', 'stock_unknown'),
+                    command('event-3', 'item_reserve'),
+                    group_commit=group_commit)
+                self.assertEqual(outcomes, [('accepted', 1),
+                                            ('ignored', None),
+                                            ('accepted', 2)])
+                self.assertEqual(self.stored_versions(), [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest import mock
+
+"""
+event_idをidempotency keyにしたcommandの受付 (guard row) の確認
+
+    $ python -m unittest discover tests
+"""
+
+import support  # noqa: E402
+from pynamodb.connection.base import Connection  # noqa: E402
+from escqrs.storage.dynamodb import DynamoDBBackend  # noqa: E402
+from escqrs.storage.memory import InMemoryBackend  # noqa: E402
+
+ITEM_ID = 'item-1'
+
+
+def command(event_id, event_type='stock_add', quantity=1, item_id=ITEM_ID):
+    return {
+        'item_id': item_id,
+        'event_id': event_id,
+        'event_type': event_type,
+        'name': 'test item',
+        'quantity': quantity,
+        'fired_at': '2026-01-01 00:00:00',
+    }
+
+
+class IdempotencyTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.event = support.Service('event')
+
+    def setUp(self):
+        InMemoryBackend.clear()
+        self.event.clear_caches()
+
+    def send(self, *commands):
+        """return: [(result, version)]"""
+        return [(outcome['result'], outcome.get('version'))
+                for outcome in self.event.lambda_function.batch_controller(
+                    list(commands))]
+
+    def stored_events(self, item_id=ITEM_ID):
+        return self.event.model.event_store.query(item_id)
+
+    def test_guard_row_is_written_with_idempotency_key_model(self):
+        # DynamoDBBackendでTransactWriteItemsのrequestまで組み立てる
+        model = self.event.model
+        requests = []
+
+        def dispatch(operation_name, operation_kwargs):
+            requests.append((operation_name, operation_kwargs))
+            return {}
+
+        with mock.patch.object(Connection, 'dispatch', side_effect=dispatch), \
+                mock.patch.object(model, 'event_store',
+                                  DynamoDBBackend(model.EventStoreModel)):
+            model.EventStore(command('event-1')).persist(0)
+
+        self.assertEqual([name for name, _ in requests],
+                         ['TransactWriteItems'])
+        event, guard = [item['Put']
+                        for item in requests[0][1]['TransactItems']]
+        self.assertEqual(event['Item']['item_id'], {'S': ITEM_ID})
+        self.assertEqual(event['Item']['version'], {'N': '1'})
+        self.assertEqual(guard['Item']['item_id'],
+                         {'S': 'event-1-idempotency'})
+        self.assertEqual(guard['Item']['version'], {'N': '0'})
+        self.assertEqual(guard['Item']['event_item_id'], {'S': ITEM_ID})
+        self.assertEqual(guard['Item']['event_version'], {'N': '1'})
+        self.assertIn('expires_at', guard['Item'])
+        for put in (event, guard):
+            self.assertEqual(put['TableName'], 'EventStore')
+            self.assertIn('attribute_not_exists', put['ConditionExpression'])
+
+    def test_resend_returns_original_version(self):
+        self.assertEqual(self.send(command('event-1'), command('event-2')),
+                         [('accepted', 1), ('accepted', 2)])
+        # warm containerの再送はcacheで、cold containerはguard rowで判定する
+        self.assertEqual(self.send(command('event-1')), [('accepted', 1)])
+        self.event.clear_caches()
+        self.assertEqual(self.send(command('event-1')), [('accepted', 1)])
+        self.assertEqual(len(self.stored_events()), 2)
+
+    def test_resend_within_batch(self):
+        self.assertEqual(self.send(command('event-1'), command('event-1')),
+                         [('accepted', 1), ('accepted', 1)])
+        self.assertEqual(len(self.stored_events()), 1)
+
+    def test_resent_reserve_is_not_ran_short(self):
+        self.send(command('event-1', quantity=2))
+        self.assertEqual(
+            self.send(command('event-2', 'item_reserve', quantity=2)),
+            [('accepted', 2)])
+        # 在庫は0だが、受付済みのreserveの再送なので元のversionを返す
+        self.event.clear_caches()
+        self.assertEqual(
+            self.send(command('event-2', 'item_reserve', quantity=2)),
+            [('accepted', 2)])
+        self.assertEqual(
+            self.send(command('event-3', 'item_reserve', quantity=1)),
+            [('ran_short', None)])
+
+    def test_group_commit_resend(self):
+        lambda_function = self.event.lambda_function
+        with mock.patch.object(lambda_function, 'GROUP_COMMIT', True):
+            self.assertEqual(
+                self.send(command('event-1'), command('event-1'),
+                          command('event-2')),
+                [('accepted', 1), ('accepted', 1), ('accepted', 2)])
+            self.event.clear_caches()
+            self.assertEqual(
+                self.send(command('event-2'), command('event-3')),
+                [('accepted', 2), ('accepted', 3)])
+        self.assertEqual(
+            [event['event_id'] for event in self.stored_events()],
+            ['event-1', 'event-2', 'event-3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import copy
+import itertools
+import sys
+import unittest
+from functools import reduce
+
+"""
+ReplayEngine (vectorized / scalar / replay_rows) が State.apply で
+1件ずつfoldした結果と一致することの確認
+
+    $ python -m unittest discover tests
+"""
+
+import support  # noqa: E402
+from escqrs import replay  # noqa: E402
+from escqrs.replay import ReplayEngine, VECTORIZE_THRESHOLD  # noqa: E402
+
+# State を持つservice (同じ名前のmodel.pyをflatにimportする)
+SERVICES = ('event', 'query', 'snapshot')
+
+# 全てのevent_type (prefixの違うものも含む)
+EVENT_TYPES = (
+    'stock_add',
+    'item_reserve',
+    'item_reserve_complete',
+    'item_reserve_cancel',
+    'rebalance_withdraw',
+    'rebalance_add',
+)
+
+INITIAL_STATE = {'available': 100, 'reserved': 5, 'bought': 3}
+
+
+def load_state_class(service):
+    return support.Service(service, 'model').model.State
+
+
+def make_events(count):
+    """event_typeを順に回し、quantityは 1..7 を繰り返す"""
+    types = itertools.cycle(EVENT_TYPES)
+    return [{'version': version,
+             'event_type': next(types),
+             'quantity': version % 7 + 1}
+            for version in range(1, count + 1)]
+
+
+def to_rows(events):
+    return [tuple(event[name] for name in replay.REPLAY_ATTRIBUTES)
+            for event in events]
+
+
+class CountingApply:
+    """State.applyを呼んだ回数を数える (scalarでfoldしたかどうか)"""
+
+    def __init__(self, apply):
+        self.apply = apply
+        self.calls = 0
+
+    def __call__(self, state, event):
+        self.calls += 1
+        return self.apply(state, event)
+
+
+class ReplayEngineTest(unittest.TestCase):
+
+    SIZES = (0, 1, len(EVENT_TYPES), VECTORIZE_THRESHOLD - 1,
+             VECTORIZE_THRESHOLD, VECTORIZE_THRESHOLD * 4 + 3)
+
+    @classmethod
+    def setUpClass(cls):
+        cls.states = {service: load_state_class(service)()
+                      for service in SERVICES}
+
+    def setUp(self):
+        self.numpy = replay._numpy
+
+    def tearDown(self):
+        replay._numpy = self.numpy
+
+    def expected(self, state, events):
+        return reduce(state.apply, copy.deepcopy(events),
+                      dict(INITIAL_STATE))
+
+    def test_replay_matches_state_apply(self):
+        for service, state in self.states.items():
+            for size in self.SIZES:
+                with self.subTest(service=service, size=size):
+                    events = make_events(size)
+                    apply = CountingApply(state.apply)
+                    actual = ReplayEngine(apply).replay(
+                        dict(INITIAL_STATE), events)
+                    self.assertEqual(actual, self.expected(state, events))
+                    # threshold以上はvectorizeし、State.applyを呼ばない
+                    self.assertEqual(
+                        apply.calls,
+                        0 if size >= VECTORIZE_THRESHOLD else size)
+
+    def test_replay_rows_matches_state_apply(self):
+        for service, state in self.states.items():
+            for size in self.SIZES:
+                with self.subTest(service=service, size=size):
+                    events = make_events(size)
+                    apply = CountingApply(state.apply)
+                    actual = ReplayEngine(apply).replay_rows(
+                        dict(INITIAL_STATE), to_rows(events))
+                    self.assertEqual(actual, self.expected(state, events))
+                    self.assertEqual(
+                        apply.calls,
+                        0 if size >= VECTORIZE_THRESHOLD else size)
+
+    def test_pages_return_last_version(self):
+        state = self.states['query']
+        events = make_events(VECTORIZE_THRESHOLD * 2 + 10)
+        pages = [events[:VECTORIZE_THRESHOLD + 5], [],
+                 events[VECTORIZE_THRESHOLD + 5:]]
+        engine = ReplayEngine(state.apply)
+
+        actual, last_version = engine.replay_pages(
+            dict(INITIAL_STATE), pages)
+        self.assertEqual(actual, self.expected(state, events))
+        self.assertEqual(last_version, events[-1]['version'])
+
+        actual, last_version = engine.replay_row_pages(
+            dict(INITIAL_STATE), [to_rows(page) for page in pages])
+        self.assertEqual(actual, self.expected(state, events))
+        self.assertEqual(last_version, events[-1]['version'])
+
+        self.assertEqual(engine.replay_row_pages(dict(INITIAL_STATE), [[]]),
+                         (INITIAL_STATE, None))
+
+    def test_non_integer_quantity_falls_back_to_scalar(self):
+        state = self.states['event']
+        events = make_events(VECTORIZE_THRESHOLD)
+        events[3]['quantity'] = 1.5
+        apply = CountingApply(state.apply)
+        actual = ReplayEngine(apply).replay(dict(INITIAL_STATE), events)
+        self.assertEqual(actual, self.expected(state, events))
+        self.assertEqual(apply.calls, len(events))
+
+    def test_without_numpy(self):
+        # numpyのimportに失敗する環境 (sys.modulesのNoneはImportErrorになる)
+        replay._numpy = False
+        saved = sys.modules.get('numpy')
+        sys.modules['numpy'] = None
+        try:
+            self.assertIsNone(replay.get_numpy())
+        finally:
+            if saved is None:
+                del sys.modules['numpy']
+            else:
+                sys.modules['numpy'] = saved
+
+        for service, state in self.states.items():
+            with self.subTest(service=service):
+                events = make_events(VECTORIZE_THRESHOLD * 2)
+                apply = CountingApply(state.apply)
+                engine = ReplayEngine(apply)
+                self.assertEqual(
+                    engine.replay(dict(INITIAL_STATE), events),
+                    self.expected(state, events))
+                self.assertEqual(
+                    engine.replay_rows(dict(INITIAL_STATE), to_rows(events)),
+                    self.expected(state, events))
+                self.assertEqual(apply.calls, 2 * len(events))
+
+
+if __name__ == '__main__':
+    unittest.main()
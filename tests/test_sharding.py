@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+from unittest import mock
+
+"""
+hot itemのsharding (commandのrouting、shard間の在庫移動、queryの合算) の確認
+
+    $ python -m unittest discover tests
+"""
+
+import support  # noqa: E402
+from escqrs import sharding  # noqa: E402
+from escqrs.storage.memory import InMemoryBackend  # noqa: E402
+
+ITEM_ID = 'hot-item'
+SHARDS = 4
+
+
+def command(event_id, event_type='stock_add', quantity=1, order_id=None):
+    return {
+        'item_id': ITEM_ID,
+        'event_id': event_id,
+        'event_type': event_type,
+        'name': 'hot item',
+        'quantity': quantity,
+        'fired_at': '2026-01-01 00:00:00',
+        'order_id': order_id,
+    }
+
+
+class ShardingTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.event = support.Service('event')
+        cls.query = support.Service('query')
+
+    def setUp(self):
+        InMemoryBackend.clear()
+        self.event.clear_caches()
+        self.query.clear_caches()
+        patcher = mock.patch.dict(sharding.SHARDED_ITEMS, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def shard(self, shards=SHARDS):
+        sharding.SHARDED_ITEMS[ITEM_ID] = shards
+
+    def send(self, *commands):
+        return [outcome['result'] for outcome in
+                self.event.lambda_function.batch_controller(list(commands))]
+
+    def stored_state(self, item_id):
+        state = {'available': 0, 'reserved': 0, 'bought': 0}
+        for event in self.event.model.event_store.query(item_id):
+            state = self.event.model.State().apply(state, event)
+        return state
+
+    def get_inventory(self):
+        response = self.query.lambda_function.lambda_handler({
+            'path': '/inventory',
+            'httpMethod': 'GET',
+            'queryStringParameters': {'item_id': ITEM_ID,
+                                      'consistency': 'strong'},
+        }, None)
+        self.assertEqual(response['statusCode'], 200)
+        return json.loads(response['body'])
+
+    def test_same_order_goes_to_same_shard(self):
+        self.shard()
+        routed = [self.event.event_handler.route(
+            command('event-{}'.format(index), 'item_reserve_complete',
+                    order_id='order-1'))['item_id']
+                  for index in range(5)]
+        self.assertEqual(len(set(routed)), 1)
+        self.assertIn(routed[0], sharding.shard_item_ids(ITEM_ID))
+
+    def test_reserve_moves_stock_from_other_shards(self):
+        self.shard()
+        self.assertEqual(self.send(command('add-1', quantity=8,
+                                           order_id='order-1')),
+                         ['accepted'])
+        for index in range(4):
+            self.assertEqual(
+                self.send(command('reserve-{}'.format(index), 'item_reserve',
+                                  quantity=2,
+                                  order_id='order-{}'.format(index))),
+                ['accepted'])
+        self.assertEqual(
+            self.send(command('reserve-9', 'item_reserve', quantity=1,
+                              order_id='order-9')),
+            ['ran_short'])
+        for item_id in sharding.shard_item_ids(ITEM_ID):
+            self.assertGreaterEqual(self.stored_state(item_id)['available'],
+                                    0)
+        self.assertEqual(self.get_inventory()['state'],
+                         {'available': 0, 'reserved': 8, 'bought': 0})
+
+    def test_stock_added_before_sharding_is_used(self):
+        # shardする前のeventはbase itemに残る
+        self.assertEqual(self.send(command('add-1', quantity=10),
+                                   command('reserve-1', 'item_reserve',
+                                           quantity=4)),
+                         ['accepted', 'accepted'])
+        self.shard()
+        self.assertEqual(self.get_inventory()['state'],
+                         {'available': 6, 'reserved': 4, 'bought': 0})
+
+        # base itemから在庫を移して予約する
+        self.assertEqual(
+            self.send(command('reserve-2', 'item_reserve', quantity=5,
+                              order_id='order-2')),
+            ['accepted'])
+        self.assertLess(self.stored_state(ITEM_ID)['available'], 6)
+        # shardする前の予約のcompleteは別のshardに書かれても合計は正しい
+        self.assertEqual(
+            self.send(command('complete-1', 'item_reserve_complete',
+                              quantity=4, order_id='order-1')),
+            ['accepted'])
+        self.assertEqual(self.get_inventory()['state'],
+                         {'available': 1, 'reserved': 5, 'bought': 4})
+        self.assertEqual(
+            self.send(command('reserve-3', 'item_reserve', quantity=2,
+                              order_id='order-3')),
+            ['ran_short'])
+
+
+if __name__ == '__main__':
+    unittest.main()
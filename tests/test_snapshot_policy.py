@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+from unittest import mock
+
+"""
+SNAPSHOT_POLICY=adaptive と、readで計測したreplayコスト (replay_cost_ms) の確認
+
+    $ python -m unittest discover tests
+"""
+
+import support  # noqa: E402
+from escqrs import reconstruct  # noqa: E402
+from escqrs.storage.memory import InMemoryBackend  # noqa: E402
+
+ITEM_ID = 'item-1'
+SNAPSHOT_ID = ITEM_ID + '-snapshot'
+
+
+def event(version, quantity=1):
+    return {
+        'item_id': ITEM_ID,
+        'version': version,
+        'event_id': 'event-{}'.format(version),
+        'event_type': 'stock_add',
+        'name': 'test item',
+        'quantity': quantity,
+        'fired_at': '2026-01-01 00:00:00',
+        'saved_at': '2026-01-01 00:00:00',
+    }
+
+
+def snapshot(version, from_version, available, **attributes):
+    return dict({
+        'item_id': SNAPSHOT_ID,
+        'version': version,
+        'from_version': from_version,
+        'name': 'test item',
+        'state': {'available': available, 'reserved': 0, 'bought': 0},
+        'saved_at': '2026-01-01 00:00:00',
+    }, **attributes)
+
+
+class AdaptivePolicyTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.snapshot = support.Service('snapshot')
+        cls.query = support.Service('query')
+
+    def setUp(self):
+        InMemoryBackend.clear()
+        self.snapshot.clear_caches()
+        self.query.clear_caches()
+        reconstruct.snapshot_hints.clear()
+        reconstruct.published_replay_costs.clear()
+
+    def policy(self, budget_ms, cost_ms=0.5):
+        return self.snapshot.snapshot_policy.AdaptivePolicy(
+            budget_ms, initial_cost_ms=cost_ms)
+
+    def get_inventory(self):
+        response = self.query.lambda_function.lambda_handler({
+            'path': '/inventory',
+            'httpMethod': 'GET',
+            'queryStringParameters': {'item_id': ITEM_ID,
+                                      'consistency': 'strong'},
+        }, None)
+        return json.loads(response['body'])
+
+    def test_policy_uses_published_cost(self):
+        policy = self.policy(10)
+        # 計測前は初期値 0.5 ms/event
+        self.assertFalse(policy.should_snapshot({'from_version': 0}, 10))
+        self.assertTrue(policy.should_snapshot({'from_version': 0}, 20))
+        measured = {'from_version': 0, 'replay_cost_ms': 2.0}
+        self.assertFalse(policy.should_snapshot(measured, 4))
+        self.assertTrue(policy.should_snapshot(measured, 5))
+
+    def test_reader_publishes_replay_cost(self):
+        store = self.query.model.snapshot_store
+        store.append(snapshot(1, 0, 0))
+        self.query.model.event_store.batch_write(
+            [event(version) for version in range(1, 16)])
+
+        with mock.patch.object(reconstruct, 'REPLAY_COST_PUBLISH', True), \
+                mock.patch.object(store, 'set_attributes',
+                                  wraps=store.set_attributes) as publish:
+            self.assertEqual(self.get_inventory()['state']['available'], 15)
+            # 同じitemは REPLAY_COST_PUBLISH_INTERVAL の間は書き込まない
+            self.query.clear_caches()
+            reconstruct.snapshot_hints.clear()
+            self.get_inventory()
+        self.assertEqual(publish.call_count, 1)
+        cost_ms = store.get(SNAPSHOT_ID, 1)['replay_cost_ms']
+        self.assertGreaterEqual(cost_ms, 0)
+
+    def test_short_tail_is_not_published(self):
+        store = self.query.model.snapshot_store
+        store.append(snapshot(1, 0, 0))
+        self.query.model.event_store.batch_write(
+            [event(version) for version in range(1, 4)])
+        with mock.patch.object(reconstruct, 'REPLAY_COST_PUBLISH', True):
+            self.get_inventory()
+        self.assertNotIn('replay_cost_ms', store.get(SNAPSHOT_ID, 1))
+
+    def test_snapshot_function_uses_and_keeps_published_cost(self):
+        store = self.snapshot.model.snapshot_store
+        store.append(snapshot(1, 0, 0, replay_cost_ms=3.0))
+        events = [event(1), event(2)]
+        self.snapshot.model.event_store.batch_write(events)
+
+        with mock.patch.object(self.snapshot.model, 'snapshot_policy',
+                               self.policy(6)):
+            self.snapshot.event_handler.EventHandler(events[:1]).update()
+            self.assertEqual(store.get_latest(SNAPSHOT_ID)['version'], 1)
+            # 2 events x 3.0 ms >= 6 ms
+            self.snapshot.event_handler.EventHandler(events[1:]).update()
+        latest = store.get_latest(SNAPSHOT_ID)
+        self.assertEqual(latest['version'], 2)
+        self.assertEqual(latest['from_version'], 2)
+        self.assertEqual(latest['replay_cost_ms'], 3.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest import mock
+
+"""
+storage backendのtransact_append (all or nothing) の確認
+
+    $ python -m unittest discover tests
+"""
+
+import support  # noqa: E402
+from pynamodb.connection.base import Connection  # noqa: E402
+from escqrs.storage.base import ConditionalCheckFailed  # noqa: E402
+from escqrs.storage.dynamodb import DynamoDBBackend  # noqa: E402
+from escqrs.storage.memory import InMemoryBackend  # noqa: E402
+from escqrs.storage.sqlite import SQLiteBackend  # noqa: E402
+
+
+def item(version, item_id='item-1'):
+    return {'item_id': item_id, 'version': version, 'quantity': 1}
+
+
+class TransactAppendTest(unittest.TestCase):
+
+    def setUp(self):
+        InMemoryBackend.clear()
+
+    def backends(self):
+        return [InMemoryBackend('EventStore'), SQLiteBackend('EventStore')]
+
+    def test_existing_key_writes_nothing(self):
+        for backend in self.backends():
+            with self.subTest(backend=type(backend).__name__):
+                backend.append(item(2))
+                with self.assertRaises(ConditionalCheckFailed):
+                    backend.transact_append([item(1), item(2), item(3)])
+                self.assertEqual([row['version'] for row in
+                                  backend.query('item-1')], [2])
+
+    def test_duplicate_key_within_transaction_writes_nothing(self):
+        for backend in self.backends():
+            with self.subTest(backend=type(backend).__name__):
+                with self.assertRaises(ConditionalCheckFailed):
+                    backend.transact_append(
+                        [item(1), item(2, 'item-2'), item(1)])
+                self.assertEqual(backend.query('item-1'), [])
+                self.assertEqual(backend.query('item-2'), [])
+
+    def test_dynamodb_rejects_duplicate_key_before_sending(self):
+        model = support.Service('event').model.EventStoreModel
+        with mock.patch.object(Connection, 'dispatch') as dispatch:
+            with self.assertRaises(ConditionalCheckFailed):
+                DynamoDBBackend(model).transact_append([item(1), item(1)])
+        dispatch.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()